@@ -21,6 +21,7 @@ from .shift_management import (
     handle_start_shift_request,
     process_karakul_number,
     process_sizod_number_input, # Если не работает с БД, session_factory не нужен
+    handle_sizod_suggestion,
     process_sizod_status_start_choice,
     process_skip_sizod_notes_start,
     process_sizod_notes_start_input,
@@ -40,6 +41,7 @@ from .firefighter import EquipmentLogStates # и другие релевантн
 
 from .dispatcher import (
     DispatchCreationStates,
+    DispatchSearchStates,
     AbsenceRegistrationStates,
     handle_mark_absent_request,
     process_absent_employee_rank,
@@ -58,6 +60,10 @@ from .commander import (
 )
 
 from models import async_session # Это ваш async_sessionmaker
+from app.reservations import release_owner as release_owner_reservations
+from app.idempotency import IdempotentCallbackMiddleware
+from app.priority_scheduler import PriorityMiddleware, update_scheduler
+from app.chat_ordering import ChatOrderedMiddleware, chat_order
 
 # Импорты функций регистрации хэндлеров из модулей ролей
 from app.drivers import register_driver_handlers
@@ -75,6 +81,8 @@ async def universal_cancel_handler(callback: types.CallbackQuery, state: FSMCont
         f"Callback data: '{callback.data}'. Current FSM state: {current_fsm_state}"
     )
     await state.clear()
+    if current_fsm_state and current_fsm_state.startswith(DispatchCreationStates.__name__):
+        await release_owner_reservations(async_session, user_id) # Снимаем брони ЛС/техники этого диспетчера
     try:
         await callback.message.edit_text("Действие отменено.", reply_markup=None)
     except Exception as e:
@@ -86,6 +94,18 @@ async def universal_cancel_handler(callback: types.CallbackQuery, state: FSMCont
 def register_handlers(router: Router, bot: Bot):
     logging.info("Регистрируем обработчики...")
 
+    # Повторные нажатия кнопок утверждения/сохранения отсекаются до обработчиков
+    router.callback_query.outer_middleware(IdempotentCallbackMiddleware())
+    # Обработчики с flags=CHAT_ORDERED выполняются по очереди внутри чата (app/chat_ordering.py)
+    chat_ordered_middleware = ChatOrderedMiddleware(chat_order)
+    router.message.middleware(chat_ordered_middleware)
+    router.callback_query.middleware(chat_ordered_middleware)
+    # Приоритеты: выезды раньше смен, смены раньше истории и отчетов. Место берется после
+    # очереди чата, чтобы ожидание более раннего апдейта не занимало место планировщика
+    priority_middleware = PriorityMiddleware(update_scheduler)
+    router.message.middleware(priority_middleware)
+    router.callback_query.middleware(priority_middleware)
+
     # Регистрация хэндлеров по ролям (эти функции сами регистрируют свои хэндлеры на переданный router)
     register_driver_handlers(router) # Предполагается, что эта функция корректно настроена
     register_firefighter_handlers(router)
@@ -137,6 +157,7 @@ def register_handlers(router: Router, bot: Bot):
 
     # Пожарный - заступление
     router.message.register(process_sizod_number_input, StartShiftStates.ENTERING_SIZOD_NUMBER) # Не требует session_factory, если только FSM
+    router.callback_query.register(handle_sizod_suggestion, StartShiftStates.ENTERING_SIZOD_NUMBER, F.data.startswith("sizod_pick_"))
     async def firefighter_sizod_status_start_entry_point(callback: types.CallbackQuery, state: FSMContext):
         await process_sizod_status_start_choice(callback, state, async_session)
     router.callback_query.register(firefighter_sizod_status_start_entry_point, F.data.startswith("sizod_status_start_"), StartShiftStates.CHOOSING_SIZOD_STATUS_START)
@@ -218,6 +239,7 @@ def register_handlers(router: Router, bot: Bot):
             EquipmentLogStates,
             StartShiftStates, EndShiftStates, # Добавил EndShiftStates
             DispatchCreationStates,
+            DispatchSearchStates,
             TripSheetStates,
             CheckStatusStates
             # Добавьте другие группы состояний по мере необходимости
@@ -0,0 +1,125 @@
+import bisect
+import heapq
+import logging
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from app.archive import DispatchOrderAll
+from app.duplicate_calls import address_prefix_key
+
+# --- Подсказки адресов по истории выездов (в памяти) ---
+# Ключ адреса - нормализованный адрес без типа улицы ("пр. Мира, д. 7" -> "мира 7").
+# Ключи лежат в отсортированном списке: все адреса с заданным началом - один непрерывный
+# диапазон, который находится двумя bisect. Из диапазона берутся самые частые адреса.
+# Для коротких начал диапазон может быть большим, поэтому лучшие адреса таких начал
+# (диапазон больше AUTOCOMPLETE_SCAN_LIMIT) вычисляются один раз и кэшируются.
+# Частоты только растут (новые выезды), поэтому кэш обновляется точечно при добавлении.
+# Загружается при старте из всех выездов (включая archive.db), пополняется после создания выезда.
+
+AUTOCOMPLETE_MIN_PREFIX = 3    # Подсказки - начиная с третьего символа
+AUTOCOMPLETE_SUGGESTIONS = 5
+AUTOCOMPLETE_SCAN_LIMIT = 256  # Больший диапазон не просматривается при каждом запросе
+
+_KEY_RANGE_END = '\U0010ffff'
+
+
+class AddressAutocomplete:
+    """Префиксный индекс адресов, упорядоченный по частоте."""
+
+    def __init__(self, limit: int = AUTOCOMPLETE_SUGGESTIONS, scan_limit: int = AUTOCOMPLETE_SCAN_LIMIT):
+        self.limit = limit
+        self.scan_limit = scan_limit
+        self._keys: list[str] = []            # Отсортированные ключи
+        self._counts: dict[str, int] = {}     # Ключ -> число выездов
+        self._display: dict[str, str] = {}    # Ключ -> адрес в том виде, в каком его показывать
+        self._top_cache: dict[str, list[str]] = {} # Начало с большим диапазоном -> лучшие ключи
+
+    def __len__(self):
+        return len(self._keys)
+
+    def load(self, address_counts):
+        """Полная загрузка из пар (адрес, число выездов)."""
+        self._counts.clear()
+        self._display.clear()
+        self._top_cache.clear()
+        display_counts: dict[str, int] = {} # Для показа - самое частое написание адреса
+        for address, count in address_counts:
+            key = address_prefix_key(address)
+            if not key:
+                continue
+            if count > display_counts.get(key, 0):
+                display_counts[key] = count
+                self._display[key] = address
+            self._counts[key] = self._counts.get(key, 0) + count
+        self._keys = sorted(self._counts)
+
+    def add(self, address: str):
+        """Учитывает новый выезд по адресу."""
+        key = address_prefix_key(address)
+        if not key:
+            return
+        if key not in self._counts:
+            bisect.insort(self._keys, key)
+            self._counts[key] = 0
+        self._counts[key] += 1
+        self._display[key] = address
+        # Обновляем кэш лучших адресов для всех начал этого ключа
+        for length in range(AUTOCOMPLETE_MIN_PREFIX, len(key) + 1):
+            top = self._top_cache.get(key[:length])
+            if top is None:
+                continue
+            if key not in top:
+                top.append(key)
+            top.sort(key=self._counts.__getitem__, reverse=True)
+            del top[self.limit:]
+
+    def _range(self, prefix: str) -> tuple[int, int]:
+        return bisect.bisect_left(self._keys, prefix), bisect.bisect_left(self._keys, prefix + _KEY_RANGE_END)
+
+    def _top_keys(self, prefix: str) -> list[str]:
+        cached = self._top_cache.get(prefix)
+        if cached is not None:
+            return cached
+        low, high = self._range(prefix)
+        top = heapq.nlargest(self.limit, self._keys[low:high], key=self._counts.__getitem__)
+        if high - low > self.scan_limit:
+            self._top_cache[prefix] = top
+        return top
+
+    def suggest(self, text: str) -> list[str]:
+        """До limit адресов, начинающихся с введенного текста, самые частые первыми."""
+        prefix = address_prefix_key(text)
+        if len(prefix) < AUTOCOMPLETE_MIN_PREFIX:
+            return []
+        return [self._display[key] for key in self._top_keys(prefix)]
+
+    def warm_cache(self):
+        """Заранее кэширует лучшие адреса для всех начал с большим диапазоном."""
+        length = AUTOCOMPLETE_MIN_PREFIX
+        prefixes = {key[:length] for key in self._keys if len(key) >= length}
+        while prefixes:
+            next_prefixes = set()
+            for prefix in prefixes:
+                low, high = self._range(prefix)
+                if high - low > self.scan_limit:
+                    self._top_keys(prefix)
+                    next_prefixes.update(key[:length + 1] for key in self._keys[low:high] if len(key) > length)
+            prefixes = next_prefixes
+            length += 1
+
+
+# Общий индекс подсказок для обработчиков диспетчера
+address_autocomplete = AddressAutocomplete()
+
+
+async def warm_address_autocomplete(session_factory: async_sessionmaker):
+    """Загружает адреса всех выездов в индекс подсказок (вызывается при старте бота)."""
+    async with session_factory() as session:
+        result = await session.execute(
+            select(DispatchOrderAll.address, func.count()).group_by(DispatchOrderAll.address)
+        )
+        rows = result.all()
+    address_autocomplete.load(rows)
+    address_autocomplete.warm_cache()
+    logging.info(f"Подсказки адресов загружены: {len(address_autocomplete)} адресов.")
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, Index, MetaData, Table, delete, event, exists, func, insert, inspect, select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+from sqlalchemy.orm import aliased
+
+from models import DispatchOrder, EquipmentLog, ResourceReservation, ShiftLog, TripSheet
+
+# --- Горячие и холодные данные ---
+# Завершенные выезды, закрытые смены, старые записи журнала снаряжения и путевые листы
+# старше горизонта хранения переносятся в отдельный файл archive.db, который подключается
+# к каждому соединению через ATTACH DATABASE ... AS archive. Основной database.db остается
+# небольшим и целиком помещается в кэш страниц.
+# Для чтения "всего сразу" на каждом соединении создаются временные представления
+# <таблица>_all = main.<таблица> UNION ALL archive.<таблица> (постоянное представление
+# в main не может ссылаться на подключенную базу - ограничение SQLite).
+# Архив только для чтения: редактирование выезда после переноса недоступно.
+
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "archive.db")
+ARCHIVE_SCHEMA = 'archive'
+
+DISPATCH_RETENTION_DAYS = int(os.getenv("DISPATCH_RETENTION_DAYS", "180")) # ~6 месяцев
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = 500   # Строк за одну транзакцию (короткие блокировки записи)
+ARCHIVAL_SCHEDULE = "30 3 * * *" # Каждую ночь в 03:30 (app/scheduler.py)
+
+ARCHIVABLE_DISPATCH_STATUSES = ('completed', 'rejected', 'canceled') # Те же, что показываются в "📂 Архив выездов"
+
+ARCHIVED_MODELS = (EquipmentLog, ShiftLog, DispatchOrder, TripSheet) # Журнал снаряжения раньше смен (ссылается на них)
+
+# Таблицы-описания представлений <таблица>_all (только колонки, без внешних ключей)
+_views_metadata = MetaData()
+_archive_metadata = MetaData()
+
+
+def _view_table(model) -> Table:
+    table = model.__table__
+    return Table(
+        f"{table.name}_all", _views_metadata,
+        *[Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns]
+    )
+
+
+def _archive_table(model) -> Table:
+    table = model.__table__
+    archive_table = Table(
+        table.name, _archive_metadata,
+        *[Column(column.name, column.type, primary_key=column.primary_key) for column in table.columns],
+        schema=ARCHIVE_SCHEMA
+    )
+    # Те же индексы, что у модели: запросы к представлениям *_all (список архива, счетчик)
+    # используют индекс в каждой из двух баз, без полного просмотра архива
+    for index in table.indexes:
+        Index(index.name, *[archive_table.c[column.name] for column in index.columns], unique=index.unique)
+    return archive_table
+
+
+dispatch_orders_all = _view_table(DispatchOrder)
+trip_sheets_all = _view_table(TripSheet)
+shift_logs_all = _view_table(ShiftLog)
+equipment_logs_all = _view_table(EquipmentLog)
+
+ARCHIVE_TABLES = {model: _archive_table(model) for model in ARCHIVED_MODELS}
+
+# ORM-сущности поверх представлений: выезды и путевые листы из обеих баз (только чтение)
+DispatchOrderAll = aliased(DispatchOrder, dispatch_orders_all, adapt_on_names=True)
+TripSheetAll = aliased(TripSheet, trip_sheets_all, adapt_on_names=True)
+
+
+def _create_views_sql(model) -> str:
+    table = model.__table__
+    columns = ", ".join(column.name for column in table.columns)
+    return (
+        f"CREATE TEMP VIEW IF NOT EXISTS {table.name}_all AS "
+        f"SELECT {columns} FROM main.{table.name} "
+        f"UNION ALL SELECT {columns} FROM {ARCHIVE_SCHEMA}.{table.name}"
+    )
+
+
+def _on_connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"ATTACH DATABASE '{ARCHIVE_DB_PATH}' AS {ARCHIVE_SCHEMA}")
+        for model in ARCHIVED_MODELS:
+            cursor.execute(_create_views_sql(model))
+    finally:
+        cursor.close()
+
+
+def install_archive(engine: AsyncEngine):
+    """Подключает archive.db и представления *_all к каждому новому соединению (вызывать до первого запроса)."""
+    event.listen(engine.sync_engine, "connect", _on_connect)
+
+
+def _ensure_archive_tables(sync_conn):
+    _archive_metadata.create_all(sync_conn)
+    inspector = inspect(sync_conn)
+    for table in ARCHIVE_TABLES.values():
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name, schema=ARCHIVE_SCHEMA)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                sync_conn.exec_driver_sql(
+                    f"ALTER TABLE {ARCHIVE_SCHEMA}.{table.name} ADD COLUMN {column.name} "
+                    f"{column.type.compile(dialect=sync_conn.dialect)}"
+                )
+                logging.info(f"Миграция архива: в таблицу {table.name} добавлена колонка {column.name}.")
+        # Индексы - после колонок (новый индекс может ссылаться на только что добавленную колонку)
+        for index in table.indexes:
+            if not inspector.has_index(table.name, index.name, schema=ARCHIVE_SCHEMA):
+                index.create(sync_conn)
+                logging.info(f"Миграция архива: создан индекс {index.name}.")
+
+
+async def ensure_archive_schema(engine: AsyncEngine):
+    """Создает таблицы в archive.db (и добавляет новые колонки и индексы моделей)."""
+    async with engine.begin() as conn:
+        await conn.run_sync(_ensure_archive_tables)
+
+
+def _archive_conditions(model, now: datetime) -> list:
+    dispatch_horizon = now - timedelta(days=DISPATCH_RETENTION_DAYS)
+    log_horizon = now - timedelta(days=LOG_RETENTION_DAYS)
+    table = model.__table__
+    # Строка с максимальным id всегда остается в основной базе: id без AUTOINCREMENT
+    # берутся как max(id) + 1, и пустая таблица начала бы выдавать id, уже занятые в архиве
+    conditions = [table.c.id < select(func.max(table.c.id)).correlate(None).scalar_subquery()]
+    if model is DispatchOrder:
+        conditions += [
+            DispatchOrder.status.in_(ARCHIVABLE_DISPATCH_STATUSES),
+            DispatchOrder.creation_time < dispatch_horizon,
+            ~exists().where(ResourceReservation.dispatch_id == DispatchOrder.id),
+        ]
+    elif model is ShiftLog:
+        conditions += [
+            ShiftLog.status != 'active',
+            ShiftLog.start_time < log_horizon,
+            ~exists().where(EquipmentLog.shift_log_id == ShiftLog.id), # Сначала уходят записи журнала смены
+        ]
+    elif model is EquipmentLog:
+        conditions.append(EquipmentLog.timestamp < log_horizon)
+    elif model is TripSheet:
+        conditions.append(TripSheet.date < log_horizon)
+    return conditions
+
+
+async def _archive_batch(session: AsyncSession, model, now: datetime) -> int:
+    table = model.__table__
+    archive_table = ARCHIVE_TABLES[model]
+    ids = (await session.scalars(
+        select(table.c.id).where(*_archive_conditions(model, now)).order_by(table.c.id).limit(ARCHIVE_BATCH_SIZE)
+    )).all()
+    if not ids:
+        return 0
+    column_names = [column.name for column in table.columns]
+    # Перенос и удаление в одной транзакции (SQLite фиксирует изменения обеих баз атомарно)
+    await session.execute(
+        insert(archive_table).from_select(column_names, select(*table.columns).where(table.c.id.in_(ids)))
+    )
+    await session.execute(delete(table).where(table.c.id.in_(ids)))
+    return len(ids)
+
+
+async def run_archival(session_factory) -> dict[str, int]:
+    """Переносит в архив все строки старше горизонта хранения. Возвращает число перенесенных строк по таблицам."""
+    now = datetime.now()
+    moved: dict[str, int] = {}
+    for model in ARCHIVED_MODELS:
+        total = 0
+        while True:
+            async with session_factory() as session:
+                async with session.begin():
+                    count = await _archive_batch(session, model, now)
+            total += count
+            if count < ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(0) # Даем обработчикам апдейтов выполниться между пачками
+        moved[model.__tablename__] = total
+    # VACUUM здесь не выполняется: он перестраивает весь файл под эксклюзивной блокировкой
+    # и не может идти, пока у пула открыты другие соединения. Освободившиеся страницы
+    # SQLite переиспользует под новые строки, так что файл основной базы не растет.
+    logging.info(f"Архивация: перенесено строк {moved}.")
+    return moved
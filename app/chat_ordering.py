@@ -0,0 +1,138 @@
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import TelegramObject, Update
+
+# --- Последовательная обработка апдейтов одного чата (по выбору обработчика) ---
+# Каждый апдейт обрабатывается отдельной задачей (режим aiogram по умолчанию), поэтому быстрый
+# второй callback может обогнать state.update_data предыдущего. Обработчики, которым это важно
+# (выбор ЛС/техники и т.п.), регистрируются с флагом flags=CHAT_ORDERED; остальные работают
+# параллельно, как обычно.
+# Порядок фиксируется при получении апдейта: ChatTicketMiddleware (outer, dp.update) выдает
+# апдейту номер в очереди его чата до фильтров - синхронные фильтры aiogram выполняются
+# в потоках и могут поменять апдейты местами. ChatOrderedMiddleware (inner, после фильтров)
+# для обработчика с флагом ждет, пока обработаются все более ранние апдейты чата; апдейт без
+# флага сразу освобождает свое место. Обработчик выполняется в задаче своего апдейта, поэтому
+# его исключение доходит до обработчиков dp.errors как обычно.
+# Очередь чата удаляется, как только в ней не остается апдейтов: память ограничена числом
+# апдейтов в обработке, а не числом пользователей.
+
+CHAT_ORDERED_FLAG = 'chat_ordered'
+CHAT_ORDERED = {CHAT_ORDERED_FLAG: True} # flags=CHAT_ORDERED при регистрации обработчика
+
+_TICKET_KEY = 'chat_order_ticket'
+
+
+class ChatTicket:
+    __slots__ = ('chat_key', 'turn', 'released')
+
+    def __init__(self, chat_key, turn: asyncio.Future):
+        self.chat_key = chat_key
+        self.turn = turn # Выполняется, когда все более ранние апдейты чата освободили очередь
+        self.released = False
+
+
+class ChatOrder:
+    """Очереди апдейтов по чатам: апдейт с флагом ждет, пока освободятся все более ранние."""
+
+    def __init__(self):
+        self._queues: dict[Any, deque[ChatTicket]] = {}
+        self.waited = 0 # Сколько раз обработчик ждал более ранний апдейт своего чата
+
+    def take_ticket(self, chat_key) -> ChatTicket:
+        queue = self._queues.get(chat_key)
+        if queue is None:
+            queue = self._queues[chat_key] = deque()
+        ticket = ChatTicket(chat_key, asyncio.get_running_loop().create_future())
+        if not queue:
+            ticket.turn.set_result(None)
+        queue.append(ticket)
+        return ticket
+
+    async def wait_turn(self, ticket: ChatTicket):
+        if not ticket.turn.done():
+            self.waited += 1
+            await ticket.turn
+
+    def release(self, ticket: ChatTicket):
+        if ticket.released:
+            return
+        ticket.released = True
+        queue = self._queues[ticket.chat_key]
+        was_first = queue[0] is ticket
+        queue.remove(ticket) # Очередь одного чата короткая
+        if not queue:
+            del self._queues[ticket.chat_key]
+        elif was_first and not queue[0].turn.done():
+            queue[0].turn.set_result(None)
+
+    def __len__(self):
+        return len(self._queues)
+
+
+def _chat_key(data: dict[str, Any]):
+    chat = data.get('event_chat')
+    if chat is not None:
+        return chat.id
+    user = data.get('event_from_user')
+    if user is not None:
+        return ('user', user.id)
+    return None
+
+
+class ChatTicketMiddleware(BaseMiddleware):
+    """Outer-middleware для dp.update: место апдейта в очереди его чата в порядке получения."""
+
+    def __init__(self, order: ChatOrder):
+        self.order = order
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any]
+    ) -> Any:
+        chat_key = _chat_key(data)
+        if chat_key is None:
+            return await handler(event, data) # Апдейты без чата и пользователя - без очереди
+        ticket = self.order.take_ticket(chat_key)
+        data[_TICKET_KEY] = ticket
+        try:
+            return await handler(event, data)
+        finally:
+            self.order.release(ticket) # Апдейт без подходящего обработчика или с ошибкой
+
+
+class ChatOrderedMiddleware(BaseMiddleware):
+    """Inner-middleware для router.message / router.callback_query (регистрировать первым).
+
+    Обработчик с флагом CHAT_ORDERED ждет своей очереди в чате, остальные выполняются сразу.
+    """
+
+    def __init__(self, order: ChatOrder):
+        self.order = order
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        ticket: ChatTicket | None = data.get(_TICKET_KEY)
+        if ticket is None:
+            return await handler(event, data)
+        if not get_flag(data, CHAT_ORDERED_FLAG):
+            self.order.release(ticket) # Более поздним апдейтам чата ждать этот обработчик не нужно
+            return await handler(event, data)
+        await self.order.wait_turn(ticket)
+        try:
+            return await handler(event, data)
+        finally:
+            self.order.release(ticket)
+
+
+# Общие очереди чатов бота
+chat_order = ChatOrder()
@@ -0,0 +1,113 @@
+import logging
+import time
+from typing import Callable
+
+from aiogram.exceptions import TelegramNetworkError, TelegramServerError
+
+# --- Предохранитель (circuit breaker) для запросов к Bot API ---
+# Если Telegram недоступен или отвечает ошибками 5xx, каждый запрос висит до таймаута,
+# и обработчики копятся. После CIRCUIT_FAILURE_THRESHOLD сетевых ошибок подряд
+# предохранитель размыкается: запросы сразу завершаются ошибкой CircuitOpenError.
+# Через CIRCUIT_RESET_TIMEOUT_SECONDS пропускается один пробный запрос; успех замыкает цепь.
+# Неинтерактивные уведомления при этом остаются в outbox и отправляются по порядку
+# после замыкания (см. app/outbox.py).
+
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT_SECONDS = 30
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half_open'
+
+# Ошибки, которые означают недоступность Telegram (а не ошибку в самом запросе)
+OUTAGE_ERRORS = (TelegramNetworkError, TelegramServerError)
+
+
+class CircuitOpenError(TelegramNetworkError):
+    """Запрос не выполнялся: предохранитель разомкнут."""
+
+
+class CircuitBreaker:
+    """Предохранитель с состояниями closed -> open -> half_open -> closed."""
+
+    def __init__(self, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = STATE_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._close_listeners: list[Callable[[], None]] = []
+        # Метрики
+        self.times_opened = 0
+        self.rejected = 0
+
+    def add_close_listener(self, listener: Callable[[], None]):
+        """Функция, вызываемая при замыкании цепи (например, разбудить отправителя outbox)."""
+        self._close_listeners.append(listener)
+
+    def _probe_due(self) -> bool:
+        return time.monotonic() - self.opened_at >= self.reset_timeout
+
+    @property
+    def accepting(self) -> bool:
+        """Будет ли сейчас пропущен запрос (без изменения состояния)."""
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN:
+            return self._probe_due()
+        return not self._probe_in_flight
+
+    def before_request(self) -> bool:
+        """Разрешение на запрос. True для пробного запроса переводит цепь в half_open."""
+        if self.state == STATE_CLOSED:
+            return True
+        if self.state == STATE_OPEN and self._probe_due():
+            self.state = STATE_HALF_OPEN
+            logging.info("Bot API: предохранитель в режиме пробного запроса.")
+        if self.state == STATE_HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self._probe_in_flight = False
+        self.consecutive_failures = 0
+        if self.state != STATE_CLOSED:
+            self.state = STATE_CLOSED
+            logging.warning("Bot API снова доступен: предохранитель замкнут.")
+            for listener in self._close_listeners:
+                try:
+                    listener()
+                except Exception as e:
+                    logging.exception(f"Ошибка обработчика замыкания предохранителя: {e}")
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == STATE_HALF_OPEN or (self.state == STATE_CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self.state = STATE_OPEN
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            logging.warning(
+                f"Bot API недоступен ({self.consecutive_failures} ошибок подряд): предохранитель разомкнут "
+                f"на {self.reset_timeout} с."
+            )
+
+    def release_probe(self):
+        """Пробный запрос прерван без результата (например, отменен) - можно пробовать снова."""
+        self._probe_in_flight = False
+
+    def metrics(self) -> dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'times_opened': self.times_opened,
+            'rejected_requests': self.rejected,
+            'open_for_seconds': round(time.monotonic() - self.opened_at, 1) if self.state != STATE_CLOSED else 0.0,
+        }
+
+
+# Общий предохранитель для всех запросов бота к Bot API
+telegram_breaker = CircuitBreaker()
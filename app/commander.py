@@ -1,21 +1,19 @@
+import html
 import json
 from aiogram import F, types, Router, Bot
-from aiogram.filters import StateFilter
+from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext # Если не используется напрямую в этом файле, можно убрать
 from aiogram.fsm.state import State, StatesGroup # Если не используется напрямую в этом файле, можно убрать
 from sqlalchemy import select, func, or_
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker # async_sessionmaker нужен
-from sqlalchemy.orm import selectinload
 from datetime import datetime, date
 from .dispatcher import show_full_dispatch_details 
 from .shift_management import get_active_shift
 # Импортируем модели и session_factory
 from models import (
     Employee,
-    Vehicle,
     DispatchOrder,
     Equipment,
-    ShiftLog,
     AbsenceLog,
     EquipmentLog,
     async_session # Это ваш session_factory из models.py
@@ -24,15 +22,44 @@ from app.keyboards import (
     get_dispatch_approval_keyboard,
     get_cancel_keyboard,
     get_equipment_maintenance_action_keyboard,
-    get_maintenance_confirmation_keyboard) # Убедитесь, что клавиатура импортируется
+    get_maintenance_confirmation_keyboard,
+    get_equipment_for_service_keyboard) # Убедитесь, что клавиатура импортируется
 # Импортируем константы статусов и хелпер пагинации из dispatcher
 from .dispatcher import (
     STATUS_TRANSLATIONS,
     ACTIVE_DISPATCH_STATUSES,
     _generate_dispatch_list_page # Если используется
 )
+from .read_models import (
+    fetch_equipment_for_service,
+    fetch_expiring_equipment,
+    count_expiring_equipment,
+    fetch_active_shift_rows,
+    fetch_vehicle_rows,
+    fetch_personnel_readiness_rows
+)
+from app.outbox import enqueue_message as enqueue_outbox_message, wake_outbox_sender
+from app.maintenance_scans import EQUIPMENT_EXPIRY_WARNING_DAYS, DIGEST_MAX_LINES
+from app.chat_ordering import CHAT_ORDERED
+from app.shift_closure import close_shifts, fetch_active_karakul_counts, END_REASON_KARAKUL_CLOSED
+from app.karakul_start import (
+    ROLE_DRIVER, ROLE_FIREFIGHTER,
+    build_karakul_roster, start_karakul_shifts, fetch_vehicle_readings, apply_vehicle, sizod_warning,
+    roster_to_data, roster_from_data
+)
+from app.inventory_index import inventory_index
+from app.equipment_checkout import get_equipment_state
+from app.reservations import release_dispatch as release_dispatch_reservations
+from app.idempotency import allow_callback_retry
 import logging
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton # Для кнопки "Детали выезда"
+from aiogram.types import InlineKeyboardMarkup
+
+# Статус техники в сводке НК
+VEHICLE_STATUS_LINES = {
+    'available': '✅ Доступен', 'in_use': '🅿️ На карауле/выезде',
+    'maintenance': '🛠 На ТО', 'repair': '⚠️ В ремонте'
+}
 
 class EquipmentMaintenanceStates(StatesGroup):
     CHOOSING_EQUIPMENT = State()      # НК выбирает снаряжение для обслуживания
@@ -40,6 +67,12 @@ class EquipmentMaintenanceStates(StatesGroup):
     ENTERING_NOTES = State()          # (Опционально) НК вводит примечание
     CONFIRMING_ACTION = State()       # НК подтверждает действие
 
+class KarakulStartStates(StatesGroup):
+    CHOOSING_KARAKUL = State()   # НК выбирает караул
+    REVIEWING_ROSTER = State()   # НК отмечает состав и правит назначения
+    CHOOSING_VEHICLE = State()   # Другой автомобиль водителю
+    ENTERING_SIZOD = State()     # Другой СИЗОД пожарному
+
 async def confirm_and_save_maintenance_action(callback: types.CallbackQuery, state: FSMContext, session_factory: async_sessionmaker):
     await callback.answer()
     data = await state.get_data()
@@ -142,6 +175,7 @@ async def confirm_and_save_maintenance_action(callback: types.CallbackQuery, sta
         except Exception as e:
             logging.exception(f"Ошибка при сохранении изменений статуса снаряжения ID {equipment_id}: {e}")
             await callback.message.edit_text("Произошла ошибка при сохранении изменений.", reply_markup=None)
+            allow_callback_retry()
         finally:
             await state.clear()
     
@@ -254,65 +288,54 @@ async def back_to_equipment_list_for_maintenance(callback: types.CallbackQuery,
     
     # Повторно показываем список снаряжения (как в start_equipment_maintenance)
     async with session_factory() as session:
-        equipment_to_service = await session.scalars(
-            select(Equipment).where(Equipment.status.notin_(['available', 'decommissioned'])).order_by(Equipment.name) # type: ignore
-        )
-        equipment_list = equipment_to_service.all()
+        equipment_list = await fetch_equipment_for_service(session)
 
     if not equipment_list:
         await callback.message.edit_text("✅ Всё снаряжение в порядке или уже списано.", reply_markup=None)
         await state.clear() # Выходим из FSM
         return
 
-    builder = InlineKeyboardBuilder()
-    for item in equipment_list:
-        status_emoji = {'maintenance': '🛠️', 'repair': '⚠️', 'in_use': '👨‍🚒'}.get(item.status, '❓')
-        builder.button(
-            text=f"{status_emoji} {item.name} ({item.inventory_number or 'б/н'}) - {item.status}",
-            callback_data=f"maint_select_equip_{item.id}"
-        )
-    builder.adjust(1)
-    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="maint_cancel_fsm"))
-
     await callback.message.edit_text(
         "Выберите снаряжение для изменения статуса/обслуживания:",
-        reply_markup=builder.as_markup()
+        reply_markup=get_equipment_for_service_keyboard(equipment_list)
     )
     await state.set_state(EquipmentMaintenanceStates.CHOOSING_EQUIPMENT) # Возвращаем в состояние выбора
 
+def _expiring_equipment_text(expiring: list, total: int) -> str:
+    """Список истекающего снаряжения: не больше DIGEST_MAX_LINES строк, остальное - "... и еще N"."""
+    today = date.today()
+    lines = [f"⏳ <b>Срок службы истекает (≤ {EQUIPMENT_EXPIRY_WARNING_DAYS} дн.):</b>"]
+    for item in expiring:
+        mark = "❗️ истек" if item.service_life_until < today else "до"
+        number = f" ({item.inventory_number})" if item.inventory_number else ""
+        lines.append(f"- {item.name}{number}: {mark} {item.service_life_until.strftime('%d.%m.%Y')}")
+    if total > len(expiring):
+        lines.append(f"... и еще {total - len(expiring)}")
+    return "\n".join(lines)
+
 async def start_equipment_maintenance(message: types.Message, state: FSMContext, session_factory: async_sessionmaker):
     await state.clear()
     logging.info(f"НК {message.from_user.id} инициировал обслуживание снаряжения.")
 
     async with session_factory() as session:
         # Выбираем снаряжение, которое НЕ доступно и НЕ списано (т.е. требует внимания)
-        # Или можно выбрать конкретные статусы, например, 'maintenance', 'repair'
-        equipment_to_service = await session.scalars(
-            select(Equipment)
-            .where(
-                Equipment.status.notin_(['available', 'decommissioned']) # type: ignore
-            )
-            .order_by(Equipment.name)
-        )
-        equipment_list = equipment_to_service.all()
+        equipment_list = await fetch_equipment_for_service(session)
+        # Снаряжение с истекающим сроком службы (диапазон по индексу service_life_until)
+        expiring = await fetch_expiring_equipment(session, EQUIPMENT_EXPIRY_WARNING_DAYS, limit=DIGEST_MAX_LINES)
+        expiring_total = len(expiring)
+        if expiring_total == DIGEST_MAX_LINES: # Показаны не все - считаем остальные
+            expiring_total = await count_expiring_equipment(session, EQUIPMENT_EXPIRY_WARNING_DAYS)
+
+    if expiring:
+        await message.answer(_expiring_equipment_text(expiring, expiring_total), parse_mode="HTML")
 
     if not equipment_list:
         await message.answer("✅ Всё снаряжение в порядке или уже списано. Нет объектов для обслуживания.", reply_markup=None)
         return
 
-    builder = InlineKeyboardBuilder()
-    for item in equipment_list:
-        status_emoji = {'maintenance': '🛠️', 'repair': '⚠️', 'in_use': '👨‍🚒'}.get(item.status, '❓')
-        builder.button(
-            text=f"{status_emoji} {item.name} ({item.inventory_number or 'б/н'}) - {item.status}",
-            callback_data=f"maint_select_equip_{item.id}"
-        )
-    builder.adjust(1)
-    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="maint_cancel_fsm"))
-
     await message.answer(
         "Выберите снаряжение для изменения статуса/обслуживания:",
-        reply_markup=builder.as_markup()
+        reply_markup=get_equipment_for_service_keyboard(equipment_list)
     )
     await state.set_state(EquipmentMaintenanceStates.CHOOSING_EQUIPMENT)
 
@@ -323,6 +346,58 @@ async def cancel_equipment_maintenance_fsm(callback: types.CallbackQuery, state:
     await state.clear()
 
 # --- Обработчик утверждения/отклонения выезда Начальником Караула (НК) ---
+async def _enqueue_approval_notifications(session: AsyncSession, dispatch_order: DispatchOrder, commander: Employee, new_status: str):
+    """Ставит в outbox уведомление диспетчеру о решении и (при утверждении) оповещение назначенному ЛС."""
+    dispatch_id = dispatch_order.id
+    dispatcher = await session.get(Employee, dispatch_order.dispatcher_id)
+    if dispatcher and dispatcher.telegram_id:
+        dispatcher_notification = (
+            f"ℹ️ Начальник караула ({commander.full_name if commander else 'НК'}) "
+            f"принял решение по выезду №{dispatch_id}:\n"
+            f"Статус: {STATUS_TRANSLATIONS.get(new_status, new_status)}"
+        )
+        enqueue_outbox_message(session, dispatcher.telegram_id, dispatcher_notification)
+        logging.info(f"Уведомление о решении по выезду {dispatch_id} для диспетчера {dispatcher.telegram_id} поставлено в outbox")
+    else:
+        logging.warning(f"Не удалось найти диспетчера ({dispatch_order.dispatcher_id}) для уведомления о решении по выезду {dispatch_id}")
+
+    # Уведомление назначенному персоналу, если выезд УТВЕРЖДЕН
+    if new_status != 'approved' or not dispatch_order.assigned_personnel_ids:
+        return
+    try:
+        personnel_ids_list = json.loads(dispatch_order.assigned_personnel_ids) # Распарсить ID персонала
+    except json.JSONDecodeError:
+        logging.error(f"Ошибка декодирования JSON assigned_personnel_ids для выезда {dispatch_id}: {dispatch_order.assigned_personnel_ids}")
+        return
+    if not isinstance(personnel_ids_list, list) or not personnel_ids_list:
+        logging.info(f"Список персонала для уведомления по выезду {dispatch_id} пуст или некорректен.")
+        return
+
+    # Получаем telegram_id всех назначенных сотрудников одним запросом
+    assigned_employees_tg_ids_result = await session.scalars(
+        select(Employee.telegram_id).where(
+            Employee.id.in_(personnel_ids_list),
+            Employee.telegram_id.isnot(None) # type: ignore
+        )
+    )
+    notification_text_personnel = (
+        f"📢 <b>ВНИМАНИЕ! Новый выезд!</b> 📢\n\n"
+        f"<b>Выезд №:</b> {dispatch_order.id}\n"
+        f"<b>Адрес:</b> {dispatch_order.address}\n"
+        f"<b>Причина:</b> {dispatch_order.reason}\n\n"
+        f"<i>Утвержден НК: {commander.full_name if commander else 'НК'}</i>"
+    )
+    # Клавиатура для уведомления персонала
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📋 Детали выезда", callback_data=f"dispatch_view_details_{dispatch_order.id}")
+    notification_markup = builder.as_markup()
+
+    tg_ids = assigned_employees_tg_ids_result.all()
+    for tg_id in tg_ids:
+        enqueue_outbox_message(session, tg_id, notification_text_personnel, parse_mode="HTML", reply_markup=notification_markup)
+    logging.info(f"Оповещения о выезде {dispatch_id} поставлены в outbox для {len(tg_ids)} сотрудников")
+
+
 async def handle_dispatch_approval(callback: types.CallbackQuery, bot: Bot, session_factory: async_sessionmaker):
     await callback.answer() 
 
@@ -369,7 +444,6 @@ async def handle_dispatch_approval(callback: types.CallbackQuery, bot: Bot, sess
 
                 new_status = ''
                 result_text_for_nk = ''
-                assigned_personnel_ids_json = dispatch_order.assigned_personnel_ids # Для уведомлений
 
                 if action == 'approve':
                     new_status = 'approved'
@@ -388,83 +462,24 @@ async def handle_dispatch_approval(callback: types.CallbackQuery, bot: Bot, sess
                     dispatch_order.approval_time = datetime.now()
                     session.add(dispatch_order)
                     logging.info(f"НК {commander.full_name} ({commander_telegram_id}) отклонил выезд ID {dispatch_id}")
-            
+
+                # Уведомления пишутся в outbox в той же транзакции, что и решение НК:
+                # после коммита они будут доставлены, даже если бот перезапустится
+                await _enqueue_approval_notifications(session, dispatch_order, commander, new_status)
+
             # --- КОММИТ ПРОИЗОШЕЛ АВТОМАТИЧЕСКИ ПРИ ВЫХОДЕ ИЗ session.begin() ---
+            wake_outbox_sender()
+
+            if new_status == 'rejected':
+                # Отклоненный выезд освобождает забронированные ЛС и технику
+                await release_dispatch_reservations(session_factory, dispatch_id)
 
-            # Уведомление Диспетчеру (используем ту же сессию, т.к. это чтение)
-            try:
-                # dispatch_order здесь уже имеет обновленные данные после коммита,
-                # но для получения dispatcher нужен только dispatch_order.dispatcher_id, который не менялся.
-                dispatcher = await session.get(Employee, dispatch_order.dispatcher_id)
-                if dispatcher and dispatcher.telegram_id:
-                    dispatcher_notification = (
-                        f"ℹ️ Начальник караула ({commander.full_name if commander else 'НК'}) "
-                        f"принял решение по выезду №{dispatch_id}:\n"
-                        f"Статус: {STATUS_TRANSLATIONS.get(new_status, new_status)}"
-                    )
-                    await bot.send_message(
-                        chat_id=dispatcher.telegram_id,
-                        text=dispatcher_notification
-                    )
-                    logging.info(f"Уведомление о решении по выезду {dispatch_id} отправлено диспетчеру {dispatcher.telegram_id}")
-                else:
-                    logging.warning(f"Не удалось найти диспетчера ({dispatch_order.dispatcher_id}) для уведомления о решении по выезду {dispatch_id}")
-            except Exception as notify_err:
-                logging.exception(f"Ошибка отправки уведомления диспетчеру о решении по выезду {dispatch_id}: {notify_err}")
-
-            # Уведомление назначенному персоналу, если выезд УТВЕРЖДЕН
-            if action == 'approve' and new_status == 'approved' and assigned_personnel_ids_json:
-                try:
-                    personnel_ids_list = json.loads(assigned_personnel_ids_json) # Распарсить ID персонала
-                    if isinstance(personnel_ids_list, list) and personnel_ids_list:
-                        logging.info(f"Подготовка к отправке уведомлений о выезде ID {dispatch_id} персоналу: {personnel_ids_list}")
-                        
-                        # Получаем telegram_id всех назначенных сотрудников одним запросом
-                        # Используем ту же сессию, так как это операция чтения
-                        assigned_employees_query = select(Employee.telegram_id).where(
-                            Employee.id.in_(personnel_ids_list), 
-                            Employee.telegram_id.isnot(None) # type: ignore
-                        )
-                        assigned_employees_tg_ids_result = await session.scalars(assigned_employees_query)
-                        
-                        notification_text_personnel = (
-                            f"📢 <b>ВНИМАНИЕ! Новый выезд!</b> 📢\n\n"
-                            f"<b>Выезд №:</b> {dispatch_order.id}\n"
-                            f"<b>Адрес:</b> {dispatch_order.address}\n"
-                            f"<b>Причина:</b> {dispatch_order.reason}\n\n"
-                            f"<i>Утвержден НК: {commander.full_name if commander else 'НК'}</i>"
-                        )
-                        
-                        # Клавиатура для уведомления персонала
-                        builder = InlineKeyboardBuilder()
-                        builder.button(text="📋 Детали выезда", callback_data=f"dispatch_view_details_{dispatch_order.id}")
-                        # Можно добавить кнопку "Принял", если нужна такая логика:
-                        # builder.button(text="✅ Принял", callback_data=f"dispatch_ack_{dispatch_order.id}")
-                        notification_markup = builder.as_markup()
-
-                        for tg_id in assigned_employees_tg_ids_result.all():
-                            try:
-                                await bot.send_message(
-                                    chat_id=tg_id,
-                                    text=notification_text_personnel,
-                                    parse_mode="HTML",
-                                    reply_markup=notification_markup
-                                )
-                                logging.info(f"Уведомление о выезде {dispatch_id} отправлено сотруднику с Telegram ID {tg_id}")
-                            except Exception as e_send_personnel:
-                                logging.error(f"Не удалось отправить уведомление о выезде {dispatch_id} сотруднику с Telegram ID {tg_id}: {e_send_personnel}")
-                    else:
-                        logging.info(f"Список персонала для уведомления по выезду {dispatch_id} пуст или некорректен.")
-                except json.JSONDecodeError:
-                    logging.error(f"Ошибка декодирования JSON assigned_personnel_ids для выезда {dispatch_id}: {assigned_personnel_ids_json}")
-                except Exception as e_notify_personnel:
-                    logging.exception(f"Общая ошибка при уведомлении персонала о выезде {dispatch_id}: {e_notify_personnel}")
-            
             # Редактируем сообщение НК, убирая кнопки
             await callback.message.edit_text(result_text_for_nk, reply_markup=None)
 
     except Exception as e:
         logging.exception(f"Непредвиденная ошибка в handle_dispatch_approval для выезда {dispatch_id}: {e}")
+        allow_callback_retry()
         try:
             await callback.message.edit_text("❌ Произошла серьезная ошибка при обработке вашего решения.")
         except Exception: pass
@@ -542,37 +557,20 @@ async def show_personnel_vehicle_status_nk(message: types.Message, session_facto
 
         # 1. Заступившие на караул (либо на караул НК, либо на все активные)
         response_parts.append("\n👨‍🚒 <b>Заступили на караул:</b>")
-        shift_log_query = (
-            select(ShiftLog)
-            .options(
-                selectinload(ShiftLog.employee), # Загружаем связанный объект Employee
-                selectinload(ShiftLog.vehicle)   # Загружаем связанный объект Vehicle
-            )
-            .where(ShiftLog.status == 'active')
-            .order_by(ShiftLog.karakul_number) # Сначала сортируем по номеру караула
-        )
-        if nk_shift_karakul_number:
-            shift_log_query = shift_log_query.where(ShiftLog.karakul_number == nk_shift_karakul_number)
-        
-        all_active_shifts_result = await session.scalars(shift_log_query)
-        all_active_shifts_list = all_active_shifts_result.all()
-
-        # Сортируем по ФИО сотрудника в Python, так как это проще с загруженными объектами
-        all_active_shifts_list.sort(key=lambda s: (s.karakul_number, s.employee.full_name if s.employee else ""))
+        # Одним запросом с JOIN сотрудника и автомобиля, уже отсортировано по караулу и ФИО
+        all_active_shifts_list = await fetch_active_shift_rows(session, nk_shift_karakul_number)
         
         found_on_shift = False
         for shift in all_active_shifts_list:
             found_on_shift = True
-            emp = shift.employee
-            if not emp: continue # Пропускаем, если сотрудник почему-то не загрузился
 
-            emp_info = f"- <b>{emp.full_name}</b> ({emp.position}, {emp.rank if emp.rank else 'б/з'})"
+            emp_info = f"- <b>{shift.full_name}</b> ({shift.position}, {shift.rank if shift.rank else 'б/з'})"
             if nk_shift_karakul_number is None: # Если показываем все караулы, добавляем номер караула
                 emp_info += f" (Караул №{shift.karakul_number})"
 
-            if emp.position.lower() == "водитель" and shift.vehicle:
-                emp_info += f"\n  Авто: {shift.vehicle.model} ({shift.vehicle.number_plate}), ход: {shift.operational_priority or 'N/A'}"
-            elif emp.position.lower() == "пожарный" and shift.sizod_number:
+            if shift.position.lower() == "водитель" and shift.vehicle_model is not None:
+                emp_info += f"\n  Авто: {shift.vehicle_model} ({shift.vehicle_number_plate}), ход: {shift.operational_priority or 'N/A'}"
+            elif shift.position.lower() == "пожарный" and shift.sizod_number:
                 emp_info += f"\n  СИЗОД: №{shift.sizod_number} (Сост. прием: {shift.sizod_status_start or 'N/A'})"
                 if shift.sizod_notes_start and shift.sizod_notes_start.lower() != 'описание пропущено':
                     emp_info += f" <i>Прим: {shift.sizod_notes_start}</i>"
@@ -609,25 +607,19 @@ async def show_personnel_vehicle_status_nk(message: types.Message, session_facto
 
         # 3. Статус всей техники
         response_parts.append("\n🚒 <b>Статус всей техники:</b>")
-        all_vehicles_result = await session.scalars(select(Vehicle).order_by(Vehicle.model))
-        all_vehicles_list = all_vehicles_result.all()
+        all_vehicles_list = await fetch_vehicle_rows(session, order_by_model=True)
         found_vehicles = False
         for vhc in all_vehicles_list:
             found_vehicles = True
-            status_msg = {
-                'available': '✅ Доступен', 'in_use': '🅿️ На карауле/выезде',
-                'maintenance': '🛠 На ТО', 'repair': '⚠️ В ремонте'
-            }.get(vhc.status, f'❓({vhc.status})')
+            status_msg = VEHICLE_STATUS_LINES.get(vhc.status) or f'❓({vhc.status})'
             response_parts.append(f"- {vhc.model} ({vhc.number_plate}): {status_msg}")
         if not found_vehicles:
             response_parts.append("  <i>Нет данных о технике.</i>")
 
         # 4. Общий статус готовности личного состава (все сотрудники из Employee)
         response_parts.append("\n🧑‍🤝‍🧑 <b>Общая готовность ЛС (всего):</b>")
-        all_personnel_result = await session.scalars(
-            select(Employee).options(selectinload(Employee.held_equipment)).order_by(Employee.position, Employee.full_name)
-        )
-        all_personnel_list = all_personnel_result.all()
+        # Количество снаряжения считается в БД, списки held_equipment не загружаются
+        all_personnel_list = await fetch_personnel_readiness_rows(session)
         
         ready_count = 0
         not_ready_count = 0
@@ -639,7 +631,7 @@ async def show_personnel_vehicle_status_nk(message: types.Message, session_facto
         for emp in all_personnel_list:
             ready_status_icon = "✅" if emp.is_ready else "❌"
             
-            held_items_count = len(emp.held_equipment) # Используем загруженные данные
+            held_items_count = emp.held_items_count
             held_str = f" (снаряж: {held_items_count} ед.)" if held_items_count > 0 else ""
             
             is_on_active_shift = emp.id in employee_ids_on_active_shifts
@@ -677,6 +669,265 @@ async def show_personnel_vehicle_status_nk(message: types.Message, session_facto
             await message.answer("Не удалось отобразить статус: произошла ошибка.")
 
 
+# --- Закрытие караула целиком (все активные смены караула одной транзакцией) ---
+CLOSE_KARAKUL_BUTTON_TEXT = "🔚 Закрыть караул"
+
+async def _get_commander(session_factory: async_sessionmaker, telegram_id: int) -> Employee | None:
+    async with session_factory() as session:
+        employee = await session.scalar(select(Employee).where(Employee.telegram_id == telegram_id))
+    if employee and "начальник караула" in employee.position.lower():
+        return employee
+    return None
+
+async def handle_close_karakul_request(message: types.Message, session_factory: async_sessionmaker):
+    """Кнопка "🔚 Закрыть караул" или /close_karakul: выбор караула с активными сменами."""
+    if not await _get_commander(session_factory, message.from_user.id):
+        await message.answer("Закрыть караул может только начальник караула.")
+        return
+    karakuls = await fetch_active_karakul_counts(session_factory)
+    if not karakuls:
+        await message.answer("Нет караулов с активными сменами.")
+        return
+    builder = InlineKeyboardBuilder()
+    for karakul_number, shifts_count in karakuls:
+        builder.button(text=f"Караул №{karakul_number} ({shifts_count} чел.)", callback_data=f"close_karakul_ask_{karakul_number}")
+    builder.adjust(1)
+    await message.answer(
+        "Выберите караул. Все его активные смены будут завершены, техника освобождена, "
+        "СИЗОД отмечены сданными и направлены на проверку.",
+        reply_markup=builder.as_markup()
+    )
+
+async def handle_close_karakul_callback(callback: types.CallbackQuery, session_factory: async_sessionmaker):
+    """Подтверждение (close_karakul_ask_N), закрытие (close_karakul_do_N) или отмена."""
+    if callback.data == "close_karakul_cancel":
+        await callback.answer("Отменено")
+        await callback.message.edit_text("Закрытие караула отменено.", reply_markup=None)
+        return
+    commander = await _get_commander(session_factory, callback.from_user.id)
+    if not commander:
+        await callback.answer("Закрыть караул может только начальник караула.", show_alert=True)
+        return
+
+    if callback.data.startswith("close_karakul_ask_"):
+        karakul_number = callback.data.removeprefix("close_karakul_ask_")
+        builder = InlineKeyboardBuilder()
+        builder.button(text=f"✅ Закрыть караул №{karakul_number}", callback_data=f"close_karakul_do_{karakul_number}")
+        builder.button(text="❌ Отмена", callback_data="close_karakul_cancel")
+        builder.adjust(1)
+        await callback.answer()
+        await callback.message.edit_text(f"Закрыть все активные смены караула №{karakul_number}?", reply_markup=builder.as_markup())
+        return
+
+    karakul_number = callback.data.removeprefix("close_karakul_do_")
+    await callback.answer("Закрываю караул...")
+    try:
+        result = await close_shifts(
+            session_factory, karakul_number=karakul_number,
+            end_reason=END_REASON_KARAKUL_CLOSED, closed_by_employee_id=commander.id
+        )
+    except Exception as e:
+        logging.exception(f"Ошибка закрытия караула {karakul_number} НК {commander.id}: {e}")
+        await callback.message.edit_text("Произошла ошибка при закрытии караула.", reply_markup=None)
+        allow_callback_retry()
+        return
+    if not result:
+        await callback.message.edit_text(f"У караула №{karakul_number} нет активных смен.", reply_markup=None)
+        return
+    await callback.message.edit_text(
+        f"✅ Караул №{karakul_number} закрыт.\n"
+        f"Завершено смен: {len(result.shift_ids)}\n"
+        f"Освобождено техники: {len(result.released_vehicle_ids)}\n"
+        f"СИЗОД сдано на проверку: {len(result.returned_equipment_ids)}",
+        reply_markup=None
+    )
+
+
+# --- Заступление всего караула (состав по прошлой смене, одна транзакция) ---
+KARAKUL_START_BUTTON_TEXT = "👥 Заступление караула"
+KARAKUL_NUMBERS = ("1", "2", "3", "4") # Те же номера, что принимает process_karakul_number
+
+def _roster_entry_details(entry) -> str:
+    if entry.role == ROLE_DRIVER:
+        odometer = f"{entry.start_odometer:g} км" if entry.start_odometer is not None else "одометр ?"
+        fuel = f"{entry.start_fuel_level:g} л" if entry.start_fuel_level is not None else "топливо ?"
+        return f": {entry.vehicle_label or 'автомобиль не выбран'}, ход {entry.operational_priority or '—'}, {odometer}, {fuel}"
+    if entry.role == ROLE_FIREFIGHTER:
+        return f": СИЗОД {entry.sizod_number or 'не указан'}"
+    return ""
+
+def _karakul_roster_view(karakul_number: str, entries: list) -> tuple[str, InlineKeyboardMarkup]:
+    lines = [f"👥 <b>Заступление караула №{karakul_number}</b>", "Состав по прошлой смене. Отметьте, кто заступает, ✏️ - изменить назначение.", ""]
+    builder = InlineKeyboardBuilder()
+    for entry in entries:
+        mark = "✅" if entry.included else "⬜️"
+        line = f"{mark} {html.escape(entry.full_name)} ({html.escape(entry.position)}){html.escape(_roster_entry_details(entry))}"
+        if entry.warning and entry.included:
+            line += f" ⚠️ {html.escape(entry.warning)}"
+        lines.append(line)
+        buttons = [InlineKeyboardButton(text=f"{mark} {entry.full_name}", callback_data=f"kstart_toggle_{entry.employee_id}")]
+        if entry.role in (ROLE_DRIVER, ROLE_FIREFIGHTER):
+            buttons.append(InlineKeyboardButton(text="✏️", callback_data=f"kstart_edit_{entry.employee_id}"))
+        builder.row(*buttons)
+    included_count = sum(entry.included for entry in entries)
+    builder.row(
+        InlineKeyboardButton(text=f"✅ Заступить ({included_count})", callback_data="kstart_confirm"),
+        InlineKeyboardButton(text="❌ Отмена", callback_data="kstart_cancel")
+    )
+    return "\n".join(lines), builder.as_markup()
+
+async def _show_karakul_roster(message: types.Message, state: FSMContext, edit: bool):
+    data = await state.get_data()
+    text, markup = _karakul_roster_view(data['kstart_karakul'], roster_from_data(data['kstart_roster']))
+    if edit:
+        await message.edit_text(text, reply_markup=markup, parse_mode="HTML")
+    else:
+        await message.answer(text, reply_markup=markup, parse_mode="HTML")
+    await state.set_state(KarakulStartStates.REVIEWING_ROSTER)
+
+async def handle_karakul_start_request(message: types.Message, state: FSMContext, session_factory: async_sessionmaker):
+    """Кнопка "👥 Заступление караула" или /start_karakul: выбор караула."""
+    await state.clear()
+    commander = await _get_commander(session_factory, message.from_user.id)
+    if not commander:
+        await message.answer("Заступление караула оформляет только начальник караула.")
+        return
+    builder = InlineKeyboardBuilder()
+    for karakul_number in KARAKUL_NUMBERS:
+        builder.button(text=f"Караул №{karakul_number}", callback_data=f"kstart_karakul_{karakul_number}")
+    builder.button(text="❌ Отмена", callback_data="kstart_cancel")
+    builder.adjust(2)
+    await message.answer("Какой караул заступает?", reply_markup=builder.as_markup())
+    await state.update_data(kstart_commander_id=commander.id)
+    await state.set_state(KarakulStartStates.CHOOSING_KARAKUL)
+
+async def handle_karakul_start_callback(callback: types.CallbackQuery, state: FSMContext, session_factory: async_sessionmaker):
+    """Все кнопки заступления караула: выбор караула, отметки, правка назначений, подтверждение."""
+    action = callback.data.removeprefix("kstart_")
+    if action == "cancel":
+        await callback.answer("Отменено")
+        await callback.message.edit_text("Заступление караула отменено.", reply_markup=None)
+        await state.clear()
+        return
+
+    if action.startswith("karakul_"):
+        karakul_number = action.removeprefix("karakul_")
+        await callback.answer()
+        entries = await build_karakul_roster(session_factory, karakul_number)
+        if not entries:
+            await callback.message.edit_text(
+                f"По караулу №{karakul_number} нет прошлых смен (или все уже заступили). "
+                "Сотрудники заступают через свое меню.",
+                reply_markup=None
+            )
+            await state.clear()
+            return
+        await state.update_data(kstart_karakul=karakul_number, kstart_roster=roster_to_data(entries))
+        await _show_karakul_roster(callback.message, state, edit=True)
+        return
+
+    data = await state.get_data()
+    entries = roster_from_data(data.get('kstart_roster', []))
+    if not entries:
+        await callback.answer("Список устарел, начните заново.", show_alert=True)
+        await state.clear()
+        return
+    by_employee = {entry.employee_id: entry for entry in entries}
+
+    if action == "back":
+        await callback.answer()
+        await _show_karakul_roster(callback.message, state, edit=True)
+
+    elif action.startswith("toggle_"):
+        entry = by_employee.get(int(action.removeprefix("toggle_")))
+        if entry:
+            entry.included = not entry.included
+            await state.update_data(kstart_roster=roster_to_data(entries))
+        await callback.answer()
+        await _show_karakul_roster(callback.message, state, edit=True)
+
+    elif action.startswith("edit_"):
+        entry = by_employee.get(int(action.removeprefix("edit_")))
+        await callback.answer()
+        if entry is None:
+            return
+        back_button = InlineKeyboardButton(text="↩️ Назад к списку", callback_data="kstart_back")
+        if entry.role == ROLE_DRIVER:
+            async with session_factory() as session:
+                vehicles = await fetch_vehicle_readings(session, only_available=True)
+            builder = InlineKeyboardBuilder()
+            for vehicle in vehicles.values():
+                builder.button(text=vehicle.label, callback_data=f"kstart_vehicle_{entry.employee_id}_{vehicle.id}")
+            builder.adjust(1)
+            builder.row(back_button)
+            await callback.message.edit_text(
+                f"Автомобиль для {entry.full_name}:" if vehicles else "Нет доступных автомобилей.",
+                reply_markup=builder.as_markup()
+            )
+            await state.set_state(KarakulStartStates.CHOOSING_VEHICLE)
+        else:
+            await callback.message.edit_text(
+                f"Введите инвентарный номер СИЗОД для {entry.full_name} (сейчас: {entry.sizod_number or 'не указан'}):",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[[back_button]])
+            )
+            await state.update_data(kstart_editing_employee_id=entry.employee_id)
+            await state.set_state(KarakulStartStates.ENTERING_SIZOD)
+
+    elif action.startswith("vehicle_"):
+        employee_id, vehicle_id = (int(part) for part in action.removeprefix("vehicle_").split("_"))
+        entry = by_employee.get(employee_id)
+        async with session_factory() as session:
+            vehicle = (await fetch_vehicle_readings(session, [vehicle_id])).get(vehicle_id)
+        await callback.answer()
+        if entry and vehicle:
+            apply_vehicle(entry, vehicle)
+            await state.update_data(kstart_roster=roster_to_data(entries))
+        await _show_karakul_roster(callback.message, state, edit=True)
+
+    elif action == "confirm":
+        await callback.answer("Оформляю заступление...")
+        karakul_number = data['kstart_karakul']
+        try:
+            result = await start_karakul_shifts(session_factory, karakul_number, entries, data.get('kstart_commander_id'))
+        except Exception as e:
+            logging.exception(f"Ошибка заступления караула {karakul_number}: {e}")
+            await callback.message.edit_text("Произошла ошибка при заступлении караула. Попробуйте позже.", reply_markup=None)
+            await state.clear()
+            allow_callback_retry()
+            return
+        lines = [f"✅ Караул №{karakul_number}: заступили {len(result.started)}."]
+        lines += [f"- {entry.full_name}{_roster_entry_details(entry)}" for entry in result.started]
+        if result.skipped:
+            lines.append(f"\n⚠️ Не заступили ({len(result.skipped)}), нужно заступить через свое меню:")
+            lines += [f"- {entry.full_name}: {reason}" for entry, reason in result.skipped]
+        await callback.message.edit_text("\n".join(lines), reply_markup=None)
+        await state.clear()
+
+async def process_karakul_start_sizod_input(message: types.Message, state: FSMContext, session_factory: async_sessionmaker):
+    data = await state.get_data()
+    entries = roster_from_data(data.get('kstart_roster', []))
+    entry = next((item for item in entries if item.employee_id == data.get('kstart_editing_employee_id')), None)
+    if entry is None:
+        await message.answer("Список устарел, начните заново.")
+        await state.clear()
+        return
+    number = message.text.strip()
+    item = inventory_index.find_exact(number, 'СИЗОД') if inventory_index.loaded else None
+    if item:
+        number = item.inventory_number # Номер в том виде, как он записан в базе
+    elif inventory_index.loaded:
+        suggestions = [suggested.inventory_number for suggested in inventory_index.suggest(number, 'СИЗОД')]
+        hint = f" Похожие номера: {', '.join(suggestions)}." if suggestions else ""
+        await message.answer(f"СИЗОД с номером '{number}' не найден.{hint} Введите номер еще раз:")
+        return
+    async with session_factory() as session:
+        equipment = await get_equipment_state(session, inventory_number=number, equipment_type='СИЗОД')
+    entry.sizod_number = number
+    entry.warning = sizod_warning(entry, (equipment.status, equipment.current_holder_id) if equipment else None)
+    await state.update_data(kstart_roster=roster_to_data(entries), kstart_editing_employee_id=None)
+    await _show_karakul_roster(message, state, edit=False)
+
+
 # --- Регистрация обработчиков ---
 def register_commander_handlers(router: Router, bot: Bot): # <-- Принимаем bot
     """Регистрирует все обработчики для роли Начальник караула."""
@@ -694,6 +945,30 @@ def register_commander_handlers(router: Router, bot: Bot): # <-- Принима
         # Фильтр по роли НК
     )
     
+    # --- Заступление караула ---
+    async def karakul_start_request_entry_point(message: types.Message, state: FSMContext):
+        await handle_karakul_start_request(message, state, async_session)
+    router.message.register(karakul_start_request_entry_point, F.text == KARAKUL_START_BUTTON_TEXT)
+    router.message.register(karakul_start_request_entry_point, Command("start_karakul"))
+
+    async def karakul_start_callback_entry_point(callback: types.CallbackQuery, state: FSMContext):
+        await handle_karakul_start_callback(callback, state, async_session)
+    router.callback_query.register(karakul_start_callback_entry_point, F.data.startswith("kstart_"), StateFilter(KarakulStartStates), flags=CHAT_ORDERED)
+
+    async def karakul_start_sizod_entry_point(message: types.Message, state: FSMContext):
+        await process_karakul_start_sizod_input(message, state, async_session)
+    router.message.register(karakul_start_sizod_entry_point, KarakulStartStates.ENTERING_SIZOD, F.text)
+
+    # --- Закрытие караула ---
+    async def close_karakul_request_entry_point(message: types.Message):
+        await handle_close_karakul_request(message, async_session)
+    router.message.register(close_karakul_request_entry_point, F.text == CLOSE_KARAKUL_BUTTON_TEXT)
+    router.message.register(close_karakul_request_entry_point, Command("close_karakul"))
+
+    async def close_karakul_callback_entry_point(callback: types.CallbackQuery):
+        await handle_close_karakul_callback(callback, async_session)
+    router.callback_query.register(close_karakul_callback_entry_point, F.data.startswith("close_karakul_"))
+
     # --- Обслуживание снаряжения FSM ---
     async def start_equipment_maintenance_entry_point(message: types.Message, state: FSMContext):
         await start_equipment_maintenance(message, state, async_session)
@@ -0,0 +1,41 @@
+from typing import Any, Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+# --- Изменения структур в памяти после коммита ---
+# Индексы и реестры в памяти (брони, инвентарные номера, кэш имен) должны меняться только
+# после коммита транзакции, которая изменила БД: события маппера срабатывают при flush,
+# а транзакция потом еще может откатиться. Изменения копятся в session.info по ключу
+# потребителя и передаются его обработчику после коммита (в порядке добавления);
+# при откате - отбрасываются. Один общий обработчик событий Session на все ключи.
+
+_PENDING_KEY = 'commit_hooks'
+
+_appliers: dict[str, Callable[[list], None]] = {}
+
+
+def register_commit_applier(key: str, apply: Callable[[list], None]):
+    """apply(items) вызывается после коммита со всеми элементами, добавленными по ключу key."""
+    _appliers[key] = apply
+
+
+def on_commit(session: Session | AsyncSession, key: str, item: Any):
+    """Откладывает item до коммита текущей транзакции сессии (при откате он отбрасывается)."""
+    if isinstance(session, AsyncSession):
+        session = session.sync_session
+    session.info.setdefault(_PENDING_KEY, {}).setdefault(key, []).append(item)
+
+
+def _on_session_commit(session: Session):
+    for key, items in session.info.pop(_PENDING_KEY, {}).items():
+        _appliers[key](items)
+
+
+def _on_session_rollback(session: Session):
+    session.info.pop(_PENDING_KEY, None)
+
+
+event.listen(Session, 'after_commit', _on_session_commit)
+event.listen(Session, 'after_rollback', _on_session_rollback)
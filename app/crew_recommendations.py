@@ -0,0 +1,102 @@
+from dataclasses import dataclass, replace
+from typing import Callable
+
+from app.duty_registry import DutyShift, duty_shifts
+
+# --- Рекомендации экипажей для выезда (техника в первую очередь) ---
+# Водитель при заступлении указывает машину и оперативный ход (ShiftLog.operational_priority),
+# но пожарные к машине не привязаны. Экипаж машины складывается так: пожарные караула по
+# времени заступления распределяются по машинам этого караула в порядке хода, по
+# CREW_FIREFIGHTERS_PER_VEHICLE на машину (первый ход укомплектовывается первым).
+# Список строится из реестра заступивших (app/duty_registry.py) и пересчитывается только
+# после заступления или завершения смены (по версии реестра), а не на каждый выезд.
+# Занятость (брони, готовность) проверяется при показе: available_crews() получает проверки
+# от вызывающего кода, так что недоступные пожарные выпадают из экипажа без пересчета.
+
+CREW_FIREFIGHTERS_PER_VEHICLE = 4 # Отделение на автоцистерне: водитель и 4 пожарных (без командира отделения)
+
+
+@dataclass(frozen=True, slots=True)
+class VehicleCrew:
+    vehicle_id: int
+    vehicle_label: str
+    karakul_number: str
+    operational_priority: int | None
+    driver_id: int
+    firefighter_ids: tuple[int, ...]
+
+    @property
+    def employee_ids(self) -> tuple[int, ...]:
+        return (self.driver_id, *self.firefighter_ids)
+
+
+_crews: tuple[VehicleCrew, ...] = ()
+_crews_version: int | None = None
+
+
+def _priority_key(priority: int | None) -> tuple[bool, int]:
+    return (priority is None, priority or 0) # Машины без хода - после всех с ходом
+
+
+def build_crews(shifts: dict[int, DutyShift]) -> tuple[VehicleCrew, ...]:
+    """Экипажи всех машин на карауле, по оперативному ходу."""
+    drivers: dict[str, list[tuple[int, DutyShift]]] = {}
+    firefighters: dict[str, list[tuple[int, DutyShift]]] = {}
+    for employee_id, shift in shifts.items():
+        if shift.vehicle_id is not None:
+            drivers.setdefault(shift.karakul_number, []).append((employee_id, shift))
+        elif shift.sizod_number:
+            firefighters.setdefault(shift.karakul_number, []).append((employee_id, shift))
+
+    crews = []
+    for karakul_number, karakul_drivers in drivers.items():
+        karakul_drivers.sort(key=lambda item: (_priority_key(item[1].operational_priority), item[1].start_time, item[0]))
+        pool = [employee_id for employee_id, _shift in sorted(
+            firefighters.get(karakul_number, []), key=lambda item: (item[1].start_time, item[0])
+        )]
+        for index, (driver_id, shift) in enumerate(karakul_drivers):
+            crews.append(VehicleCrew(
+                vehicle_id=shift.vehicle_id,
+                vehicle_label=shift.vehicle_label or f"Машина №{shift.vehicle_id}",
+                karakul_number=karakul_number,
+                operational_priority=shift.operational_priority,
+                driver_id=driver_id,
+                firefighter_ids=tuple(pool[index * CREW_FIREFIGHTERS_PER_VEHICLE:(index + 1) * CREW_FIREFIGHTERS_PER_VEHICLE])
+            ))
+
+    crews.sort(key=lambda crew: (_priority_key(crew.operational_priority), crew.karakul_number, crew.vehicle_id))
+    # Одна машина у двух смен (пересменка) - рекомендуется один раз, с экипажем первой по порядку
+    seen_vehicles = set()
+    unique_crews = []
+    for crew in crews:
+        if crew.vehicle_id not in seen_vehicles:
+            seen_vehicles.add(crew.vehicle_id)
+            unique_crews.append(crew)
+    return tuple(unique_crews)
+
+
+def crews_by_priority() -> tuple[VehicleCrew, ...]:
+    """Экипажи из реестра заступивших; пересчет только после изменения реестра."""
+    global _crews, _crews_version
+    version, shifts = duty_shifts()
+    if version != _crews_version:
+        _crews = build_crews(shifts)
+        _crews_version = version
+    return _crews
+
+
+def available_crews(
+    employee_available: Callable[[int], bool],
+    vehicle_available: Callable[[int], bool],
+    limit: int | None = None
+) -> list[VehicleCrew]:
+    """Экипажи, которые можно назначить сейчас: машина и водитель свободны, занятые пожарные исключены."""
+    result = []
+    for crew in crews_by_priority():
+        if not vehicle_available(crew.vehicle_id) or not employee_available(crew.driver_id):
+            continue
+        firefighter_ids = tuple(employee_id for employee_id in crew.firefighter_ids if employee_available(employee_id))
+        result.append(crew if firefighter_ids == crew.firefighter_ids else replace(crew, firefighter_ids=firefighter_ids))
+        if limit is not None and len(result) >= limit:
+            break
+    return result
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+
+# --- Объединение частых правок клавиатуры в одну ---
+# При быстром выборе нескольких сотрудников подряд каждое нажатие меняет FSM сразу,
+# а правка клавиатуры откладывается на короткое окно: все нажатия внутри окна дают
+# одну итоговую edit_reply_markup. Если итоговая разметка не изменилась с прошлой
+# отправки, запрос в Telegram не делается.
+
+TOGGLE_DEBOUNCE_SECONDS = 0.6
+LAST_MARKUPS_MAX_SIZE = 1000 # Сколько последних отправленных разметок помнить (по сообщениям)
+
+
+class MarkupEditDebouncer:
+    """Откладывает и схлопывает правки inline-клавиатуры одного сообщения."""
+
+    def __init__(self, delay: float = TOGGLE_DEBOUNCE_SECONDS, last_markups_max_size: int = LAST_MARKUPS_MAX_SIZE):
+        self.delay = delay
+        self._pending: dict[tuple[int, int], asyncio.Task] = {}
+        self._renderers: dict[tuple[int, int], Callable[[], Awaitable]] = {}
+        self._last_sent: OrderedDict[tuple[int, int], str] = OrderedDict()
+        self._last_sent_max_size = last_markups_max_size
+        # Счетчики для оценки экономии запросов к Telegram API
+        self.requested = 0
+        self.sent = 0
+        self.skipped_unchanged = 0
+
+    @staticmethod
+    def _key(message: types.Message) -> tuple[int, int]:
+        return (message.chat.id, message.message_id)
+
+    def schedule(self, message: types.Message, render: Callable[[], Awaitable]):
+        """Запланировать правку: render() вызывается один раз в конце окна и строит актуальную разметку.
+
+        Если render() вернул None (например, пользователь уже перешел к следующему шагу), правки не будет.
+        """
+        key = self._key(message)
+        self.requested += 1
+        self._renderers[key] = render # Побеждает последний рендерер
+        if key not in self._pending:
+            self._pending[key] = asyncio.create_task(self._flush_later(key, message))
+
+    def remember(self, message: types.Message, markup):
+        """Запомнить разметку, уже отправленную в сообщение (чтобы не отправлять ее повторно)."""
+        self._store_last(self._key(message), markup.model_dump_json() if markup is not None else "")
+
+    def _store_last(self, key, dumped: str):
+        self._last_sent[key] = dumped
+        self._last_sent.move_to_end(key)
+        while len(self._last_sent) > self._last_sent_max_size:
+            self._last_sent.popitem(last=False)
+
+    async def _flush_later(self, key, message: types.Message):
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self._pending.pop(key, None)
+        render = self._renderers.pop(key, None)
+        if render is None:
+            return
+        try:
+            markup = await render()
+            if markup is None:
+                return
+            dumped = markup.model_dump_json()
+            if self._last_sent.get(key) == dumped:
+                self.skipped_unchanged += 1
+                return
+            await message.edit_reply_markup(reply_markup=markup)
+            self.sent += 1
+            self._store_last(key, dumped)
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.warning(f"Не удалось обновить клавиатуру сообщения {key}: {e}")
+        except Exception as e:
+            logging.exception(f"Ошибка отложенного обновления клавиатуры {key}: {e}")
+        logging.debug(
+            f"Debounce клавиатур: запрошено {self.requested}, отправлено {self.sent}, "
+            f"пропущено без изменений {self.skipped_unchanged}"
+        )
+
+
+# Общий экземпляр для выбора ЛС и техники при создании выезда
+selection_keyboard_debouncer = MarkupEditDebouncer()
@@ -0,0 +1,125 @@
+import logging
+import re
+
+from sqlalchemy import DateTime, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from app.archive import ARCHIVE_SCHEMA
+from app.read_models import DispatchListRow
+
+# --- Полнотекстовый поиск по выездам (SQLite FTS5) ---
+# Индекс dispatch_search хранит адрес, причину, примечания и сведения о пострадавших;
+# rowid индекса = id выезда. Индекс обновляется триггерами на dispatch_orders, а при
+# первом создании заполняется по всем выездам (включая archive.db). Строки, перенесенные
+# в архив, остаются в индексе. Найденные rowid ищутся по первичному ключу отдельно в
+# main.dispatch_orders и archive.dispatch_orders: соединение с временным представлением
+# dispatch_orders_all (UNION ALL) SQLite материализует целиком, то есть читает обе таблицы.
+# Токенизатор unicode61 сам приводит кириллицу к нижнему регистру, но не отождествляет
+# "ё" и "е" - поэтому "ё" заменяется на "е" и в индексе, и в запросе. Стемминга для
+# русского в SQLite нет: у слов запроса отбрасываются гласные окончания, а поиск идет
+# по префиксу ("пожара" -> пожар*, "подъезде" -> подъезд*).
+
+SEARCH_TABLE = 'dispatch_search'
+SEARCH_COLUMNS = ('address', 'reason', 'notes', 'details_on_casualties')
+SEARCH_COLUMN_WEIGHTS = (10.0, 5.0, 1.0, 1.0) # bm25: совпадение в адресе важнее, чем в примечаниях
+SEARCH_MAX_TERMS = 8
+SEARCH_MIN_STEM_LENGTH = 3 # Если основа короче, слово ищется целиком ("моя" не превращается в "м*")
+
+_WORD_RE = re.compile(r"\w+")
+_RUSSIAN_ENDING_RE = re.compile(r"[аеиоуыэюяйь]{1,2}$")
+
+
+def _fold_sql(expression: str) -> str:
+    return f"replace(replace(coalesce({expression}, ''), 'ё', 'е'), 'Ё', 'Е')"
+
+
+def _index_row_sql(prefix: str) -> str:
+    values = ", ".join(_fold_sql(f"{prefix}.{column}") for column in SEARCH_COLUMNS)
+    return f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(SEARCH_COLUMNS)}) VALUES ({prefix}.id, {values});"
+
+
+_SCHEMA_SQL = (
+    f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+    f"{', '.join(SEARCH_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+    # id без AUTOINCREMENT может повториться после удаления - старая запись индекса заменяется
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_ai AFTER INSERT ON dispatch_orders BEGIN "
+    f"DELETE FROM {SEARCH_TABLE} WHERE rowid = new.id; {_index_row_sql('new')} END",
+    f"CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_au AFTER UPDATE OF {', '.join(SEARCH_COLUMNS)} ON dispatch_orders BEGIN "
+    f"DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id; {_index_row_sql('new')} END",
+)
+
+_BACKFILL_SQL = (
+    f"INSERT INTO {SEARCH_TABLE}(rowid, {', '.join(SEARCH_COLUMNS)}) "
+    f"SELECT id, {', '.join(_fold_sql(column) for column in SEARCH_COLUMNS)} FROM dispatch_orders_all "
+    f"WHERE id NOT IN (SELECT rowid FROM {SEARCH_TABLE})"
+)
+
+_MATCH_ROWIDS_SQL = f"SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :query"
+_DISPATCH_TABLES = ('main.dispatch_orders', f'{ARCHIVE_SCHEMA}.dispatch_orders')
+_RESULT_COLUMNS = ('id', 'status', 'address', 'reason', 'creation_time', 'victims_count', 'fatalities_count')
+
+_COUNT_SQL = "SELECT " + " + ".join(
+    f"(SELECT count(*) FROM {table} WHERE id IN ({_MATCH_ROWIDS_SQL}))" for table in _DISPATCH_TABLES
+)
+
+
+def _page_sql(weights: str) -> str:
+    # Совпадения с рангом bm25 считаются один раз (MATERIALIZED), затем каждая таблица - по первичному ключу
+    columns = ", ".join(f"d.{column}" for column in _RESULT_COLUMNS)
+    arms = " UNION ALL ".join(
+        f"SELECT {columns}, hits.rank FROM hits JOIN {table} AS d ON d.id = hits.id" for table in _DISPATCH_TABLES
+    )
+    return (
+        f"WITH hits AS MATERIALIZED (SELECT rowid AS id, bm25({SEARCH_TABLE}, {weights}) AS rank "
+        f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :query) "
+        f"SELECT {', '.join(_RESULT_COLUMNS)} FROM ({arms}) ORDER BY rank, creation_time DESC "
+        "LIMIT :limit OFFSET :offset"
+    )
+
+
+def _create_search_index(sync_conn):
+    exists = sync_conn.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,)
+    ).first()
+    if exists:
+        return
+    for statement in _SCHEMA_SQL:
+        sync_conn.exec_driver_sql(statement)
+    indexed = sync_conn.exec_driver_sql(_BACKFILL_SQL).rowcount
+    sync_conn.exec_driver_sql(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('optimize')")
+    logging.info(f"Поиск по выездам: создан индекс FTS5, проиндексировано выездов {indexed}.")
+
+
+async def ensure_search_index(engine: AsyncEngine):
+    """Создает индекс FTS5 и триггеры, при первом запуске индексирует существующие выезды.
+
+    Вызывать после create_tables() и install_archive() (заполнение читает dispatch_orders_all).
+    """
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_search_index)
+
+
+def build_match_query(user_text: str) -> str | None:
+    """Строка запроса MATCH из текста пользователя: все слова обязательны, каждое - по префиксу."""
+    terms = []
+    for word in _WORD_RE.findall(user_text.lower().replace('ё', 'е'))[:SEARCH_MAX_TERMS]:
+        stem = _RUSSIAN_ENDING_RE.sub('', word)
+        if len(stem) < SEARCH_MIN_STEM_LENGTH:
+            stem = word
+        terms.append(f'"{stem}"*') # Кавычки: слова запроса не разбираются как операторы FTS5
+    return " ".join(terms) or None
+
+
+async def count_search_results(session: AsyncSession, match_query: str) -> int:
+    result = await session.execute(text(_COUNT_SQL), {'query': match_query})
+    return result.scalar_one()
+
+
+async def search_dispatches(session: AsyncSession, match_query: str, limit: int, offset: int) -> list[DispatchListRow]:
+    """Страница результатов поиска, лучшие совпадения первыми (bm25), при равенстве - новые выше."""
+    weights = ", ".join(str(weight) for weight in SEARCH_COLUMN_WEIGHTS)
+    result = await session.execute(
+        text(_page_sql(weights)).columns(creation_time=DateTime), # Дата из SQLite приходит строкой
+        {'query': match_query, 'limit': limit, 'offset': offset}
+    )
+    return [DispatchListRow(*row) for row in result.all()]
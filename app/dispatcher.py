@@ -2,11 +2,10 @@ import json
 from aiogram import F, types, Router
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.filters import StateFilter
+from aiogram.filters import Command, StateFilter
 from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
-from sqlalchemy.orm import selectinload
-from models import async_session, Employee, Vehicle, DispatchOrder, AbsenceLog
+from models import async_session, Employee, DispatchOrder, AbsenceLog
 from app.keyboards import ( # Добавляем новые клавиатуры
     confirm_cancel_dispatch_keyboard,
     get_dispatch_approval_keyboard,
@@ -19,16 +18,42 @@ from app.keyboards import ( # Добавляем новые клавиатуры
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder, InlineKeyboardButton
 from aiogram import Bot
+from app.query_budget import query_budget
+from app.name_loader import NameLoader, parse_id_list
+from app.read_models import fetch_dispatch_list_rows, fetch_dispatch_personnel_candidates, fetch_dispatch_vehicle_candidates
+from app.debounce import selection_keyboard_debouncer
+from app.outbox import enqueue_message as enqueue_outbox_message, wake_outbox_sender
+from app.archive import DispatchOrderAll
+from app.dispatch_search import build_match_query, count_search_results, search_dispatches
+from app.duplicate_calls import normalize_address, find_possible_duplicate
+from app.address_autocomplete import address_autocomplete
+from app.crew_recommendations import available_crews
+from app.chat_ordering import CHAT_ORDERED
+from app.reservations import (
+    RESOURCE_EMPLOYEE,
+    RESOURCE_VEHICLE,
+    is_available as is_reservation_available,
+    claim as claim_reservation,
+    claim_many as claim_reservations,
+    release as release_reservation,
+    release_owner as release_owner_reservations,
+    assign_to_dispatch as assign_reservations_to_dispatch,
+    release_dispatch as release_dispatch_reservations
+)
+from app.idempotency import allow_callback_retry
 from datetime import datetime
 import logging
 import math
+from functools import lru_cache
 
 # --- Константы ---
 DISPATCHES_PER_PAGE = 5 # Выездов на страницу
+RECOMMENDED_CREWS_SHOWN = 3 # Сколько экипажей (по оперативному ходу) предлагать при выборе ЛС
 
 # Статусы для списков
 ACTIVE_DISPATCH_STATUSES = ['pending_approval', 'approved', 'dispatched', 'in_progress']
 ARCHIVED_DISPATCH_STATUSES = ['completed', 'rejected', 'canceled']
+COMPLETABLE_DISPATCH_STATUSES = ('approved', 'dispatched', 'in_progress') # Утвержденные НК выезды
 
 # --- Словарь для перевода статусов ---
 STATUS_TRANSLATIONS = {
@@ -41,6 +66,19 @@ STATUS_TRANSLATIONS = {
     'canceled': 'Отменено'
 }
 
+DISPATCH_STATUS_EMOJI = {
+    'pending_approval': '⏳', 'approved': '✅', 'rejected': '❌',
+    'dispatched': '➡️', 'in_progress': '🔥', 'completed': '🏁',
+    'canceled': '🚫'
+}
+
+# Шаблон карточки выезда в списке (заполняется через str.format)
+DISPATCH_LIST_ITEM_TEMPLATE = (
+    "\n🆔 {id} | {status_emoji} {status_russian}\n"
+    "📍 {address}\n"
+    "📄 {reason} ({created}){casualties}"
+)
+
 # --- Состояния FSM для создания выезда ---
 # --- Обновляем состояния FSM ---
 class DispatchCreationStates(StatesGroup):
@@ -58,6 +96,9 @@ class DispatchEditStates(StatesGroup):
     ENTERING_GENERAL_NOTES = State()
     CONFIRM_DISPATCH_EDIT = State()     # Ожидание подтверждения изменений
 
+class DispatchSearchStates(StatesGroup):
+    ENTERING_QUERY = State()
+
 class AbsenceRegistrationStates(StatesGroup):
     WAITING_FOR_ABSENT_EMPLOYEE_FULLNAME = State()
     WAITING_FOR_ABSENT_EMPLOYEE_POSITION = State()
@@ -244,6 +285,7 @@ async def process_dispatch_field_save(callback: types.CallbackQuery, state: FSMC
             logging.exception(f"Ошибка при сохранении изменений для выезда {dispatch_id}: {e}")
             await callback.message.edit_text("Произошла ошибка при сохранении изменений.", reply_markup=None)
             await state.clear()
+            allow_callback_retry()
     
     elif callback.data.startswith("edit_dispatch_cancel_change_"): # Отмена изменения конкретного поля
         # Это обрабатывается функцией cancel_specific_field_edit, которую мы уже определили.
@@ -255,6 +297,7 @@ async def process_dispatch_field_save(callback: types.CallbackQuery, state: FSMC
         )
         await state.set_state(DispatchEditStates.CHOOSING_FIELD_TO_EDIT)
 
+@query_budget()
 async def show_full_dispatch_details(callback: types.CallbackQuery, session_factory: async_sessionmaker):
     await callback.answer()
     try:
@@ -265,15 +308,9 @@ async def show_full_dispatch_details(callback: types.CallbackQuery, session_fact
         return
 
     async with session_factory() as session:
-        dispatch = await session.get(
-            DispatchOrder, 
-            dispatch_id,
-            options=[ # Жадная загрузка связанных объектов Employee
-                selectinload(DispatchOrder.creator),
-                selectinload(DispatchOrder.approver),
-                selectinload(DispatchOrder.editor)
-            ]
-        )
+        dispatch = await session.get(DispatchOrder, dispatch_id)
+        if not dispatch: # Возможно, выезд уже в архиве
+            dispatch = await session.scalar(select(DispatchOrderAll).where(DispatchOrderAll.id == dispatch_id))
 
         if not dispatch:
             try:
@@ -282,6 +319,27 @@ async def show_full_dispatch_details(callback: types.CallbackQuery, session_fact
                 await callback.message.answer(f"❌ Выезд №{dispatch_id} не найден.")
             return
 
+        # Собираем все ID сотрудников и техники, нужные для сообщения, и загружаем их пакетно
+        personnel_ids_list, vehicle_ids_list = [], []
+        personnel_json_error = vehicle_json_error = False
+        try:
+            personnel_ids_list = parse_id_list(dispatch.assigned_personnel_ids)
+        except json.JSONDecodeError:
+            personnel_json_error = True
+        try:
+            vehicle_ids_list = parse_id_list(dispatch.assigned_vehicle_ids)
+        except json.JSONDecodeError:
+            vehicle_json_error = True
+
+        names = NameLoader()
+        names.want_employees([dispatch.dispatcher_id, dispatch.commander_id, dispatch.last_edited_by_dispatcher_id])
+        names.want_employees(personnel_ids_list)
+        names.want_vehicles(vehicle_ids_list)
+        await names.load(session)
+        creator = names.employee(dispatch.dispatcher_id)
+        approver = names.employee(dispatch.commander_id)
+        editor = names.employee(dispatch.last_edited_by_dispatcher_id)
+
         details = [
             f"<b>Детальная информация по выезду №{dispatch.id}</b>",
             f"<b>Статус:</b> {STATUS_TRANSLATIONS.get(dispatch.status, dispatch.status)}",
@@ -290,73 +348,31 @@ async def show_full_dispatch_details(callback: types.CallbackQuery, session_fact
             f"<b>Время создания:</b> {dispatch.creation_time.strftime('%d.%m.%Y %H:%M')}",
         ]
 
-        if dispatch.creator:
-            details.append(f"<b>Создал диспетчер:</b> {dispatch.creator.full_name}")
+        if creator:
+            details.append(f"<b>Создал диспетчер:</b> {creator.full_name}")
 
-        if dispatch.approver:
+        if approver:
             details.append(
-                f"<b>Решение НК ({dispatch.approver.full_name}):</b> "
+                f"<b>Решение НК ({approver.full_name}):</b> "
                 f"{STATUS_TRANSLATIONS.get(dispatch.status, dispatch.status).capitalize()} " # Используем текущий статус, который отражает решение
                 f"в {dispatch.approval_time.strftime('%H:%M %d.%m.%Y') if dispatch.approval_time else 'время не указано'}"
             )
         
         # Информация о назначенном ЛС
-        if dispatch.assigned_personnel_ids:
-            try:
-                personnel_ids_data = dispatch.assigned_personnel_ids
-                personnel_ids_list = []
-                # ИСПРАВЛЕНИЕ ЗДЕСЬ
-                if isinstance(personnel_ids_data, str):
-                    personnel_ids_list = json.loads(personnel_ids_data)
-                elif isinstance(personnel_ids_data, list):
-                    personnel_ids_list = personnel_ids_data
-                else:
-                    logging.warning(f"Неожиданный тип для assigned_personnel_ids в show_full_dispatch_details: {type(personnel_ids_data)} для выезда {dispatch.id}")
-
-                if personnel_ids_list:
-                    personnel_on_dispatch_result = await session.execute(
-                        select(Employee.full_name, Employee.position, Employee.rank)
-                        .where(Employee.id.in_(personnel_ids_list))
-                        .order_by(Employee.full_name)
-                    )
-                    personnel_str_list = "\n  - ".join(
-                        [f"{name} ({pos}, {rank or 'б/з'})" for name, pos, rank in personnel_on_dispatch_result.all()]
-                    )
-                    details.append(f"<b>Назначенный ЛС:</b>\n  - {personnel_str_list if personnel_str_list else 'список пуст'}")
-                else:
-                    details.append("<b>Назначенный ЛС:</b> не назначен")
-            except json.JSONDecodeError:
-                details.append("<b>Назначенный ЛС:</b> ошибка чтения данных (JSON)")
+        if personnel_json_error:
+            details.append("<b>Назначенный ЛС:</b> ошибка чтения данных (JSON)")
+        elif personnel_ids_list:
+            personnel_str_list = "\n  - ".join(emp.display() for emp in names.employees_by_name(personnel_ids_list))
+            details.append(f"<b>Назначенный ЛС:</b>\n  - {personnel_str_list if personnel_str_list else 'список пуст'}")
         else:
             details.append("<b>Назначенный ЛС:</b> не назначен")
 
         # Информация о назначенной технике
-        if dispatch.assigned_vehicle_ids:
-            try:
-                vehicle_ids_data = dispatch.assigned_vehicle_ids
-                vehicle_ids_list = []
-                # ИСПРАВЛЕНИЕ ЗДЕСЬ
-                if isinstance(vehicle_ids_data, str):
-                    vehicle_ids_list = json.loads(vehicle_ids_data)
-                elif isinstance(vehicle_ids_data, list):
-                    vehicle_ids_list = vehicle_ids_data
-                else:
-                    logging.warning(f"Неожиданный тип для assigned_vehicle_ids в show_full_dispatch_details: {type(vehicle_ids_data)} для выезда {dispatch.id}")
-                    
-                if vehicle_ids_list:
-                    vehicles_on_dispatch_result = await session.execute(
-                        select(Vehicle.model, Vehicle.number_plate)
-                        .where(Vehicle.id.in_(vehicle_ids_list))
-                        .order_by(Vehicle.model)
-                    )
-                    vehicle_str_list = "\n  - ".join(
-                        [f"{model} ({plate})" for model, plate in vehicles_on_dispatch_result.all()]
-                    )
-                    details.append(f"<b>Назначенная техника:</b>\n  - {vehicle_str_list if vehicle_str_list else 'список пуст'}")
-                else:
-                    details.append("<b>Назначенная техника:</b> не назначена")
-            except json.JSONDecodeError:
-                details.append("<b>Назначенная техника:</b> ошибка чтения данных (JSON)")
+        if vehicle_json_error:
+            details.append("<b>Назначенная техника:</b> ошибка чтения данных (JSON)")
+        elif vehicle_ids_list:
+            vehicle_str_list = "\n  - ".join(vhc.display() for vhc in names.vehicles_by_model(vehicle_ids_list))
+            details.append(f"<b>Назначенная техника:</b>\n  - {vehicle_str_list if vehicle_str_list else 'список пуст'}")
         else:
             details.append("<b>Назначенная техника:</b> не назначена")
             
@@ -381,9 +397,9 @@ async def show_full_dispatch_details(callback: types.CallbackQuery, session_fact
         if dispatch.status == 'completed' and dispatch.completion_time:
             details.append(f"<b>Время завершения:</b> {dispatch.completion_time.strftime('%d.%m.%Y %H:%M')}")
         
-        if dispatch.editor and dispatch.last_edited_at:
+        if editor and dispatch.last_edited_at:
             details.append(
-                f"<i>Последнее изменение: {dispatch.editor.full_name} "
+                f"<i>Последнее изменение: {editor.full_name} "
                 f"в {dispatch.last_edited_at.strftime('%H:%M %d.%m.%Y')}</i>" # Добавил год
             )
         
@@ -407,6 +423,9 @@ async def show_full_dispatch_details(callback: types.CallbackQuery, session_fact
                 text="✏️ Редактировать выезд", 
                 callback_data=f"dispatch_edit_start_{dispatch.id}"
             )
+        if _can_complete_dispatch(current_user_employee, dispatch):
+            edit_markup_builder.button(text="🏁 Завершить выезд", callback_data=f"dispatch_complete_{dispatch.id}")
+        edit_markup_builder.adjust(1)
         
         final_markup = edit_markup_builder.as_markup()
         
@@ -416,6 +435,34 @@ async def show_full_dispatch_details(callback: types.CallbackQuery, session_fact
             logging.error(f"Не удалось отредактировать сообщение для деталей выезда {dispatch_id}: {e}")
             await callback.message.answer(response_text, parse_mode="HTML", reply_markup=final_markup)
             
+def _can_complete_dispatch(employee: Employee | None, dispatch) -> bool:
+    """Завершить утвержденный выезд может создавший его диспетчер или НК."""
+    if employee is None or dispatch.status not in COMPLETABLE_DISPATCH_STATUSES:
+        return False
+    return employee.id == dispatch.dispatcher_id or (employee.position or "").lower() == "начальник караула"
+
+async def handle_dispatch_complete(callback: types.CallbackQuery, session_factory: async_sessionmaker):
+    """Кнопка "🏁 Завершить выезд": статус 'completed' и освобождение ЛС и техники выезда."""
+    try:
+        dispatch_id = int(callback.data.split("_")[-1])
+    except (IndexError, ValueError):
+        logging.error(f"Ошибка извлечения dispatch_id из callback_data для завершения: {callback.data}")
+        await callback.answer()
+        return
+    async with session_factory() as session:
+        async with session.begin():
+            employee = await session.scalar(select(Employee).where(Employee.telegram_id == callback.from_user.id))
+            dispatch = await session.get(DispatchOrder, dispatch_id)
+            if dispatch is None or not _can_complete_dispatch(employee, dispatch):
+                await callback.answer("Этот выезд нельзя завершить (уже завершен или нет прав).", show_alert=True)
+                return
+            dispatch.status = 'completed'
+            dispatch.completion_time = datetime.now()
+    await release_dispatch_reservations(session_factory, dispatch_id) # ЛС и техника снова доступны для выездов
+    logging.info(f"Выезд {dispatch_id} завершен сотрудником {employee.id}.")
+    await callback.answer(f"Выезд №{dispatch_id} завершен")
+    await callback.message.edit_text(f"🏁 Выезд №{dispatch_id} завершен. Личный состав и техника освобождены.", reply_markup=None)
+
 # --- Обработчики для отметки отсутствующих ---
 async def handle_mark_absent_request(message: types.Message, state: FSMContext, session_factory: async_sessionmaker): # Принимаем session_factory
     await state.clear() # Очищаем предыдущее состояние FSM
@@ -457,6 +504,29 @@ async def handle_mark_absent_request(message: types.Message, state: FSMContext,
     )
     await state.set_state(AbsenceRegistrationStates.WAITING_FOR_ABSENT_EMPLOYEE_FULLNAME)
 
+@lru_cache(maxsize=256)
+def _dispatch_details_button(dispatch_id: int) -> InlineKeyboardButton:
+    return InlineKeyboardButton(text=f"🔍 Детали выезда №{dispatch_id}", callback_data=f"dispatch_full_details_{dispatch_id}")
+
+def _format_dispatch_list_item(order) -> str:
+    """Карточка выезда в списке (DispatchListRow)."""
+    casualties_info = [] # Собираем информацию о пострадавших/погибших
+    if order.victims_count is not None and order.victims_count > 0:
+        casualties_info.append(f"Пострадавших: {order.victims_count}")
+    if order.fatalities_count is not None and order.fatalities_count > 0:
+        casualties_info.append(f"Погибших: {order.fatalities_count}")
+
+    return DISPATCH_LIST_ITEM_TEMPLATE.format(
+        id=order.id,
+        status_emoji=DISPATCH_STATUS_EMOJI.get(order.status, '❓'),
+        status_russian=STATUS_TRANSLATIONS.get(order.status, order.status),
+        address=order.address,
+        reason=order.reason,
+        created=order.creation_time.strftime('%d.%m %H:%M'),
+        casualties=f" ({', '.join(casualties_info)})" if casualties_info else ""
+    )
+
+@query_budget()
 async def _generate_dispatch_list_page(session: AsyncSession, page: int, list_type: str):
     """Генерирует текст и клавиатуру для страницы списка выездов."""
 
@@ -470,10 +540,12 @@ async def _generate_dispatch_list_page(session: AsyncSession, page: int, list_ty
         return "Неизвестный тип списка.", None
 
     offset = (page - 1) * DISPATCHES_PER_PAGE
+    include_archive = list_type == 'archived' # Завершенные выезды могут быть уже перенесены в archive.db
+    source = DispatchOrderAll if include_archive else DispatchOrder
 
     total_items_result = await session.execute(
-        select(func.count(DispatchOrder.id))
-        .where(DispatchOrder.status.in_(statuses_to_select))
+        select(func.count(source.id))
+        .where(source.status.in_(statuses_to_select))
     )
     total_items = total_items_result.scalar_one_or_none() or 0
 
@@ -484,50 +556,17 @@ async def _generate_dispatch_list_page(session: AsyncSession, page: int, list_ty
     total_pages = math.ceil(total_items / DISPATCHES_PER_PAGE)
     page = max(1, min(page, total_pages)) # Корректируем номер страницы
 
-    dispatch_orders_result = await session.execute(
-        select(DispatchOrder)
-        .where(DispatchOrder.status.in_(statuses_to_select))
-        .order_by(DispatchOrder.creation_time.desc())
-        .limit(DISPATCHES_PER_PAGE)
-        .offset(offset)
-    )
-    dispatch_orders = dispatch_orders_result.scalars().all()
+    # Только нужные для списка колонки, без загрузки полных ORM-объектов
+    dispatch_orders = await fetch_dispatch_list_rows(session, statuses_to_select, DISPATCHES_PER_PAGE, offset, include_archive)
 
     response_lines = [f"{title} (Страница {page}/{total_pages}):"]
     builder = InlineKeyboardBuilder() # Инициализируем билдер клавиатуры здесь
 
     for order in dispatch_orders:
-        status_emoji = {
-            'pending_approval': '⏳', 'approved': '✅', 'rejected': '❌',
-            'dispatched': '➡️', 'in_progress': '🔥', 'completed': '🏁',
-            'canceled': '🚫'
-        }.get(order.status, '❓')
-        
-        status_russian = STATUS_TRANSLATIONS.get(order.status, order.status)
-        
-        casualties_info = [] # Собираем информацию о пострадавших/погибших
-        if order.victims_count is not None and order.victims_count > 0:
-            casualties_info.append(f"Пострадавших: {order.victims_count}")
-        if order.fatalities_count is not None and order.fatalities_count > 0:
-            casualties_info.append(f"Погибших: {order.fatalities_count}")
-        
-        casualties_str = ""
-        if casualties_info:
-            casualties_str = f" ({', '.join(casualties_info)})"
-
-        # Формируем текст для одного выезда
-        dispatch_text = (
-            f"\n🆔 {order.id} | {status_emoji} {status_russian}\n"
-            f"📍 {order.address}\n"
-            f"📄 {order.reason} ({order.creation_time.strftime('%d.%m %H:%M')}){casualties_str}" # <--- ДОБАВИЛИ ИНФО
-        )
-        response_lines.append(dispatch_text)
+        response_lines.append(_format_dispatch_list_item(order))
         
         # Добавляем инлайн-кнопку "Детали" для каждого выезда
-        builder.row(InlineKeyboardButton(
-            text=f"🔍 Детали выезда №{order.id}", 
-            callback_data=f"dispatch_full_details_{order.id}" # Новый callback_data
-        ))
+        builder.row(_dispatch_details_button(order.id))
 
     response_text = "\n".join(response_lines)
 
@@ -553,6 +592,7 @@ async def cancel_dispatch_creation(callback: types.CallbackQuery, state: FSMCont
     current_state = await state.get_state()
     logging.info(f"Диспетчер {callback.from_user.id} отменил создание выезда из состояния {current_state}")
     await state.clear()
+    await release_owner_reservations(async_session, callback.from_user.id)
     try: # Пытаемся отредактировать сообщение
         await callback.message.edit_text("Создание нового выезда отменено.", reply_markup=None)
     except Exception as e: # Если не вышло (старое сообщение)
@@ -564,8 +604,9 @@ async def cancel_dispatch_creation(callback: types.CallbackQuery, state: FSMCont
 
 async def handle_new_dispatch_request(message: types.Message, state: FSMContext):
     await state.clear()
+    await release_owner_reservations(async_session, message.from_user.id) # Брони от незавершенного прошлого выезда
     # Отправляем с кнопкой отмены
-    await message.answer("Введите адрес выезда:", reply_markup=get_cancel_keyboard())
+    await message.answer("Введите адрес выезда (или начало названия улицы - бот предложит адреса прошлых выездов):", reply_markup=get_cancel_keyboard())
     await state.set_state(DispatchCreationStates.ENTERING_ADDRESS)
     logging.info(f"Диспетчер {message.from_user.id} начал создание выезда...")
 
@@ -576,13 +617,79 @@ async def process_address(message: types.Message, state: FSMContext):
         return
     # -- Более сложная проверка адреса (пример, можно расширить) --
     if len(address) < 10: # Условно, адрес короче 10 символов - подозрительно
+        # Начало адреса: предлагаем ранее использованные адреса
+        suggestions = address_autocomplete.suggest(address)
+        if suggestions:
+            await state.update_data(address_suggestions=suggestions)
+            await message.answer(
+                "Выберите адрес из ранее использованных или введите полный адрес:",
+                reply_markup=_address_suggestions_keyboard(suggestions)
+            )
+            return
         await message.answer("Пожалуйста, введите более полный адрес:", reply_markup=get_cancel_keyboard())
         return
     # -- Конец проверки адреса --
-    await state.update_data(address=address)
+    await _accept_dispatch_address(message, state, address)
+
+async def handle_address_suggestion(callback: types.CallbackQuery, state: FSMContext):
+    """Выбор адреса из подсказок (dispatch_address_pick_{номер подсказки})."""
+    suggestions = (await state.get_data()).get('address_suggestions') or []
+    try:
+        address = suggestions[int(callback.data.split("_")[-1])]
+    except (ValueError, IndexError):
+        await callback.answer("Подсказка устарела. Введите адрес.", show_alert=True)
+        return
+    await callback.answer()
+    await state.update_data(address_suggestions=None)
+    await callback.message.edit_text(f"📍 Адрес: {address}", reply_markup=None)
+    await _accept_dispatch_address(callback.message, state, address, callback.from_user.id)
+
+def _address_suggestions_keyboard(suggestions: list[str]) -> types.InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    for index, address in enumerate(suggestions):
+        builder.row(InlineKeyboardButton(text=f"📍 {address}", callback_data=f"dispatch_address_pick_{index}"))
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="universal_cancel"))
+    return builder.as_markup()
+
+async def _accept_dispatch_address(message: types.Message, state: FSMContext, address: str, user_id: int | None = None):
+    user_id = user_id or message.from_user.id
+    address_normalized = normalize_address(address)
+    await state.update_data(address=address, address_normalized=address_normalized)
+    async with async_session() as session:
+        duplicate = await find_possible_duplicate(session, address_normalized)
+    if duplicate:
+        logging.info(f"Диспетчер {user_id}: адрес '{address}' совпадает с активным выездом №{duplicate.id}")
+        await message.answer(_possible_duplicate_text(duplicate) + "\nЕсли это тот же вызов, отмените создание выезда.")
     await message.answer("Введите причину вызова:", reply_markup=get_cancel_keyboard())
     await state.set_state(DispatchCreationStates.ENTERING_REASON)
-    logging.info(f"Диспетчер {message.from_user.id}, адрес: '{address}'...")
+    logging.info(f"Диспетчер {user_id}, адрес: '{address}'...")
+
+def _possible_duplicate_text(duplicate) -> str:
+    return (
+        f"⚠️ Возможный дубль выезда №{duplicate.id}: {duplicate.address} — {duplicate.reason} "
+        f"({STATUS_TRANSLATIONS.get(duplicate.status, duplicate.status)}, создан {duplicate.creation_time.strftime('%H:%M')})."
+    )
+
+def _available_for(candidates, resource_type: str, owner_telegram_id: int) -> list:
+    """Кандидаты, не занятые другими диспетчерами и выездами (проверка по броням в памяти)."""
+    return [item for item in candidates if is_reservation_available(resource_type, item.id, owner_telegram_id)]
+
+def _recommended_crews(personnel_candidates, owner_telegram_id: int) -> list:
+    """Экипажи машин на карауле по ходу: только готовые (есть среди кандидатов) и не занятые сотрудники."""
+    candidate_ids = {item.id for item in personnel_candidates}
+    return available_crews(
+        lambda employee_id: employee_id in candidate_ids and is_reservation_available(RESOURCE_EMPLOYEE, employee_id, owner_telegram_id),
+        lambda vehicle_id: is_reservation_available(RESOURCE_VEHICLE, vehicle_id, owner_telegram_id),
+        limit=RECOMMENDED_CREWS_SHOWN
+    )
+
+def _personnel_keyboard(data: dict, owner_telegram_id: int):
+    candidates = data.get('personnel_candidates', [])
+    return get_personnel_select_keyboard(
+        _available_for(candidates, RESOURCE_EMPLOYEE, owner_telegram_id),
+        data.get('selected_personnel_ids', set()),
+        _recommended_crews(candidates, owner_telegram_id)
+    )
 
 # --- Изменяем process_reason ---
 async def process_reason(message: types.Message, state: FSMContext):
@@ -594,65 +701,105 @@ async def process_reason(message: types.Message, state: FSMContext):
     logging.info(f"Диспетчер {message.from_user.id}, причина: '{reason}'...")
 
     # --- Переходим к выбору ЛС ---
+    # Кандидатов читаем один раз и храним в FSM; при нажатиях занятость проверяется по броням в памяти
     async with async_session() as session:
-        # Ищем доступных и ГОТОВЫХ пожарных/водителей (пример)
-        # TODO: Уточнить, кого именно можно выбирать
-        available_personnel = await session.scalars(
-            select(Employee).where(
-                Employee.position.in_(['Пожарный', 'Водитель']), # Пример выбора
-                Employee.is_ready == True # Только готовых
-            ).order_by(Employee.full_name)
-        )
-        personnel_list = available_personnel.all()
+        personnel_candidates = await fetch_dispatch_personnel_candidates(session)
+    await state.update_data(personnel_candidates=personnel_candidates)
+    personnel_list = _available_for(personnel_candidates, RESOURCE_EMPLOYEE, message.from_user.id)
 
     if not personnel_list:
         await message.answer("Нет доступного и готового личного состава для назначения. Создание выезда отменено.")
         await state.clear()
         return
 
-    keyboard = get_personnel_select_keyboard(personnel_list, set())
-    await message.answer(
-        "Выберите личный состав (нажмите на имя для выбора/отмены):",
+    keyboard = get_personnel_select_keyboard(personnel_list, set(), _recommended_crews(personnel_candidates, message.from_user.id))
+    selection_message = await message.answer(
+        "Выберите личный состав (нажмите на имя для выбора/отмены) или экипаж машины на карауле (🚒):",
         reply_markup=keyboard
     )
+    selection_keyboard_debouncer.remember(selection_message, keyboard)
     await state.set_state(DispatchCreationStates.SELECTING_PERSONNEL)
     logging.info(f"Состояние: SELECTING_PERSONNEL")
 
 async def handle_personnel_toggle(callback: types.CallbackQuery, state: FSMContext):
-    """Обрабатывает выбор/отмену выбора сотрудника."""
-    await callback.answer()
+    """Обрабатывает выбор/отмену выбора сотрудника (с бронированием)."""
     try:
         personnel_id = int(callback.data.split('_')[-1])
+    except (ValueError, IndexError) as e:
+        logging.error(f"Ошибка обработки выбора ЛС: {e}, data: {callback.data}")
+        await callback.answer()
+        return
+    try:
+        owner_id = callback.from_user.id
         data = await state.get_data()
         selected_ids = data.get('selected_personnel_ids', set())
 
-        # Переключаем ID в сете
+        # Переключаем ID в сете: выбор - бронь, снятие выбора - освобождение
         if personnel_id in selected_ids:
             selected_ids.remove(personnel_id)
-        else:
+            await release_reservation(async_session, RESOURCE_EMPLOYEE, personnel_id, owner_id)
+            await callback.answer()
+        elif await claim_reservation(async_session, RESOURCE_EMPLOYEE, personnel_id, owner_id):
             selected_ids.add(personnel_id)
+            await callback.answer()
+        else:
+            await callback.answer("Этот сотрудник уже выбран другим диспетчером или назначен на выезд.", show_alert=True)
 
         await state.update_data(selected_personnel_ids=selected_ids)
 
-        # Обновляем клавиатуру
-        async with async_session() as session:
-            available_personnel = await session.scalars(
-                select(Employee).where(
-                    Employee.position.in_(['Пожарный', 'Водитель']),
-                    Employee.is_ready == True
-                ).order_by(Employee.full_name)
-            )
-            personnel_list = available_personnel.all()
-
-        keyboard = get_personnel_select_keyboard(personnel_list, selected_ids)
-        # Редактируем сообщение с обновленной клавиатурой
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
+        # Клавиатуру обновляем отложенно: серия быстрых нажатий дает одну правку сообщения
+        async def render_personnel_keyboard():
+            if await state.get_state() != DispatchCreationStates.SELECTING_PERSONNEL.state:
+                return None # Уже перешли к выбору техники/отменили - клавиатура не нужна
+            return _personnel_keyboard(await state.get_data(), owner_id)
+        selection_keyboard_debouncer.schedule(callback.message, render_personnel_keyboard)
 
-    except (ValueError, IndexError) as e:
-        logging.error(f"Ошибка обработки выбора ЛС: {e}, data: {callback.data}")
     except Exception as e:
         logging.exception(f"Ошибка в handle_personnel_toggle: {e}")
 
+async def handle_crew_recommendation(callback: types.CallbackQuery, state: FSMContext):
+    """Кнопка рекомендованного экипажа: машина, водитель и пожарные одним нажатием, затем сводка."""
+    try:
+        vehicle_id = int(callback.data.split('_')[-1])
+    except (ValueError, IndexError) as e:
+        logging.error(f"Ошибка обработки выбора экипажа: {e}, data: {callback.data}")
+        await callback.answer()
+        return
+    owner_id = callback.from_user.id
+    data = await state.get_data()
+    crew = next((item for item in _recommended_crews(data.get('personnel_candidates', []), owner_id) if item.vehicle_id == vehicle_id), None)
+    if crew is None:
+        await callback.answer("Этот экипаж уже назначен на выезд или снят с караула.", show_alert=True)
+        await callback.message.edit_reply_markup(reply_markup=_personnel_keyboard(data, owner_id))
+        return
+
+    selected_personnel_ids = data.get('selected_personnel_ids', set())
+    selected_vehicle_ids = data.get('selected_vehicle_ids', set())
+    vehicle_key = (RESOURCE_VEHICLE, crew.vehicle_id)
+    driver_key = (RESOURCE_EMPLOYEE, crew.driver_id)
+    held = await claim_reservations(
+        async_session, [vehicle_key, *((RESOURCE_EMPLOYEE, employee_id) for employee_id in crew.employee_ids)], owner_id
+    )
+    if vehicle_key not in held or driver_key not in held:
+        # Машину или водителя перехватил другой диспетчер - снимаем только что взятые брони
+        for resource_type, resource_id in held:
+            selected = selected_vehicle_ids if resource_type == RESOURCE_VEHICLE else selected_personnel_ids
+            if resource_id not in selected:
+                await release_reservation(async_session, resource_type, resource_id, owner_id)
+        await callback.answer("Машину или водителя только что выбрал другой диспетчер.", show_alert=True)
+        await callback.message.edit_reply_markup(reply_markup=_personnel_keyboard(await state.get_data(), owner_id))
+        return
+
+    selected_personnel_ids |= {resource_id for resource_type, resource_id in held if resource_type == RESOURCE_EMPLOYEE}
+    selected_vehicle_ids |= {crew.vehicle_id}
+    await state.update_data(selected_personnel_ids=selected_personnel_ids, selected_vehicle_ids=selected_vehicle_ids)
+    await callback.answer(f"Назначен экипаж: {crew.vehicle_label}")
+    logging.info(
+        f"Диспетчер {owner_id} назначил экипаж машины {crew.vehicle_id} (ход {crew.operational_priority}, "
+        f"караул {crew.karakul_number}): ЛС {sorted(selected_personnel_ids)}"
+    )
+    await show_confirmation_summary(callback, state)
+
 # --- Обработчик кнопки "К выбору техники" ---
 async def handle_personnel_done(callback: types.CallbackQuery, state: FSMContext):
     """Переход к выбору техники."""
@@ -669,10 +816,9 @@ async def handle_personnel_done(callback: types.CallbackQuery, state: FSMContext
 
     # --- Переходим к выбору техники ---
     async with async_session() as session:
-        available_vehicles = await session.scalars(
-            select(Vehicle).where(Vehicle.status == 'available').order_by(Vehicle.model)
-        )
-        vehicle_list = available_vehicles.all()
+        vehicle_candidates = await fetch_dispatch_vehicle_candidates(session)
+    await state.update_data(vehicle_candidates=vehicle_candidates)
+    vehicle_list = _available_for(vehicle_candidates, RESOURCE_VEHICLE, callback.from_user.id)
 
     if not vehicle_list:
         # Если нет техники, сразу переходим к подтверждению (ЛС уже выбран)
@@ -686,41 +832,50 @@ async def handle_personnel_done(callback: types.CallbackQuery, state: FSMContext
         "Выберите технику (нажмите для выбора/отмены):",
         reply_markup=keyboard
     )
+    selection_keyboard_debouncer.remember(callback.message, keyboard)
     await state.set_state(DispatchCreationStates.SELECTING_VEHICLES)
     logging.info(f"Состояние: SELECTING_VEHICLES")
 
 
 # --- Новый обработчик выбора Техники ---
 async def handle_vehicle_toggle(callback: types.CallbackQuery, state: FSMContext):
-    """Обрабатывает выбор/отмену выбора техники."""
-    await callback.answer()
+    """Обрабатывает выбор/отмену выбора техники (с бронированием)."""
     try:
         vehicle_id = int(callback.data.split('_')[-1])
+    except (ValueError, IndexError) as e:
+        logging.error(f"Ошибка обработки выбора техники: {e}, data: {callback.data}")
+        await callback.answer()
+        return
+    try:
+        owner_id = callback.from_user.id
         data = await state.get_data()
         selected_ids = data.get('selected_vehicle_ids', set())
 
         if vehicle_id in selected_ids:
             selected_ids.remove(vehicle_id)
-        else:
+            await release_reservation(async_session, RESOURCE_VEHICLE, vehicle_id, owner_id)
+            await callback.answer()
+        elif await claim_reservation(async_session, RESOURCE_VEHICLE, vehicle_id, owner_id):
             selected_ids.add(vehicle_id)
+            await callback.answer()
+        else:
+            await callback.answer("Эта техника уже выбрана другим диспетчером или назначена на выезд.", show_alert=True)
 
         await state.update_data(selected_vehicle_ids=selected_ids)
 
-        async with async_session() as session:
-            available_vehicles = await session.scalars(
-                select(Vehicle).where(Vehicle.status == 'available').order_by(Vehicle.model)
-            )
-            vehicle_list = available_vehicles.all()
-
-        keyboard = get_vehicle_select_keyboard(vehicle_list, selected_ids)
-        await callback.message.edit_reply_markup(reply_markup=keyboard)
+        async def render_vehicle_keyboard():
+            if await state.get_state() != DispatchCreationStates.SELECTING_VEHICLES.state:
+                return None
+            current = await state.get_data()
+            vehicle_list = _available_for(current.get('vehicle_candidates', []), RESOURCE_VEHICLE, owner_id)
+            return get_vehicle_select_keyboard(vehicle_list, current.get('selected_vehicle_ids', set()))
+        selection_keyboard_debouncer.schedule(callback.message, render_vehicle_keyboard)
 
-    except (ValueError, IndexError) as e:
-        logging.error(f"Ошибка обработки выбора техники: {e}, data: {callback.data}")
     except Exception as e:
         logging.exception(f"Ошибка в handle_vehicle_toggle: {e}")
 
 # --- Вспомогательная функция для показа сводки ---
+@query_budget()
 async def show_confirmation_summary(message_or_callback: types.Message | types.CallbackQuery, state: FSMContext):
     """Формирует и показывает сводку перед подтверждением."""
     data = await state.get_data()
@@ -730,24 +885,28 @@ async def show_confirmation_summary(message_or_callback: types.Message | types.C
     personnel_names = ["Не выбран"]
     vehicle_names = ["Не выбрана"]
 
+    names = NameLoader()
+    names.want_employees(selected_personnel_ids)
+    names.want_vehicles(selected_vehicle_ids)
     async with async_session() as session:
-        if selected_personnel_ids:
-            pers_result = await session.scalars(
-                select(Employee.full_name).where(Employee.id.in_(selected_personnel_ids)).order_by(Employee.full_name)
-            )
-            personnel_names = pers_result.all() or ["Не найдены"]
-        if selected_vehicle_ids:
-            veh_result = await session.scalars(
-                select(Vehicle.number_plate).where(Vehicle.id.in_(selected_vehicle_ids)).order_by(Vehicle.number_plate)
-            )
-            vehicle_names = veh_result.all() or ["Не найдены"]
-
+        await names.load(session)
+        # Повторная проверка: другой диспетчер мог создать выезд на этот адрес, пока выбирали ЛС и технику
+        duplicate = await find_possible_duplicate(session, data.get('address_normalized') or normalize_address(data['address']))
+    if selected_personnel_ids:
+        personnel_names = [emp.full_name for emp in names.employees_by_name(selected_personnel_ids)] or ["Не найдены"]
+    if selected_vehicle_ids:
+        vehicle_names = sorted(
+            (vhc.number_plate or "" for vhc in names.vehicles_by_model(selected_vehicle_ids))
+        ) or ["Не найдены"]
+
+    duplicate_warning = f"{_possible_duplicate_text(duplicate)}\n\n" if duplicate else ""
     confirmation_text = (
         "🚨 **Новый выезд (проверьте данные):**\n\n"
         f"**Адрес:** {data['address']}\n"
         f"**Причина:** {data['reason']}\n"
         f"**Личный состав:** {', '.join(personnel_names)}\n"
         f"**Техника:** {', '.join(vehicle_names)}\n\n"
+        f"{duplicate_warning}"
         "Отправить на утверждение начальнику караула?"
     )
 
@@ -833,6 +992,7 @@ async def process_dispatch_confirmation(callback: types.CallbackQuery, state: FS
         selected_vehicle_ids = list(data.get('selected_vehicle_ids', []))
         # --- Конец получения ID ---
 
+        dispatch_id = None
         try:
             async with async_session() as session:
                 # --- Получаем ПОЛНЫЙ объект диспетчера ---
@@ -857,67 +1017,67 @@ async def process_dispatch_confirmation(callback: types.CallbackQuery, state: FS
                 new_dispatch = DispatchOrder(
                     dispatcher_id=dispatcher_id,
                     address=data['address'],
+                    address_normalized=data.get('address_normalized') or normalize_address(data['address']),
                     reason=data['reason'],
                     assigned_personnel_ids=json.dumps(selected_personnel_ids), # Сохраняем ID
                     assigned_vehicle_ids=json.dumps(selected_vehicle_ids),     # Сохраняем ID
                     status='pending_approval'
                 )
                 session.add(new_dispatch)
-                # Важно: коммитим ЗДЕСЬ, чтобы получить new_dispatch.id для отправки
-                await session.commit()
+                await session.flush() # Получаем new_dispatch.id для брони
                 dispatch_id = new_dispatch.id
-                logging.info(f"Выезд ID {dispatch_id} сохранен в БД со статусом 'pending_approval'.")
 
-                # --- Отправка уведомления Начальнику Караула ---
-                try:
-                    # --- ИЗМЕНЕНИЕ ЗДЕСЬ ---
-                    # Ищем точное совпадение с названием на кнопке, но регистронезависимо все равно
-                    search_position_term = "Начальник караула"
-                    logging.info(f"Ищем НК с должностью '{search_position_term}' (через ilike)")
-                    commander_result = await session.execute(
-                        select(Employee)
-                        # Используем ilike на случай, если в будущем появятся вариации,
-                        # но ищем теперь строку с большой буквы
-                        .where(Employee.position.ilike(search_position_term))
-                        .limit(1)
+                # Брони выбранных ЛС и техники становятся бронями выезда в той же транзакции
+                lost_resources = await assign_reservations_to_dispatch(session, user_id, dispatch_id, {
+                    RESOURCE_EMPLOYEE: selected_personnel_ids,
+                    RESOURCE_VEHICLE: selected_vehicle_ids
+                })
+                if lost_resources:
+                    await session.rollback()
+                    logging.warning(f"Диспетчер {user_id}: ресурсы уже заняты, выезд не создан: {lost_resources}")
+                    await release_owner_reservations(async_session, user_id)
+                    await callback.message.edit_text(
+                        "❌ Часть выбранного ЛС или техники уже назначена на другой выезд "
+                        "(или бронь истекла и ее занял другой диспетчер). Создайте выезд заново.",
+                        reply_markup=None
                     )
-                    # --- КОНЕЦ ИЗМЕНЕНИЯ ---
-                    commander = commander_result.scalar_one_or_none()
-
-                    if commander and commander.telegram_id:
-                        commander_telegram_id = commander.telegram_id
-                        logging.info(f"Найден НК: {commander.full_name} (Telegram ID: {commander_telegram_id})")
-
-                        # Формируем текст уведомления для НК
-                        nk_notification_text = (
-                            f"❗️ Поступил новый выезд №{dispatch_id} на утверждение:\n\n"
-                            f"**Адрес:** {new_dispatch.address}\n"
-                            f"**Причина:** {new_dispatch.reason}\n"
-                            # Можно добавить ЛС и Технику при желании
-                            f"**(Создан диспетчером:** {dispatcher.full_name})" # Добавим, кто создал
-                        )
-                        # Генерируем клавиатуру для НК
-                        nk_keyboard = get_dispatch_approval_keyboard(dispatch_id)
-
-                        # Отправляем сообщение НК с помощью объекта bot
-                        await bot.send_message(
-                            chat_id=commander_telegram_id,
-                            text=nk_notification_text,
-                            reply_markup=nk_keyboard,
-                            parse_mode="Markdown"
-                        )
-                        logging.info(f"Уведомление о выезде ID {dispatch_id} отправлено НК {commander_telegram_id}")
-                        dispatcher_confirm_text = f"✅ Выезд №{dispatch_id} создан и отправлен на утверждение НК ({commander.full_name})."
+                    await state.clear()
+                    return
 
-                    else:
-                        logging.warning(f"Не найден НК для отправки уведомления о выезде ID {dispatch_id}.")
-                        dispatcher_confirm_text = f"✅ Выезд №{dispatch_id} создан, но не удалось найти НК для отправки уведомления."
+                # --- Уведомление Начальнику Караула (через outbox, в той же транзакции) ---
+                search_position_term = "Начальник караула"
+                logging.info(f"Ищем НК с должностью '{search_position_term}' (через ilike)")
+                commander_result = await session.execute(
+                    select(Employee)
+                    # Используем ilike на случай, если в будущем появятся вариации
+                    .where(Employee.position.ilike(search_position_term))
+                    .limit(1)
+                )
+                commander = commander_result.scalar_one_or_none()
+
+                if commander and commander.telegram_id:
+                    logging.info(f"Найден НК: {commander.full_name} (Telegram ID: {commander.telegram_id})")
+                    nk_notification_text = (
+                        f"❗️ Поступил новый выезд №{dispatch_id} на утверждение:\n\n"
+                        f"**Адрес:** {new_dispatch.address}\n"
+                        f"**Причина:** {new_dispatch.reason}\n"
+                        # Можно добавить ЛС и Технику при желании
+                        f"**(Создан диспетчером:** {dispatcher.full_name})" # Добавим, кто создал
+                    )
+                    enqueue_outbox_message(
+                        session, commander.telegram_id, nk_notification_text,
+                        parse_mode="Markdown", reply_markup=get_dispatch_approval_keyboard(dispatch_id)
+                    )
+                    dispatcher_confirm_text = f"✅ Выезд №{dispatch_id} создан и отправлен на утверждение НК ({commander.full_name})."
+                else:
+                    logging.warning(f"Не найден НК для отправки уведомления о выезде ID {dispatch_id}.")
+                    dispatcher_confirm_text = f"✅ Выезд №{dispatch_id} создан, но не удалось найти НК для отправки уведомления."
 
-                except Exception as notify_err:
-                    logging.exception(f"Ошибка при отправке уведомления НК о выезде ID {dispatch_id}: {notify_err}")
-                    dispatcher_confirm_text = f"✅ Выезд №{dispatch_id} создан, но произошла ошибка при отправке уведомления НК."
-                
-                # --- Конец уведомления ---
+                # Выезд и уведомление НК фиксируются вместе
+                await session.commit()
+                wake_outbox_sender()
+                address_autocomplete.add(new_dispatch.address)
+                logging.info(f"Выезд ID {dispatch_id} сохранен в БД со статусом 'pending_approval'.")
 
                 # Сообщаем диспетчеру результат
                 await callback.message.edit_text(dispatcher_confirm_text, reply_markup=None)
@@ -925,11 +1085,13 @@ async def process_dispatch_confirmation(callback: types.CallbackQuery, state: FS
         except Exception as e:
             logging.exception(f"Ошибка сохранения выезда в БД: {e}")
             await callback.message.edit_text("❌ Произошла ошибка при сохранении выезда.")
+            allow_callback_retry()
 
         await state.clear() # Очищаем состояние в любом случае
 
     elif callback.data == "dispatch_cancel":
         logging.info(f"Диспетчер {user_id} отменил создание выезда.")
+        await release_owner_reservations(async_session, user_id)
         await callback.message.edit_text("❌ Создание выезда отменено.", reply_markup=None)
         await state.clear()
 
@@ -1030,6 +1192,7 @@ async def process_absence_confirmation(callback: types.CallbackQuery, state: FSM
         except Exception as e:
             logging.exception(f"Ошибка сохранения записи об отсутствующем: {e}")
             await callback.message.edit_text("❌ Произошла ошибка при сохранении записи.", reply_markup=None)
+            allow_callback_retry()
         finally:
             await state.clear()
 
@@ -1086,6 +1249,82 @@ async def handle_dispatch_list_pagination(callback: types.CallbackQuery):
         logging.exception(f"Непредвиденная ошибка при пагинации списка выездов: {e}")
         await callback.answer("Произошла ошибка.", show_alert=True)
 
+# --- Поиск выездов (полнотекстовый, FTS5) ---
+
+@query_budget()
+async def _generate_dispatch_search_page(session: AsyncSession, search_text: str, page: int):
+    """Текст и клавиатура страницы результатов поиска по адресу, причине и примечаниям."""
+    match_query = build_match_query(search_text)
+    if match_query is None:
+        return "Введите хотя бы одно слово для поиска.", None
+
+    total_items = await count_search_results(session, match_query)
+    if total_items == 0:
+        return f"🔎 По запросу «{search_text}» выездов не найдено.", None
+
+    total_pages = math.ceil(total_items / DISPATCHES_PER_PAGE)
+    page = max(1, min(page, total_pages))
+    dispatch_orders = await search_dispatches(session, match_query, DISPATCHES_PER_PAGE, (page - 1) * DISPATCHES_PER_PAGE)
+
+    response_lines = [f"🔎 Поиск «{search_text}»: найдено {total_items} (Страница {page}/{total_pages}):"]
+    builder = InlineKeyboardBuilder()
+    for order in dispatch_orders:
+        response_lines.append(_format_dispatch_list_item(order))
+        builder.row(_dispatch_details_button(order.id))
+
+    pagination_buttons = []
+    if page > 1:
+        pagination_buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"dispatch_search_page_{page-1}"))
+    if page < total_pages:
+        pagination_buttons.append(InlineKeyboardButton(text="➡️ Вперед", callback_data=f"dispatch_search_page_{page+1}"))
+    if pagination_buttons:
+        builder.row(*pagination_buttons)
+
+    return "\n".join(response_lines), builder.as_markup()
+
+async def _answer_dispatch_search(message: types.Message, state: FSMContext, session_factory: async_sessionmaker, search_text: str):
+    # Запрос остается в данных FSM для кнопок пагинации (в callback_data он может не поместиться)
+    await state.set_state(None)
+    await state.update_data(dispatch_search_text=search_text)
+    async with session_factory() as session:
+        text, reply_markup = await _generate_dispatch_search_page(session, search_text, page=1)
+    await message.answer(text, reply_markup=reply_markup)
+
+async def handle_dispatch_search_request(message: types.Message, state: FSMContext, session_factory: async_sessionmaker):
+    """Кнопка "🔎 Поиск выездов" или команда /search [текст]."""
+    search_text = message.text.partition(" ")[2].strip() if message.text.startswith("/") else ""
+    if search_text:
+        await _answer_dispatch_search(message, state, session_factory, search_text)
+        return
+    await state.set_state(DispatchSearchStates.ENTERING_QUERY)
+    await message.answer(
+        "Введите слова для поиска по адресу, причине или примечаниям (например: Ленина пожар):",
+        reply_markup=get_cancel_keyboard()
+    )
+
+async def process_dispatch_search_query(message: types.Message, state: FSMContext, session_factory: async_sessionmaker):
+    search_text = (message.text or "").strip()
+    if not search_text:
+        await message.answer("Введите текст для поиска.")
+        return
+    await _answer_dispatch_search(message, state, session_factory, search_text)
+
+async def handle_dispatch_search_pagination(callback: types.CallbackQuery, state: FSMContext, session_factory: async_sessionmaker):
+    try:
+        page = int(callback.data.split("_")[-1]) # dispatch_search_page_{page}
+    except ValueError:
+        logging.error(f"Ошибка обработки пагинации поиска выездов: {callback.data}")
+        await callback.answer("Ошибка при переключении страницы.", show_alert=True)
+        return
+    search_text = (await state.get_data()).get("dispatch_search_text")
+    if not search_text:
+        await callback.answer("Результаты поиска устарели. Повторите поиск.", show_alert=True)
+        return
+    async with session_factory() as session:
+        text, reply_markup = await _generate_dispatch_search_page(session, search_text, page=page)
+    await callback.message.edit_text(text, reply_markup=reply_markup)
+    await callback.answer()
+
 async def start_dispatch_edit(callback: types.CallbackQuery, state: FSMContext, session_factory: async_sessionmaker): # Добавил session_factory
     await callback.answer()
     try:
@@ -1220,6 +1459,21 @@ def register_dispatcher_handlers(router: Router):
         show_archived_dispatches,
         F.text == "📂 Архив выездов"
     )
+
+    # --- Поиск выездов ---
+    async def dispatch_search_request_entry_point(message: types.Message, state: FSMContext):
+        await handle_dispatch_search_request(message, state, async_session)
+    router.message.register(dispatch_search_request_entry_point, F.text == "🔎 Поиск выездов")
+    router.message.register(dispatch_search_request_entry_point, Command("search"))
+
+    async def dispatch_search_query_entry_point(message: types.Message, state: FSMContext):
+        await process_dispatch_search_query(message, state, async_session)
+    router.message.register(dispatch_search_query_entry_point, DispatchSearchStates.ENTERING_QUERY)
+
+    async def dispatch_search_pagination_entry_point(callback: types.CallbackQuery, state: FSMContext):
+        await handle_dispatch_search_pagination(callback, state, async_session)
+    router.callback_query.register(dispatch_search_pagination_entry_point, F.data.startswith("dispatch_search_page_"))
+
     async def full_dispatch_details_entry_point(callback: types.CallbackQuery, state: FSMContext): # state здесь может не понадобиться
         await show_full_dispatch_details(callback, async_session) # async_session - ваш session_factory
     
@@ -1228,6 +1482,10 @@ def register_dispatcher_handlers(router: Router):
         F.data.startswith("dispatch_full_details_")
     )
 
+    async def dispatch_complete_entry_point(callback: types.CallbackQuery):
+        await handle_dispatch_complete(callback, async_session)
+    router.callback_query.register(dispatch_complete_entry_point, F.data.startswith("dispatch_complete_"))
+
     # Хэндлер для ввода кол-ва погибших
     async def process_fatalities_input_entry_point(message: types.Message, state: FSMContext):
         await process_fatalities_count_input(message, state, async_session) # async_session здесь не используется, но для единообразия
@@ -1261,13 +1519,15 @@ def register_dispatcher_handlers(router: Router):
     
     # Обработчики состояний FSM
     router.message.register(process_address, DispatchCreationStates.ENTERING_ADDRESS)
+    router.callback_query.register(handle_address_suggestion, DispatchCreationStates.ENTERING_ADDRESS, F.data.startswith("dispatch_address_pick_"))
     router.message.register(process_reason, DispatchCreationStates.ENTERING_REASON)
 
-    # Новые обработчики выбора
-    router.callback_query.register(handle_personnel_toggle, DispatchCreationStates.SELECTING_PERSONNEL, F.data.startswith("dispatch_toggle_personnel_"))
-    router.callback_query.register(handle_personnel_done, DispatchCreationStates.SELECTING_PERSONNEL, F.data == "dispatch_personnel_done")
-    router.callback_query.register(handle_vehicle_toggle, DispatchCreationStates.SELECTING_VEHICLES, F.data.startswith("dispatch_toggle_vehicle_"))
-    router.callback_query.register(handle_vehicles_done, DispatchCreationStates.SELECTING_VEHICLES, F.data == "dispatch_vehicles_done")
+    # Новые обработчики выбора (быстрые нажатия меняют одни и те же данные FSM - по очереди внутри чата)
+    router.callback_query.register(handle_personnel_toggle, DispatchCreationStates.SELECTING_PERSONNEL, F.data.startswith("dispatch_toggle_personnel_"), flags=CHAT_ORDERED)
+    router.callback_query.register(handle_personnel_done, DispatchCreationStates.SELECTING_PERSONNEL, F.data == "dispatch_personnel_done", flags=CHAT_ORDERED)
+    router.callback_query.register(handle_crew_recommendation, DispatchCreationStates.SELECTING_PERSONNEL, F.data.startswith("dispatch_crew_"), flags=CHAT_ORDERED)
+    router.callback_query.register(handle_vehicle_toggle, DispatchCreationStates.SELECTING_VEHICLES, F.data.startswith("dispatch_toggle_vehicle_"), flags=CHAT_ORDERED)
+    router.callback_query.register(handle_vehicles_done, DispatchCreationStates.SELECTING_VEHICLES, F.data == "dispatch_vehicles_done", flags=CHAT_ORDERED)
 
     # Хэндлер для выбора поля для редактирования И для отмены всего редактирования из этого же меню
     router.callback_query.register(
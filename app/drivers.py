@@ -3,16 +3,33 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy import select, func
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from datetime import datetime, timedelta
 from models import async_session, Vehicle, TripSheet, Employee
 # Убираем get_vehicles_keyboard из импорта:
 from app.keyboards import confirm_cancel_keyboard
+from app.query_budget import query_budget
+from app.read_models import fetch_vehicle_rows
+from app.archive import TripSheetAll # Путевые листы из основной базы и archive.db
+from app.idempotency import allow_callback_retry
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 import logging
 import math # Оставляем, если пагинация используется
 
 TRIPS_PER_PAGE = 5 # Оставляем, если пагинация используется
 
+# Иконки статуса автомобиля для кнопок выбора и подписи для карточки состояния
+VEHICLE_STATUS_ICONS = {
+    'available': '✅', 'in_use': '🅿️',
+    'maintenance': '🛠️', 'repair': '⚠️'
+}
+VEHICLE_STATUS_LABELS = {
+    'available': '✅ Доступен',
+    'in_use': '🅿️ В рейсе',
+    'maintenance': '🛠 На обслуживании',
+    'repair': '⚠️ В ремонте'
+}
+
 class CheckStatusStates(StatesGroup):
     CHOOSING_VEHICLE = State()
 
@@ -26,13 +43,14 @@ class TripSheetStates(StatesGroup):
 # Убрали ShiftStates/ShiftManagementStates
 
 # --- Пагинация истории поездок (если она была) ---
+@query_budget()
 async def _generate_trip_history_page(session: AsyncSession, user_id: int, page: int = 1):
     offset = (page - 1) * TRIPS_PER_PAGE
     # Считаем общее количество поездок
     total_trips_result = await session.execute(
-        select(func.count(TripSheet.id))
+        select(func.count(TripSheetAll.id))
         # Используем driver_id
-        .where(TripSheet.driver_id == user_id)
+        .where(TripSheetAll.driver_id == user_id)
     )
     total_trips = total_trips_result.scalar_one_or_none() or 0
 
@@ -44,10 +62,11 @@ async def _generate_trip_history_page(session: AsyncSession, user_id: int, page:
 
     # Получаем поездки для страницы
     trips_result = await session.execute(
-        select(TripSheet)
+        select(TripSheetAll)
+        .options(selectinload(TripSheetAll.vehicle)) # Автомобили страницы одним запросом, а не по одному на поездку
         # Используем driver_id
-        .where(TripSheet.driver_id == user_id)
-        .order_by(TripSheet.date.desc())
+        .where(TripSheetAll.driver_id == user_id)
+        .order_by(TripSheetAll.date.desc())
         .limit(TRIPS_PER_PAGE)
         .offset(offset)
     )
@@ -55,8 +74,8 @@ async def _generate_trip_history_page(session: AsyncSession, user_id: int, page:
 
     response_text = [f"📅 Ваша история поездок (Страница {page}/{total_pages}):"]
     for trip in trips_on_page:
-        # Связь vehicle осталась в TripSheet
-        vehicle = await session.get(Vehicle, trip.vehicle_id)
+        # Связь vehicle осталась в TripSheet (уже загружена через selectinload)
+        vehicle = trip.vehicle
         vehicle_info = f"{vehicle.number_plate} ({vehicle.model})" if vehicle else f"Автомобиль не найден (ID: {trip.vehicle_id})"
         response_text.append(
             f"\n🗓 {trip.date.strftime('%d.%m.%Y %H:%M')} | 🚗 {vehicle_info}\n"
@@ -267,6 +286,7 @@ async def save_trip_sheet(callback: types.CallbackQuery, state: FSMContext):
             logging.exception(f"Ошибка сохранения путевого листа: {e}")
             await callback.message.edit_text("🚫 Произошла ошибка при сохранении.")
             await state.clear()
+            allow_callback_retry()
 
 
     elif callback.data == "cancel":
@@ -318,15 +338,15 @@ async def show_fuel_stats(message: types.Message):
         async with async_session() as session:
             # Используем user_id или employee_db_id
             avg_fuel_result = await session.execute(
-                select(func.avg(TripSheet.fuel_consumption / TripSheet.mileage * 100)) # Расход л/100км
-                .where(TripSheet.driver_id == user_id)
-                .where(TripSheet.mileage > 0) # Избегаем деления на ноль
+                select(func.avg(TripSheetAll.fuel_consumption / TripSheetAll.mileage * 100)) # Расход л/100км
+                .where(TripSheetAll.driver_id == user_id)
+                .where(TripSheetAll.mileage > 0) # Избегаем деления на ноль
             )
             avg_fuel = round(avg_fuel_result.scalar() or 0, 1)
 
             total_mileage_result = await session.execute(
-                select(func.sum(TripSheet.mileage))
-                .where(TripSheet.driver_id == user_id)
+                select(func.sum(TripSheetAll.mileage))
+                .where(TripSheetAll.driver_id == user_id)
             )
             total_mileage = round(total_mileage_result.scalar() or 0, 1)
 
@@ -348,8 +368,8 @@ async def get_trip_count(driver_identifier: int) -> int:
     try:
         async with async_session() as session:
             result = await session.execute(
-                select(func.count(TripSheet.id))
-                .where(TripSheet.driver_id == driver_identifier)
+                select(func.count(TripSheetAll.id))
+                .where(TripSheetAll.driver_id == driver_identifier)
             )
             return result.scalar_one_or_none() or 0
     except Exception as e:
@@ -364,9 +384,8 @@ async def check_vehicle_status(message: types.Message, state: FSMContext):
 
     try:
         async with async_session() as session:
-            # Получаем ВСЕ автомобили из базы данных
-            result = await session.execute(select(Vehicle))
-            vehicles = result.scalars().all()
+            # Получаем ВСЕ автомобили из базы данных (только поля для кнопок)
+            vehicles = await fetch_vehicle_rows(session)
 
             if not vehicles:
                 await message.answer("🚫 В базе данных нет автомобилей.")
@@ -376,10 +395,7 @@ async def check_vehicle_status(message: types.Message, state: FSMContext):
             builder = InlineKeyboardBuilder()
             for vehicle in vehicles:
                 # Можно добавить текущий статус прямо в кнопку для информативности
-                status_icon = {
-                    'available': '✅', 'in_use': '🅿️',
-                    'maintenance': '🛠️', 'repair': '⚠️'
-                }.get(vehicle.status, '❓')
+                status_icon = VEHICLE_STATUS_ICONS.get(vehicle.status, '❓')
                 builder.button(
                     # Текст кнопки: Иконка Модель (Номер)
                     text=f"{status_icon} {vehicle.model} ({vehicle.number_plate})",
@@ -418,12 +434,7 @@ async def process_vehicle_status_selection(callback: types.CallbackQuery, state:
                 return
 
             # Формируем сообщение о статусе (как в старой версии check_vehicle_status)
-            status_msg = {
-                'available': '✅ Доступен',
-                'in_use': '🅿️ В рейсе',
-                'maintenance': '🛠 На обслуживании',
-                'repair': '⚠️ В ремонте'
-            }.get(vehicle.status, f'❓ Неизвестный статус ({vehicle.status})')
+            status_msg = VEHICLE_STATUS_LABELS.get(vehicle.status) or f'❓ Неизвестный статус ({vehicle.status})'
 
             status_text = (
                 f"Техническое состояние:\n"
@@ -0,0 +1,174 @@
+import logging
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from models import DispatchOrder
+
+# --- Повторные вызовы на один адрес ---
+# Об одном пожаре часто сообщают несколько человек, и диспетчеры создают несколько выездов.
+# У выезда хранится нормализованный адрес (address_normalized), по нему построен индекс
+# (address_normalized, creation_time). Перед созданием нового выезда активный выезд
+# с тем же адресом за последние DUPLICATE_CALL_WINDOW ищется одним точечным запросом по индексу.
+# Нормализация: нижний регистр, "ё" -> "е", единые сокращения типов улиц ("проспект",
+# "пр-т" -> "пр"), без "д."/"дом", квартиры и подъезда, литера дома слитно с номером
+# ("12 А" -> "12а"), корпус и строение отдельно от номера ("д5к2", "5 корп. 2" -> "5 к2"),
+# без города. "ул." отбрасывается: его чаще всего просто не пишут.
+
+DUPLICATE_CALL_WINDOW = timedelta(hours=2)
+DUPLICATE_CHECK_STATUSES = ('pending_approval', 'approved', 'dispatched', 'in_progress') # Активные выезды
+
+# Тип улицы -> каноническое сокращение (None - слово не входит в ключ)
+STREET_TYPE_ABBREVIATIONS = {
+    'улица': None, 'ул': None,
+    'проспект': 'пр', 'просп': 'пр', 'пр-т': 'пр', 'пр-кт': 'пр', 'пр': 'пр',
+    'переулок': 'пер', 'пер': 'пер',
+    'площадь': 'пл', 'пл': 'пл',
+    'шоссе': 'ш', 'ш': 'ш',
+    'бульвар': 'б-р', 'бул': 'б-р', 'б-р': 'б-р',
+    'набережная': 'наб', 'наб': 'наб',
+    'проезд': 'пр-д', 'пр-д': 'пр-д',
+    'тупик': 'туп', 'туп': 'туп',
+    'микрорайон': 'мкр', 'мкрн': 'мкр', 'мкр': 'мкр',
+}
+HOUSE_WORDS = {'дом', 'д'}
+BUILDING_PREFIXES = {'корпус': 'к', 'корп': 'к', 'к': 'к', 'строение': 'с', 'стр': 'с', 'с': 'с'}
+CITY_WORDS = {'город', 'г'} # Вместе со следующим словом: адрес в пределах своего гарнизона
+# Часть адреса внутри здания: слово и следующий за ним номер в ключ не входят
+INSIDE_BUILDING_WORDS = {'кв', 'квартира', 'офис', 'оф', 'подъезд', 'под', 'этаж', 'эт', 'комната', 'ком'}
+
+_TOKEN_RE = re.compile(r"[a-zа-я0-9]+(?:-[a-zа-я0-9]+)*")
+_NUMBER_RE = re.compile(r"\d+[a-zа-я]?")
+# Номер, слитый с "д" и/или с корпусом/строением: "д5", "5к2", "д12ас1", "корп2"
+_GLUED_HOUSE_RE = re.compile(r"д?(\d+[а-я]?)")
+_GLUED_BUILDING_RE = re.compile(r"(д?\d+[а-я]?)?(корп|стр|к|с)(\d+)")
+
+
+def _split_glued_number(token: str) -> list[str]:
+    """Разбивает слитный номер на части, как если бы их написали через пробел: "д5к2" -> ["5", "к", "2"]."""
+    match = _GLUED_BUILDING_RE.fullmatch(token)
+    if match:
+        house, prefix, number = match.groups()
+        return [*(_split_glued_number(house) if house else []), prefix, number]
+    match = _GLUED_HOUSE_RE.fullmatch(token)
+    if match:
+        return [match.group(1)]
+    return [token]
+
+
+def _is_house_letter(tokens: list[str], index: int) -> bool:
+    letter = tokens[index]
+    if len(letter) != 1 or not letter.isalpha():
+        return False
+    is_building_prefix = letter in BUILDING_PREFIXES and index + 1 < len(tokens) and tokens[index + 1][0].isdigit()
+    return not is_building_prefix
+
+
+def _address_parts(address: str) -> tuple[list[str], list[str], list[str]]:
+    """Слова названия, типы улиц и части номера дома."""
+    tokens = [
+        part
+        for token in _TOKEN_RE.findall(address.lower().replace('ё', 'е'))
+        for part in _split_glued_number(token)
+    ]
+    words, street_types, house_parts = [], [], []
+    pending_prefix = ''
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        index += 1
+        if token in INSIDE_BUILDING_WORDS:
+            if index < len(tokens) and tokens[index][0].isdigit():
+                index += 1
+            continue
+        if token in CITY_WORDS:
+            index += 1
+            continue
+        if token in STREET_TYPE_ABBREVIATIONS:
+            if STREET_TYPE_ABBREVIATIONS[token]:
+                street_types.append(STREET_TYPE_ABBREVIATIONS[token])
+            continue
+        if token in HOUSE_WORDS:
+            continue
+        if token in BUILDING_PREFIXES and index < len(tokens) and tokens[index][0].isdigit():
+            pending_prefix = BUILDING_PREFIXES[token]
+            continue
+        if _NUMBER_RE.fullmatch(token):
+            # Литера отдельным словом: "12 а" -> "12а" (но "5 к 2" - корпус)
+            if index < len(tokens) and token.isdigit() and _is_house_letter(tokens, index):
+                token += tokens[index]
+                index += 1
+            house_parts.append(pending_prefix + token)
+            pending_prefix = ''
+            continue
+        words.append(token)
+    return words, sorted(street_types), house_parts
+
+
+def normalize_address(address: str) -> str:
+    """Ключ адреса для поиска повторных вызовов: "Проспект Мира, дом 7 А" -> "мира пр 7а"."""
+    words, street_types, house_parts = _address_parts(address)
+    return " ".join([*words, *street_types, *house_parts])
+
+
+def address_prefix_key(address: str) -> str:
+    """Ключ для поиска по началу адреса: без типа улицы ("пр. Мира, 7" -> "мира 7"), как его набирают."""
+    words, _street_types, house_parts = _address_parts(address)
+    return " ".join([*words, *house_parts])
+
+
+@dataclass(frozen=True, slots=True)
+class PossibleDuplicate:
+    id: int
+    address: str
+    reason: str
+    status: str
+    creation_time: datetime
+
+
+async def find_possible_duplicate(session: AsyncSession, address_normalized: str, now: datetime | None = None) -> PossibleDuplicate | None:
+    """Последний активный выезд с тем же нормализованным адресом за DUPLICATE_CALL_WINDOW (или None)."""
+    if not address_normalized:
+        return None
+    since = (now or datetime.now()) - DUPLICATE_CALL_WINDOW
+    result = await session.execute(
+        select(
+            DispatchOrder.id, DispatchOrder.address, DispatchOrder.reason,
+            DispatchOrder.status, DispatchOrder.creation_time
+        )
+        .where(
+            DispatchOrder.address_normalized == address_normalized,
+            DispatchOrder.creation_time >= since,
+            DispatchOrder.status.in_(DUPLICATE_CHECK_STATUSES)
+        )
+        .order_by(DispatchOrder.creation_time.desc())
+        .limit(1)
+    )
+    row = result.first()
+    return PossibleDuplicate(*row) if row else None
+
+
+async def backfill_normalized_addresses(session_factory: async_sessionmaker):
+    """Пересчитывает address_normalized у активных выездов (новая колонка или новые правила нормализации)."""
+    async with session_factory() as session:
+        async with session.begin():
+            rows = (await session.execute(
+                select(DispatchOrder.id, DispatchOrder.address, DispatchOrder.address_normalized)
+                .where(DispatchOrder.status.in_(DUPLICATE_CHECK_STATUSES))
+            )).all()
+            changed = 0
+            for dispatch_id, address, address_normalized in rows:
+                key = normalize_address(address)
+                if key == address_normalized:
+                    continue
+                await session.execute(
+                    update(DispatchOrder)
+                    .where(DispatchOrder.id == dispatch_id)
+                    .values(address_normalized=key)
+                )
+                changed += 1
+    if changed:
+        logging.info(f"Повторные вызовы: нормализованы адреса {changed} активных выездов.")
@@ -0,0 +1,96 @@
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from models import ShiftLog, Vehicle
+
+# --- Реестр заступивших на караул (в памяти) ---
+# employee_id -> активная смена (караул, время начала; у водителя - машина и оперативный ход,
+# у пожарного - номер СИЗОД).
+# Заполняется при старте бота из активных записей ShiftLog и обновляется финализаторами
+# заступления/завершения караула, поэтому меню и рекомендации экипажей (app/crew_recommendations.py)
+# строятся без запросов к БД. Рассчитан на один процесс бота: все изменения смен проходят через этот процесс.
+
+
+@dataclass(slots=True)
+class DutyShift:
+    karakul_number: str
+    start_time: datetime = field(default_factory=datetime.now)
+    vehicle_id: int | None = None            # Водитель: машина смены
+    vehicle_label: str | None = None         # "Модель (гос. номер)"
+    operational_priority: int | None = None  # Водитель: 1 - первый ход, 2 - второй и т.д.
+    sizod_number: str | None = None          # Пожарный: СИЗОД смены
+
+
+_on_duty: dict[int, DutyShift] = {}
+_warmed = False
+_version = 0 # Меняется при каждом изменении реестра (по нему пересчитываются рекомендации экипажей)
+
+
+def _changed():
+    global _version
+    _version += 1
+
+
+async def warm_duty_registry(session_factory: async_sessionmaker):
+    """Загружает активные смены из БД в реестр (вызывается при старте бота)."""
+    global _warmed
+    async with session_factory() as session:
+        result = await session.execute(
+            select(
+                ShiftLog.employee_id, ShiftLog.karakul_number, ShiftLog.start_time,
+                ShiftLog.vehicle_id, Vehicle.model, Vehicle.number_plate,
+                ShiftLog.operational_priority, ShiftLog.sizod_number
+            )
+            .outerjoin(Vehicle, Vehicle.id == ShiftLog.vehicle_id)
+            .where(ShiftLog.status == 'active')
+        )
+        rows = result.all()
+    _on_duty.clear()
+    _on_duty.update({
+        employee_id: DutyShift(
+            karakul_number, start_time, vehicle_id,
+            f"{model} ({number_plate})" if vehicle_id is not None else None,
+            operational_priority, sizod_number
+        )
+        for employee_id, karakul_number, start_time, vehicle_id, model, number_plate, operational_priority, sizod_number in rows
+    })
+    _warmed = True
+    _changed()
+    logging.info(f"Реестр заступивших на караул загружен: {len(_on_duty)} активных смен.")
+
+
+def mark_on_duty(employee_id: int, karakul_number: str, **shift_details):
+    """Вызывается после успешного коммита заступления на караул.
+
+    shift_details - поля DutyShift (start_time, vehicle_id, vehicle_label, operational_priority,
+    sizod_number), если они есть у смены.
+    """
+    _on_duty[employee_id] = DutyShift(karakul_number, **shift_details)
+    _changed()
+
+
+def mark_off_duty(employee_id: int):
+    """Вызывается после успешного коммита завершения караула."""
+    if _on_duty.pop(employee_id, None) is not None:
+        _changed()
+
+
+def is_on_duty(employee_id: int) -> bool | None:
+    """True/False по реестру; None, если реестр еще не загружен (тогда нужно спросить БД)."""
+    if not _warmed:
+        return None
+    return employee_id in _on_duty
+
+
+def get_duty_karakul(employee_id: int) -> str | None:
+    shift = _on_duty.get(employee_id)
+    return shift.karakul_number if shift else None
+
+
+def duty_shifts() -> tuple[int, dict[int, DutyShift]]:
+    """Версия реестра и активные смены (только для чтения)."""
+    return _version, _on_duty
@@ -0,0 +1,123 @@
+import logging
+from dataclasses import dataclass
+
+from sqlalchemy import update, insert, select, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Equipment, EquipmentLog
+
+# --- Выдача и сдача снаряжения условными UPDATE ---
+# Проверка статуса и запись выполняются одним оператором
+# UPDATE ... WHERE <условие> RETURNING ..., поэтому два пожарных, одновременно
+# взявших один и тот же СИЗОД, не могут оба получить его: второй UPDATE просто
+# не найдет подходящей строки. Транзакция не держится открытой на время проверок в Python.
+# Функции принимают сессию с уже начатой транзакцией (async with session.begin()).
+
+
+@dataclass(frozen=True, slots=True)
+class EquipmentState:
+    id: int
+    name: str
+    inventory_number: str | None
+    status: str
+    current_holder_id: int | None
+    version: int
+
+
+_RETURNING_COLUMNS = (
+    Equipment.id, Equipment.name, Equipment.inventory_number,
+    Equipment.status, Equipment.current_holder_id, Equipment.version
+)
+
+
+def _equipment_filter(equipment_id: int | None, inventory_number: str | None, equipment_type: str | None):
+    if equipment_id is not None:
+        conditions = [Equipment.id == equipment_id]
+    elif inventory_number is not None:
+        conditions = [Equipment.inventory_number == inventory_number]
+    else:
+        raise ValueError("Нужно указать equipment_id или inventory_number.")
+    if equipment_type is not None:
+        conditions.append(Equipment.type == equipment_type)
+    return conditions
+
+
+async def _conditional_update(session: AsyncSession, conditions, values: dict) -> EquipmentState | None:
+    result = await session.execute(
+        update(Equipment)
+        .where(*conditions)
+        .values(**values, version=Equipment.version + 1)
+        .returning(*_RETURNING_COLUMNS)
+        .execution_options(synchronize_session=False)
+    )
+    row = result.first()
+    return EquipmentState(*row) if row else None
+
+
+async def claim_equipment(
+    session: AsyncSession,
+    employee_id: int,
+    *,
+    equipment_id: int | None = None,
+    inventory_number: str | None = None,
+    equipment_type: str | None = None,
+    allow_reclaim: bool = False
+) -> EquipmentState | None:
+    """Закрепляет снаряжение за сотрудником, только если оно свободно.
+
+    allow_reclaim=True дополнительно разрешает повторно взять то, что уже числится
+    за этим сотрудником, и "in_use" без владельца (правила заступления на караул).
+    Возвращает новое состояние или None, если снаряжение занято/недоступно/не найдено.
+    """
+    free_condition = Equipment.status == 'available'
+    if allow_reclaim:
+        free_condition = or_(
+            free_condition,
+            Equipment.current_holder_id == employee_id,
+            and_(Equipment.status == 'in_use', Equipment.current_holder_id.is_(None))
+        )
+    return await _conditional_update(
+        session,
+        [*_equipment_filter(equipment_id, inventory_number, equipment_type), free_condition],
+        {'status': 'in_use', 'current_holder_id': employee_id}
+    )
+
+
+async def release_equipment(
+    session: AsyncSession,
+    employee_id: int,
+    *,
+    equipment_id: int | None = None,
+    inventory_number: str | None = None,
+    equipment_type: str | None = None,
+    new_status: str = 'available',
+    only_in_use: bool = False
+) -> EquipmentState | None:
+    """Снимает снаряжение с сотрудника, только если оно числится за ним."""
+    conditions = [*_equipment_filter(equipment_id, inventory_number, equipment_type), Equipment.current_holder_id == employee_id]
+    if only_in_use:
+        conditions.append(Equipment.status == 'in_use')
+    return await _conditional_update(session, conditions, {'status': new_status, 'current_holder_id': None})
+
+
+async def get_equipment_state(
+    session: AsyncSession,
+    *,
+    equipment_id: int | None = None,
+    inventory_number: str | None = None,
+    equipment_type: str | None = None
+) -> EquipmentState | None:
+    """Текущее состояние снаряжения (для сообщений об ошибке после неудачного UPDATE)."""
+    result = await session.execute(
+        select(*_RETURNING_COLUMNS).where(*_equipment_filter(equipment_id, inventory_number, equipment_type))
+    )
+    row = result.first()
+    return EquipmentState(*row) if row else None
+
+
+async def add_equipment_logs(session: AsyncSession, entries: list[dict]):
+    """Записывает строки EquipmentLog одним INSERT (executemany) в текущей транзакции."""
+    if not entries:
+        return
+    await session.execute(insert(EquipmentLog), entries)
+    logging.info(f"EquipmentLog: добавлено записей: {len(entries)}.")
@@ -5,7 +5,7 @@ from aiogram.fsm.state import State, StatesGroup
 from sqlalchemy import select, or_
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.orm import selectinload
-from models import async_session, Employee, Equipment, EquipmentLog, DispatchOrder, Vehicle
+from models import async_session, Employee, Equipment, DispatchOrder
 from app.keyboards import (
     get_equipment_log_main_keyboard,
     get_equipment_log_action_keyboard,
@@ -14,6 +14,9 @@ from app.keyboards import (
 )
 from app.shift_management import get_active_shift
 from app.dispatcher import ACTIVE_DISPATCH_STATUSES, STATUS_TRANSLATIONS
+from app.name_loader import NameLoader, parse_id_list
+from app.query_budget import query_budget
+from app.equipment_checkout import claim_equipment, release_equipment, get_equipment_state, add_equipment_logs
 
 import logging
 from aiogram.filters import StateFilter
@@ -158,71 +161,45 @@ async def process_equipment_selection(callback: types.CallbackQuery, state: FSMC
             logging.info(f"Сотрудник {employee_db_id_for_shift_check} не на активном карауле.")
 
 
-        # Основная логика теперь вся внутри одного блока session и session.begin
-        async with session_factory() as session:
-            logging.info(f"SRV_DEBUG: process_equipment_selection: Main session CREATED. Is active? {session.in_transaction()}")
-            
-            # "Хак" оставляем на всякий случай, но он не должен срабатывать, если теория верна
-            if session.in_transaction():
-                logging.warning(f"SRV_DEBUG: process_equipment_selection (main block): Transaction was unexpectedly active. Attempting to commit.")
-                try:
-                    await session.commit()
-                    logging.info(f"SRV_DEBUG: process_equipment_selection (main block): Pre-existing transaction committed. Is now active? {session.in_transaction()}")
-                except Exception as e_commit_main:
-                    logging.error(f"SRV_DEBUG: process_equipment_selection (main block): Failed to commit pre-existing transaction: {e_commit_main}")
-                    await session.rollback()
-            
-            logging.info(f"SRV_DEBUG: process_equipment_selection: BEFORE main session.begin() - Is transaction active? {session.in_transaction()}")
-            async with session.begin(): # Начинаем основную транзакцию
-                # 1. Получаем ПОЛНЫЙ объект сотрудника ВНУТРИ транзакции
-                employee = await session.scalar(
-                    select(Employee).where(Employee.telegram_id == user_telegram_id)
-                )
-                if not employee: # Повторная проверка на всякий случай, хотя уже делали
-                    log_message_text = "Ошибка: Ваш профиль не найден в системе."
-                    raise ValueError(log_message_text) # Откатит транзакцию
-                
-                employee_db_id = employee.id # Используем этот ID для EquipmentLog
-
-                # 2. Логика работы со снаряжением
-                equipment = await session.get(Equipment, equipment_id)
-                if not equipment:
-                    log_message_text = "Ошибка: Выбранное снаряжение не найдено."
-                    raise ValueError(log_message_text)
+        employee_db_id = employee_db_id_for_shift_check
+        notes_for_log = f"Действие через журнал."
+        if active_shift_id_for_log: notes_for_log += f" Караул ID: {active_shift_id_for_log}"
+        else: notes_for_log += " Вне караула"
 
-                action_successful = False
+        # Проверка статуса и изменение - одним условным UPDATE, лог - в той же короткой транзакции
+        async with session_factory() as session:
+            async with session.begin():
                 if action == 'taken':
-                    # ... (логика для 'taken')
-                    if equipment.status == 'available':
-                        equipment.status = 'in_use'; equipment.current_holder_id = employee_db_id
-                        session.add(equipment); action_successful = True
-                        log_message_text = f"✅ Вы взяли: {equipment.name}"
-                    else: log_message_text = f"❌ Ошибка: Снаряжение '{equipment.name}' уже используется."
+                    equipment_state = await claim_equipment(session, employee_db_id, equipment_id=equipment_id)
                 elif action == 'returned':
-                    # ... (логика для 'returned')
-                    if equipment.status == 'in_use' and equipment.current_holder_id == employee_db_id:
-                        equipment.status = 'available'; equipment.current_holder_id = None
-                        session.add(equipment); action_successful = True
-                        log_message_text = f"✅ Вы вернули: {equipment.name}"
-                    elif equipment.current_holder_id != employee_db_id: log_message_text = f"❌ Ошибка: Вы не можете вернуть '{equipment.name}'..."
-                    else: log_message_text = f"❌ Ошибка: Снаряжение '{equipment.name}' не числится как используемое."
-                elif action == 'checked':
-                    # ... (логика для 'checked')
-                    action_successful = True; log_message_text = f"✅ Вы проверили: {equipment.name}"
-
-                if action_successful:
-                    notes_for_log = f"Действие через журнал."
-                    if active_shift_id_for_log: notes_for_log += f" Караул ID: {active_shift_id_for_log}"
-                    else: notes_for_log += " Вне караула"
-                    
-                    new_log_entry = EquipmentLog(
+                    equipment_state = await release_equipment(session, employee_db_id, equipment_id=equipment_id, only_in_use=True)
+                else: # 'checked' - состояние не меняется
+                    equipment_state = await get_equipment_state(session, equipment_id=equipment_id)
+
+                if equipment_state:
+                    await add_equipment_logs(session, [dict(
                         employee_id=employee_db_id, equipment_id=equipment_id, action=action,
                         notes=notes_for_log, shift_log_id=active_shift_id_for_log
-                    )
-                    session.add(new_log_entry)
+                    )])
                     logging.info(f"Лог снаряжения: ... shift_id={active_shift_id_for_log}")
+
+            if equipment_state:
+                log_message_text = {
+                    'taken': f"✅ Вы взяли: {equipment_state.name}",
+                    'returned': f"✅ Вы вернули: {equipment_state.name}",
+                }.get(action, f"✅ Вы проверили: {equipment_state.name}")
+            else:
+                # UPDATE не затронул строку - выясняем причину для сообщения
+                current_state = await get_equipment_state(session, equipment_id=equipment_id)
+                if not current_state:
+                    log_message_text = "Ошибка: Выбранное снаряжение не найдено."
+                elif action == 'taken':
+                    log_message_text = f"❌ Ошибка: Снаряжение '{current_state.name}' уже используется."
+                elif current_state.current_holder_id != employee_db_id:
+                    log_message_text = f"❌ Ошибка: Вы не можете вернуть '{current_state.name}'..."
                 else:
-                    logging.warning(f"Действие с снаряжением не выполнено (action_successful=False)... Причина: {log_message_text}")
+                    log_message_text = f"❌ Ошибка: Снаряжение '{current_state.name}' не числится как используемое."
+                logging.warning(f"Действие с снаряжением не выполнено (action_successful=False)... Причина: {log_message_text}")
             
             # Сообщение пользователю после транзакции
             await callback.message.edit_text(log_message_text, reply_markup=None)
@@ -345,6 +322,7 @@ async def handle_shift_schedule_view(message: types.Message):
         else:
             await message.answer("Не удалось найти информацию о вашей основной смене.")
 
+@query_budget()
 async def show_my_active_dispatches(
     event: types.Message | types.CallbackQuery,
     session_factory: async_sessionmaker,
@@ -383,20 +361,13 @@ async def show_my_active_dispatches(
         relevant_dispatches_result = await session.scalars(query.order_by(DispatchOrder.creation_time.desc()))
         
         for dispatch in relevant_dispatches_result.all():
-            assigned_ids_list = []
-            if dispatch.assigned_personnel_ids:
-                try:
-                    if isinstance(dispatch.assigned_personnel_ids, str):
-                        assigned_ids_list = json.loads(dispatch.assigned_personnel_ids)
-                    elif isinstance(dispatch.assigned_personnel_ids, list):
-                        assigned_ids_list = dispatch.assigned_personnel_ids 
-                    else:
-                        logging.warning(f"Неожиданный тип для assigned_personnel_ids: {type(dispatch.assigned_personnel_ids)} для выезда {dispatch.id}")
-                    
-                    if isinstance(assigned_ids_list, list) and employee_id in assigned_ids_list:
-                        active_dispatches_to_show.append(dispatch)
-                except json.JSONDecodeError:
-                    logging.error(f"Ошибка декодирования assigned_personnel_ids для выезда {dispatch.id} при фильтрации: {dispatch.assigned_personnel_ids}")
+            try:
+                assigned_ids_list = parse_id_list(dispatch.assigned_personnel_ids)
+            except json.JSONDecodeError:
+                logging.error(f"Ошибка декодирования assigned_personnel_ids для выезда {dispatch.id} при фильтрации: {dispatch.assigned_personnel_ids}")
+                continue
+            if employee_id in assigned_ids_list:
+                active_dispatches_to_show.append(dispatch)
         
         if not active_dispatches_to_show:
             msg_text = f"Выезд №{target_dispatch_id} не найден в списке ваших активных назначений, либо он уже завершен." if target_dispatch_id else "У вас нет назначенных активных выездов."
@@ -411,6 +382,24 @@ async def show_my_active_dispatches(
         if isinstance(event, types.Message) and not target_dispatch_id:
              response_parts.append("<b>ℹ️ Ваши активные выезда:</b>")
 
+        # Собираем ID ЛС и техники по всем показываемым выездам и загружаем имена пакетно:
+        # один запрос на сотрудников и один на технику вместо двух запросов на каждый выезд
+        names = NameLoader()
+        dispatch_ids_parsed = {}
+        for dispatch_order_obj in active_dispatches_to_show:
+            try:
+                personnel_ids_list = parse_id_list(dispatch_order_obj.assigned_personnel_ids)
+            except json.JSONDecodeError:
+                personnel_ids_list = None
+            try:
+                vehicle_ids_list = parse_id_list(dispatch_order_obj.assigned_vehicle_ids)
+            except json.JSONDecodeError:
+                vehicle_ids_list = None
+            dispatch_ids_parsed[dispatch_order_obj.id] = (personnel_ids_list, vehicle_ids_list)
+            names.want_employees(personnel_ids_list or [])
+            names.want_vehicles(vehicle_ids_list or [])
+        await names.load(session)
+
         for dispatch_order_obj in active_dispatches_to_show:
             dispatch_details = [
                 f"\n<b>Выезд № {dispatch_order_obj.id}</b> (Статус: {STATUS_TRANSLATIONS.get(dispatch_order_obj.status, dispatch_order_obj.status)})",
@@ -421,55 +410,23 @@ async def show_my_active_dispatches(
             if dispatch_order_obj.approval_time:
                 dispatch_details.append(f"<b>Утвержден:</b> {dispatch_order_obj.approval_time.strftime('%d.%m.%Y %H:%M')}")
 
-            # Получаем информацию о назначенном ЛС
-            if dispatch_order_obj.assigned_personnel_ids:
-                try:
-                    personnel_ids_data = dispatch_order_obj.assigned_personnel_ids
-                    personnel_ids_list = []
-                    # ИСПРАВЛЕНИЕ ЗДЕСЬ
-                    if isinstance(personnel_ids_data, str):
-                        personnel_ids_list = json.loads(personnel_ids_data)
-                    elif isinstance(personnel_ids_data, list):
-                        personnel_ids_list = personnel_ids_data
-                    
-                    if personnel_ids_list:
-                        personnel_on_dispatch_result = await session.execute(
-                            select(Employee.full_name, Employee.position, Employee.rank)
-                            .where(Employee.id.in_(personnel_ids_list))
-                            .order_by(Employee.full_name)
-                        )
-                        personnel_str_list = ", ".join([f"{name} ({pos}, {rank or 'б/з'})" for name, pos, rank in personnel_on_dispatch_result.all()])
-                        dispatch_details.append(f"<b>ЛС на выезде:</b> {personnel_str_list if personnel_str_list else 'не указан'}")
-                    else:
-                        dispatch_details.append("<b>ЛС на выезде:</b> не назначен")
-                except json.JSONDecodeError:
-                    dispatch_details.append("<b>ЛС на выезде:</b> ошибка чтения данных (JSON)")
+            personnel_ids_list, vehicle_ids_list = dispatch_ids_parsed[dispatch_order_obj.id]
+
+            # Информация о назначенном ЛС
+            if personnel_ids_list is None:
+                dispatch_details.append("<b>ЛС на выезде:</b> ошибка чтения данных (JSON)")
+            elif personnel_ids_list:
+                personnel_str_list = ", ".join(emp.display() for emp in names.employees_by_name(personnel_ids_list))
+                dispatch_details.append(f"<b>ЛС на выезде:</b> {personnel_str_list if personnel_str_list else 'не указан'}")
             else:
                 dispatch_details.append("<b>ЛС на выезде:</b> не назначен")
             
-            # Получаем информацию о назначенной технике
-            if dispatch_order_obj.assigned_vehicle_ids:
-                try:
-                    vehicle_ids_data = dispatch_order_obj.assigned_vehicle_ids
-                    vehicle_ids_list = []
-                    # ИСПРАВЛЕНИЕ ЗДЕСЬ
-                    if isinstance(vehicle_ids_data, str):
-                        vehicle_ids_list = json.loads(vehicle_ids_data)
-                    elif isinstance(vehicle_ids_data, list):
-                        vehicle_ids_list = vehicle_ids_data
-                        
-                    if vehicle_ids_list:
-                        vehicles_on_dispatch_result = await session.execute(
-                            select(Vehicle.model, Vehicle.number_plate)
-                            .where(Vehicle.id.in_(vehicle_ids_list))
-                            .order_by(Vehicle.model)
-                        )
-                        vehicle_str_list = ", ".join([f"{model} ({plate})" for model, plate in vehicles_on_dispatch_result.all()])
-                        dispatch_details.append(f"<b>Техника:</b> {vehicle_str_list if vehicle_str_list else 'не указана'}")
-                    else:
-                        dispatch_details.append("<b>Техника:</b> не назначена")
-                except json.JSONDecodeError:
-                    dispatch_details.append("<b>Техника:</b> ошибка чтения данных (JSON)")
+            # Информация о назначенной технике
+            if vehicle_ids_list is None:
+                dispatch_details.append("<b>Техника:</b> ошибка чтения данных (JSON)")
+            elif vehicle_ids_list:
+                vehicle_str_list = ", ".join(vhc.display() for vhc in names.vehicles_by_model(vehicle_ids_list))
+                dispatch_details.append(f"<b>Техника:</b> {vehicle_str_list if vehicle_str_list else 'не указана'}")
             else:
                 dispatch_details.append("<b>Техника:</b> не назначена")
 
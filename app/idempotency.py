@@ -0,0 +1,149 @@
+import logging
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.types import CallbackQuery
+
+# --- Идемпотентная обработка callback-кнопок, которые что-то записывают в БД ---
+# Двойное нажатие или повторная доставка Telegram для кнопок утверждения/сохранения
+# не должны выполнять запись и рассылку уведомлений второй раз. Ключ - чат + сообщение + callback_data
+# (для inline-сообщений без message - id callback-запроса). Повтор в пределах TTL
+# не доходит до обработчика и получает ответ по сохраненному результату.
+# Обработчик, который поймал ошибку и сообщил о ней пользователю (действие не выполнено),
+# вызывает allow_callback_retry(): ключ снимается, и повторное нажатие снова дойдет до обработчика.
+
+IDEMPOTENCY_TTL_SECONDS = 120
+IDEMPOTENCY_MAX_KEYS = 5000
+
+# Префиксы callback_data (кнопки с ID в данных), которые защищаются от повторов
+IDEMPOTENT_CALLBACK_PREFIXES = (
+    'dispatch_approve_', 'dispatch_reject_',  # Решение НК по выезду
+    'dispatch_complete_',                     # Завершение выезда
+    'maint_confirm_',                         # Подтверждение обслуживания снаряжения
+    'edit_dispatch_save_change_',             # Сохранение правки выезда
+    'close_karakul_do_',                      # Закрытие караула НК
+)
+
+# Точные значения callback_data. Отдельно от префиксов: префикс 'confirm' совпал бы
+# с любыми данными, начинающимися с "confirm", включая будущие кнопки
+IDEMPOTENT_CALLBACK_DATA = frozenset({
+    'dispatch_confirm',                       # Создание выезда диспетчером
+    'confirm',                                # Сохранение путевого листа (save_trip_sheet)
+    'absence_confirm',                        # Запись отсутствующего
+    'kstart_confirm',                         # Заступление караула НК
+})
+
+DUPLICATE_IN_PROGRESS_TEXT = "⏳ Уже обрабатывается..."
+DUPLICATE_DONE_TEXT = "✅ Уже выполнено."
+
+
+@dataclass(slots=True)
+class _Entry:
+    expires_at: float
+    done: bool = False
+    result: Any = None
+    failed: bool = False
+
+
+_current_entry: ContextVar[_Entry | None] = ContextVar("idempotency_entry", default=None)
+
+
+def allow_callback_retry():
+    """Отмечает, что защищенный callback не выполнен: повторное нажатие снова дойдет до обработчика."""
+    entry = _current_entry.get()
+    if entry is not None:
+        entry.failed = True
+
+
+class TTLStore:
+    """Ограниченное по размеру хранилище ключей с временем жизни (вытесняются самые старые)."""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry.expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def put(self, key, entry):
+        self._data[key] = entry
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class IdempotentCallbackMiddleware(BaseMiddleware):
+    """Outer-middleware для router.callback_query: пропускает к обработчику только первое нажатие."""
+
+    def __init__(
+        self,
+        prefixes: tuple[str, ...] = IDEMPOTENT_CALLBACK_PREFIXES,
+        exact_values: frozenset[str] = IDEMPOTENT_CALLBACK_DATA,
+        ttl_seconds: float = IDEMPOTENCY_TTL_SECONDS,
+        max_keys: int = IDEMPOTENCY_MAX_KEYS
+    ):
+        self.prefixes = prefixes
+        self.exact_values = exact_values
+        self._store = TTLStore(ttl_seconds, max_keys)
+
+    def _is_guarded(self, callback_data: str | None) -> bool:
+        return bool(callback_data) and (callback_data in self.exact_values or callback_data.startswith(self.prefixes))
+
+    @staticmethod
+    def _key(event: CallbackQuery):
+        if event.message is not None:
+            return (event.message.chat.id, event.message.message_id, event.data)
+        return ('query', event.id)
+
+    async def __call__(
+        self,
+        handler: Callable[[CallbackQuery, dict[str, Any]], Awaitable[Any]],
+        event: CallbackQuery,
+        data: dict[str, Any]
+    ) -> Any:
+        if not self._is_guarded(event.data):
+            return await handler(event, data)
+
+        key = self._key(event)
+        entry = self._store.get(key)
+        if entry is not None:
+            logging.info(f"Повторный callback '{event.data}' от {event.from_user.id} пропущен (done={entry.done}).")
+            try:
+                await event.answer(DUPLICATE_DONE_TEXT if entry.done else DUPLICATE_IN_PROGRESS_TEXT)
+            except Exception as e:
+                logging.warning(f"Не удалось ответить на повторный callback: {e}")
+            return entry.result
+
+        entry = _Entry(expires_at=time.monotonic() + self._store.ttl_seconds)
+        self._store.put(key, entry)
+        token = _current_entry.set(entry)
+        try:
+            result = await handler(event, data)
+        except Exception:
+            self._store.discard(key) # После ошибки повторное нажатие должно снова дойти до обработчика
+            raise
+        finally:
+            _current_entry.reset(token)
+        if result is UNHANDLED or entry.failed:
+            # Не подошло ни одному обработчику (например, другое состояние FSM) или обработчик сообщил об ошибке
+            self._store.discard(key)
+            return result
+        entry.done = True
+        entry.result = result
+        return result
@@ -0,0 +1,208 @@
+import bisect
+import logging
+from dataclasses import dataclass
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import object_session
+
+from models import Equipment
+from app.commit_hooks import on_commit, register_commit_applier
+
+# --- Индекс инвентарных номеров снаряжения (в памяти) ---
+# При заступлении номер СИЗОД вводится вручную, и опечатка раньше обрывала все заступление
+# в finalize_firefighter_shift_start. Индекс позволяет проверить номер сразу после ввода
+# и предложить похожие номера без запросов к БД:
+# - точное совпадение после нормализации (регистр, пробелы и дефисы, кириллические
+#   буквы, похожие на латинские: "с-0012" -> "S0012" совпадет с "S-0012");
+# - начало номера (отсортированный список ключей + bisect);
+# - расстояние Левенштейна до INVENTORY_MAX_DISTANCE. Кандидаты ищутся по словарю
+#   удалений (symmetric delete): для каждого номера заранее записаны все варианты
+#   без 1..INVENTORY_MAX_DISTANCE символов, и у номеров на расстоянии <= 2 есть общий
+#   вариант. BK-дерево здесь не подходит: номера короткие, почти все расстояния 1..6,
+#   и отсечение по неравенству треугольника почти ничего не отбрасывает.
+# Загружается при старте, а изменения Equipment через ORM (добавление, смена номера,
+# удаление) применяются событиями маппера после коммита транзакции.
+
+INVENTORY_MAX_DISTANCE = 2
+INVENTORY_SUGGESTIONS = 5
+
+# Кириллические буквы, которые выглядят как латинские (номера набирают в любой раскладке)
+_HOMOGLYPHS = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
+_SEPARATORS = str.maketrans("", "", " -_./\\")
+
+
+def normalize_inventory_number(number: str) -> str:
+    return number.upper().translate(_HOMOGLYPHS).translate(_SEPARATORS)
+
+
+def levenshtein(a: str, b: str, limit: int | None = None) -> int:
+    """Расстояние Левенштейна; с limit - любое значение больше limit, как только это стало ясно."""
+    if len(a) < len(b):
+        a, b = b, a
+    if limit is not None and len(a) - len(b) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+@dataclass(frozen=True, slots=True)
+class InventoryItem:
+    id: int
+    inventory_number: str
+    type: str
+    name: str
+
+
+def _deletes(key: str, max_distance: int) -> set[str]:
+    """Все варианты ключа без 0..max_distance символов."""
+    variants = {key}
+    frontier = {key}
+    for _ in range(max_distance):
+        frontier = {word[:i] + word[i + 1:] for word in frontier for i in range(len(word))}
+        variants |= frontier
+    return variants
+
+
+class InventoryIndex:
+    """Поиск снаряжения по инвентарному номеру: точный, по началу и с опечатками."""
+
+    def __init__(self, max_distance: int = INVENTORY_MAX_DISTANCE, limit: int = INVENTORY_SUGGESTIONS):
+        self.max_distance = max_distance
+        self.limit = limit
+        self._items: dict[str, dict[int, InventoryItem]] = {} # Нормализованный номер -> снаряжение
+        self._by_id: dict[int, str] = {}                      # id снаряжения -> нормализованный номер
+        self._keys: list[str] = []                             # Отсортированные ключи (для поиска по началу)
+        self._deletes: dict[str, set[str]] = {}                # Вариант без 0..2 символов -> ключи
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def load(self, items):
+        self._items.clear()
+        self._by_id.clear()
+        self._keys = []
+        self._deletes.clear()
+        for item in items:
+            self.put(item)
+        self.loaded = True
+
+    def put(self, item: InventoryItem):
+        """Добавляет снаряжение или обновляет его номер."""
+        self.remove(item.id)
+        key = normalize_inventory_number(item.inventory_number)
+        if not key:
+            return
+        if key not in self._items:
+            self._items[key] = {}
+            bisect.insort(self._keys, key)
+            for variant in _deletes(key, self.max_distance):
+                self._deletes.setdefault(variant, set()).add(key)
+        self._items[key][item.id] = item
+        self._by_id[item.id] = key
+
+    def remove(self, equipment_id: int):
+        key = self._by_id.pop(equipment_id, None)
+        if key is not None:
+            # Ключ остается в словаре удалений, ключи без снаряжения пропускаются при поиске
+            self._items[key].pop(equipment_id, None)
+
+    def _matching(self, key: str, equipment_type: str | None) -> list[InventoryItem]:
+        return [
+            item for item in self._items.get(key, {}).values()
+            if equipment_type is None or item.type == equipment_type
+        ]
+
+    def find_exact(self, number: str, equipment_type: str | None = None) -> InventoryItem | None:
+        """Снаряжение с этим номером (с точностью до регистра, разделителей и раскладки)."""
+        matches = self._matching(normalize_inventory_number(number), equipment_type)
+        return matches[0] if matches else None
+
+    def suggest(self, number: str, equipment_type: str | None = None) -> list[InventoryItem]:
+        """Похожие номера: сначала ближайшие по расстоянию, затем начинающиеся с введенного."""
+        key = normalize_inventory_number(number)
+        if not key:
+            return []
+        ranked: dict[str, tuple[int, str]] = {}
+        # Опечатки: кандидаты с общим вариантом удаления, затем точное расстояние
+        candidates = set()
+        for variant in _deletes(key, self.max_distance):
+            candidates |= self._deletes.get(variant, set())
+        for candidate in candidates:
+            distance = levenshtein(key, candidate, self.max_distance)
+            if distance <= self.max_distance:
+                ranked[candidate] = (distance, candidate)
+        # Начало номера ("S00" -> S0012, S0013 ...)
+        position = bisect.bisect_left(self._keys, key)
+        while position < len(self._keys) and self._keys[position].startswith(key) and len(ranked) < 4 * self.limit:
+            candidate = self._keys[position]
+            ranked.setdefault(candidate, (self.max_distance + 1, candidate))
+            position += 1
+
+        result = []
+        for _rank, candidate in sorted(ranked.values()):
+            result.extend(self._matching(candidate, equipment_type))
+            if len(result) >= self.limit:
+                break
+        return result[:self.limit]
+
+
+# Общий индекс для обработчиков заступления на караул
+inventory_index = InventoryIndex()
+
+
+def _item_from(equipment: Equipment) -> InventoryItem | None:
+    if not equipment.inventory_number:
+        return None
+    return InventoryItem(equipment.id, equipment.inventory_number, equipment.type, equipment.name)
+
+
+# События маппера срабатывают при flush, а не при коммите: изменения попадают в индекс
+# только после коммита, при откате - отбрасываются (app/commit_hooks.py)
+_COMMIT_KEY = 'inventory_index_changes'
+
+
+def _on_equipment_saved(mapper, connection, target: Equipment):
+    session = object_session(target)
+    if session is not None:
+        on_commit(session, _COMMIT_KEY, (target.id, _item_from(target))) # None - номер убран
+
+
+def _on_equipment_deleted(mapper, connection, target: Equipment):
+    session = object_session(target)
+    if session is not None:
+        on_commit(session, _COMMIT_KEY, (target.id, None))
+
+
+def _apply_committed_changes(changes: list):
+    for equipment_id, item in changes: # По порядку: побеждает последнее изменение строки
+        if item is None:
+            inventory_index.remove(equipment_id)
+        else:
+            inventory_index.put(item)
+
+
+register_commit_applier(_COMMIT_KEY, _apply_committed_changes)
+event.listen(Equipment, 'after_insert', _on_equipment_saved)
+event.listen(Equipment, 'after_update', _on_equipment_saved)
+event.listen(Equipment, 'after_delete', _on_equipment_deleted)
+
+
+async def warm_inventory_index(session_factory: async_sessionmaker):
+    """Загружает инвентарные номера снаряжения (вызывается при старте бота)."""
+    async with session_factory() as session:
+        result = await session.execute(
+            select(Equipment.id, Equipment.inventory_number, Equipment.type, Equipment.name)
+            .where(Equipment.inventory_number.is_not(None))
+        )
+        rows = result.all()
+    inventory_index.load(InventoryItem(*row) for row in rows)
+    logging.info(f"Индекс инвентарных номеров загружен: {len(inventory_index)} единиц снаряжения.")
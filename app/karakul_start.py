@@ -0,0 +1,350 @@
+import logging
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+
+from sqlalchemy import and_, case, func, insert, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import aliased
+
+from models import Employee, Equipment, ShiftLog, Vehicle
+from app.duty_registry import mark_on_duty
+from app.equipment_checkout import add_equipment_logs
+from app.outbox import enqueue_message as enqueue_outbox_message, wake_outbox_sender
+
+# --- Заступление всего караула одной операцией ---
+# В пересменку каждый сотрудник проходит StartShiftStates сам, и каждое заступление -
+# отдельная транзакция. Здесь НК получает состав караула по прошлой смене: сотрудники,
+# чья последняя смена была в этом карауле, с теми же автомобилем, оперативным ходом
+# и СИЗОД; одометр и топливо - по последней закрытой смене автомобиля. НК правит состав,
+# и все заступления записываются одной транзакцией из нескольких операторов:
+# 1. занятые смены (сотрудник уже заступил с момента показа списка) отсеиваются одним SELECT;
+# 2. UPDATE vehicles ... WHERE status = 'available' RETURNING - техника водителей;
+# 3. UPDATE equipment ... RETURNING - СИЗОД пожарных по тем же правилам, что и claim_equipment
+#    с allow_reclaim (владелец подставляется через CASE по номеру);
+# 4. INSERT shift_logs и INSERT equipment_logs (executemany);
+# 5. уведомления сотрудникам через outbox.
+# Сотрудник, которому не досталась техника или СИЗОД, не заступает и попадает в отчет НК.
+# Последняя смена ищется только в основной базе: архив хранит смены старше полугода.
+
+ROLE_DRIVER = 'driver'
+ROLE_FIREFIGHTER = 'firefighter'
+ROLE_OTHER = 'other'
+
+BULK_START_SIZOD_STATUS = 'Исправен' # Состояние СИЗОД подтверждает НК при заступлении караула
+
+
+def role_for_position(position: str) -> str:
+    position_lower = position.lower()
+    if position_lower == "водитель":
+        return ROLE_DRIVER
+    if position_lower == "пожарный":
+        return ROLE_FIREFIGHTER
+    return ROLE_OTHER
+
+
+@dataclass
+class RosterEntry:
+    employee_id: int
+    full_name: str
+    position: str
+    telegram_id: int | None
+    role: str
+    vehicle_id: int | None = None
+    vehicle_label: str | None = None
+    operational_priority: int | None = None
+    start_odometer: float | None = None
+    start_fuel_level: float | None = None
+    sizod_number: str | None = None
+    included: bool = True
+    warning: str | None = None # Что проверить НК перед подтверждением
+
+
+@dataclass(frozen=True, slots=True)
+class VehicleReading:
+    id: int
+    model: str | None
+    number_plate: str | None
+    status: str | None
+    odometer: float | None   # Конечный одометр последней закрытой смены на этой машине
+    fuel_level: float | None
+
+    @property
+    def label(self) -> str:
+        return f"{self.model} ({self.number_plate})"
+
+
+@dataclass
+class KarakulStartResult:
+    started: list[RosterEntry] = field(default_factory=list)
+    skipped: list[tuple[RosterEntry, str]] = field(default_factory=list)
+
+
+def roster_to_data(entries: list[RosterEntry]) -> list[dict]:
+    """Состав караула в виде, пригодном для хранения в данных FSM."""
+    return [asdict(entry) for entry in entries]
+
+
+def roster_from_data(data: list[dict]) -> list[RosterEntry]:
+    return [RosterEntry(**item) for item in data]
+
+
+async def fetch_vehicle_readings(session: AsyncSession, vehicle_ids=None, only_available: bool = False) -> dict[int, VehicleReading]:
+    """Техника с показаниями последней закрытой смены (одним запросом, коррелированные подзапросы по индексу)."""
+    last_shift = aliased(ShiftLog)
+
+    def _last_value(column):
+        return (
+            select(column)
+            .where(last_shift.vehicle_id == Vehicle.id, last_shift.end_time.is_not(None), last_shift.end_odometer.is_not(None))
+            .order_by(last_shift.end_time.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+
+    query = select(
+        Vehicle.id, Vehicle.model, Vehicle.number_plate, Vehicle.status,
+        _last_value(last_shift.end_odometer), _last_value(last_shift.end_fuel_level)
+    ).order_by(Vehicle.model)
+    if vehicle_ids is not None:
+        query = query.where(Vehicle.id.in_(vehicle_ids))
+    if only_available:
+        query = query.where(Vehicle.status == 'available')
+    result = await session.execute(query)
+    return {row[0]: VehicleReading(*row) for row in result.all()}
+
+
+def apply_vehicle(entry: RosterEntry, vehicle: VehicleReading):
+    """Назначает водителю автомобиль с показаниями одометра и топлива по последней смене."""
+    entry.vehicle_id = vehicle.id
+    entry.vehicle_label = vehicle.label
+    entry.start_odometer = vehicle.odometer
+    entry.start_fuel_level = vehicle.fuel_level
+    if vehicle.status != 'available':
+        entry.warning = f"автомобиль занят ({vehicle.status})"
+    elif vehicle.odometer is None:
+        entry.warning = "нет показаний одометра"
+    else:
+        entry.warning = None
+
+
+async def build_karakul_roster(session_factory: async_sessionmaker, karakul_number: str) -> list[RosterEntry]:
+    """Состав караула по последним сменам сотрудников (без тех, кто уже заступил)."""
+    last_shift_ids = (
+        select(func.max(ShiftLog.id).label('id'))
+        .group_by(ShiftLog.employee_id)
+        .subquery()
+    )
+    async with session_factory() as session:
+        rows = (await session.execute(
+            select(
+                Employee.id, Employee.full_name, Employee.position, Employee.telegram_id,
+                ShiftLog.vehicle_id, ShiftLog.operational_priority, ShiftLog.sizod_number
+            )
+            .join(last_shift_ids, last_shift_ids.c.id == ShiftLog.id)
+            .join(Employee, Employee.id == ShiftLog.employee_id)
+            .where(ShiftLog.karakul_number == karakul_number, ShiftLog.status != 'active')
+            .order_by(Employee.position, Employee.full_name)
+        )).all()
+
+        vehicle_ids = {row.vehicle_id for row in rows if row.vehicle_id is not None}
+        vehicles = await fetch_vehicle_readings(session, vehicle_ids) if vehicle_ids else {}
+        sizod_numbers = {row.sizod_number for row in rows if row.sizod_number}
+        sizod_states = {}
+        if sizod_numbers:
+            sizod_states = {
+                number: (status, holder_id)
+                for number, status, holder_id in (await session.execute(
+                    select(Equipment.inventory_number, Equipment.status, Equipment.current_holder_id)
+                    .where(Equipment.type == 'СИЗОД', Equipment.inventory_number.in_(sizod_numbers))
+                )).all()
+            }
+
+    entries = []
+    for row in rows:
+        entry = RosterEntry(
+            employee_id=row.id, full_name=row.full_name, position=row.position,
+            telegram_id=row.telegram_id, role=role_for_position(row.position)
+        )
+        if entry.role == ROLE_DRIVER:
+            entry.operational_priority = row.operational_priority
+            if row.vehicle_id in vehicles:
+                apply_vehicle(entry, vehicles[row.vehicle_id])
+            else:
+                entry.warning = "не выбран автомобиль"
+        elif entry.role == ROLE_FIREFIGHTER:
+            entry.sizod_number = row.sizod_number
+            entry.warning = sizod_warning(entry, sizod_states.get(row.sizod_number))
+        entries.append(entry)
+    return entries
+
+
+def sizod_warning(entry: RosterEntry, state: tuple[str, int | None] | None) -> str | None:
+    if not entry.sizod_number:
+        return "не указан СИЗОД"
+    if state is None:
+        return "СИЗОД не найден"
+    status, holder_id = state
+    if status == 'available' or holder_id == entry.employee_id or (status == 'in_use' and holder_id is None):
+        return None
+    return f"СИЗОД недоступен ({status})"
+
+
+async def start_karakul_shifts(
+    session_factory: async_sessionmaker,
+    karakul_number: str,
+    entries: list[RosterEntry],
+    started_by_employee_id: int | None = None
+) -> KarakulStartResult:
+    """Заступление выбранных сотрудников на караул одной транзакцией."""
+    result = KarakulStartResult()
+    candidates: list[RosterEntry] = []
+    seen_vehicles, seen_sizods = set(), set()
+    for entry in entries:
+        if not entry.included:
+            continue
+        if entry.role == ROLE_DRIVER and entry.vehicle_id is None:
+            result.skipped.append((entry, "не выбран автомобиль"))
+        elif entry.role == ROLE_DRIVER and entry.vehicle_id in seen_vehicles:
+            result.skipped.append((entry, "автомобиль уже назначен другому водителю"))
+        elif entry.role == ROLE_DRIVER and entry.start_odometer is None:
+            # Без начального одометра водитель не сможет закончить караул - пусть заступит через свое меню
+            result.skipped.append((entry, "нет показаний одометра, заступление через меню водителя"))
+        elif entry.role == ROLE_FIREFIGHTER and not entry.sizod_number:
+            result.skipped.append((entry, "не указан СИЗОД"))
+        elif entry.role == ROLE_FIREFIGHTER and entry.sizod_number in seen_sizods:
+            result.skipped.append((entry, "СИЗОД уже назначен другому пожарному"))
+        else:
+            if entry.role == ROLE_DRIVER:
+                seen_vehicles.add(entry.vehicle_id)
+            elif entry.role == ROLE_FIREFIGHTER:
+                seen_sizods.add(entry.sizod_number)
+            candidates.append(entry)
+    if not candidates:
+        return result
+
+    start_time = datetime.now()
+    async with session_factory() as session:
+        async with session.begin():
+            # 1. Кто уже заступил (например, сам, пока НК правил список)
+            already_on_duty = set((await session.scalars(
+                select(ShiftLog.employee_id).where(
+                    ShiftLog.status == 'active',
+                    ShiftLog.employee_id.in_([entry.employee_id for entry in candidates])
+                )
+            )).all())
+            for entry in [entry for entry in candidates if entry.employee_id in already_on_duty]:
+                candidates.remove(entry)
+                result.skipped.append((entry, "уже на карауле"))
+
+            # 2. Техника водителей
+            drivers = [entry for entry in candidates if entry.role == ROLE_DRIVER]
+            if drivers:
+                claimed_vehicles = set((await session.scalars(
+                    update(Vehicle)
+                    .where(Vehicle.id.in_([entry.vehicle_id for entry in drivers]), Vehicle.status == 'available')
+                    .values(status='in_use')
+                    .returning(Vehicle.id)
+                    .execution_options(synchronize_session=False)
+                )).all())
+                for entry in drivers:
+                    if entry.vehicle_id not in claimed_vehicles:
+                        candidates.remove(entry)
+                        result.skipped.append((entry, f"автомобиль {entry.vehicle_label or ''} занят или недоступен"))
+
+            # 3. СИЗОД пожарных
+            firefighters = [entry for entry in candidates if entry.role == ROLE_FIREFIGHTER]
+            claimed_sizods: dict[str, int] = {}
+            if firefighters:
+                holder_by_number = {entry.sizod_number: entry.employee_id for entry in firefighters}
+                claimed_sizods = {
+                    number: equipment_id
+                    for equipment_id, number in (await session.execute(
+                        update(Equipment)
+                        .where(
+                            Equipment.type == 'СИЗОД',
+                            Equipment.inventory_number.in_(list(holder_by_number)),
+                            or_(
+                                Equipment.status == 'available',
+                                tuple_(Equipment.inventory_number, Equipment.current_holder_id).in_(list(holder_by_number.items())),
+                                and_(Equipment.status == 'in_use', Equipment.current_holder_id.is_(None))
+                            )
+                        )
+                        .values(
+                            status='in_use',
+                            current_holder_id=case(holder_by_number, value=Equipment.inventory_number),
+                            version=Equipment.version + 1
+                        )
+                        .returning(Equipment.id, Equipment.inventory_number)
+                        .execution_options(synchronize_session=False)
+                    )).all()
+                }
+                for entry in firefighters:
+                    if entry.sizod_number not in claimed_sizods:
+                        candidates.remove(entry)
+                        result.skipped.append((entry, f"СИЗОД №{entry.sizod_number} не найден, занят или недоступен"))
+
+            if candidates:
+                # 4. Смены и журнал снаряжения
+                shift_ids = dict((await session.execute(
+                    insert(ShiftLog).returning(ShiftLog.employee_id, ShiftLog.id),
+                    [
+                        {
+                            'employee_id': entry.employee_id,
+                            'karakul_number': karakul_number,
+                            'start_time': start_time,
+                            'status': 'active',
+                            'vehicle_id': entry.vehicle_id if entry.role == ROLE_DRIVER else None,
+                            'operational_priority': entry.operational_priority if entry.role == ROLE_DRIVER else None,
+                            'start_odometer': entry.start_odometer if entry.role == ROLE_DRIVER else None,
+                            'start_fuel_level': entry.start_fuel_level if entry.role == ROLE_DRIVER else None,
+                            'sizod_number': entry.sizod_number if entry.role == ROLE_FIREFIGHTER else None,
+                            'sizod_status_start': BULK_START_SIZOD_STATUS if entry.role == ROLE_FIREFIGHTER else None,
+                        }
+                        for entry in candidates
+                    ]
+                )).all())
+                await add_equipment_logs(session, [
+                    {
+                        'employee_id': entry.employee_id,
+                        'equipment_id': claimed_sizods[entry.sizod_number],
+                        'action': 'taken',
+                        'timestamp': start_time,
+                        'notes': f"Взят на караул №{karakul_number} (заступление караула, подтвердил НК). "
+                                 f"Начальное состояние: {BULK_START_SIZOD_STATUS}. Примечание: нет",
+                        'shift_log_id': shift_ids[entry.employee_id],
+                    }
+                    for entry in candidates if entry.role == ROLE_FIREFIGHTER
+                ])
+
+                # 5. Уведомления сотрудникам
+                for entry in candidates:
+                    if entry.telegram_id:
+                        enqueue_outbox_message(session, entry.telegram_id, _started_notification(entry, karakul_number, start_time))
+
+    result.started = candidates
+    for entry in result.started:
+        if entry.role == ROLE_DRIVER:
+            mark_on_duty(
+                entry.employee_id, karakul_number, start_time=start_time, vehicle_id=entry.vehicle_id,
+                vehicle_label=entry.vehicle_label, operational_priority=entry.operational_priority
+            )
+        elif entry.role == ROLE_FIREFIGHTER:
+            mark_on_duty(entry.employee_id, karakul_number, start_time=start_time, sizod_number=entry.sizod_number)
+        else:
+            mark_on_duty(entry.employee_id, karakul_number, start_time=start_time)
+    if result.started:
+        wake_outbox_sender()
+    logging.info(
+        f"Заступление караула №{karakul_number} (НК {started_by_employee_id}): заступили {len(result.started)}, "
+        f"пропущено {len(result.skipped)}."
+    )
+    return result
+
+
+def _started_notification(entry: RosterEntry, karakul_number: str, start_time: datetime) -> str:
+    text = f"✅ Вы заступили на караул №{karakul_number} ({start_time.strftime('%d.%m.%Y %H:%M')}) по списку начальника караула."
+    if entry.role == ROLE_DRIVER:
+        text += f"\nАвтомобиль: {entry.vehicle_label}, оперативный ход: {entry.operational_priority or '—'}."
+    elif entry.role == ROLE_FIREFIGHTER:
+        text += f"\nСИЗОД №{entry.sizod_number} зарегистрирован за вами."
+    return text
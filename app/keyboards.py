@@ -2,8 +2,21 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from functools import lru_cache
 from models import Equipment, Employee, Vehicle
+
+# --- Кэширование клавиатур ---
+# Статичные клавиатуры строятся один раз и переиспользуются (@lru_cache без ограничения:
+# вариантов аргументов единицы). Клавиатуры с ID выезда/снаряжения кэшируются
+# по аргументам в ограниченном LRU. Возвращаемые разметки общие для всех вызовов -
+# их нельзя изменять после получения, нужна другая клавиатура - добавьте новую функцию.
+ID_KEYBOARD_CACHE_SIZE = 256
+
+# Эмодзи статусов снаряжения в списке обслуживания
+EQUIPMENT_STATUS_EMOJI = {'maintenance': '🛠️', 'repair': '⚠️', 'in_use': '👨‍🚒'}
+
 # --- Inline клавиатуры ---
+@lru_cache(maxsize=None)
 def confirm_cancel_keyboard(show_finish_button=False): # Функция остается
     keyboard_rows = [
         [
@@ -18,6 +31,7 @@ def confirm_cancel_keyboard(show_finish_button=False): # Функция оста
     return InlineKeyboardMarkup(inline_keyboard=keyboard_rows)
 
 # Клавиатура для подтверждения/отмены создания выезда
+@lru_cache(maxsize=None)
 def confirm_cancel_dispatch_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -28,6 +42,7 @@ def confirm_cancel_dispatch_keyboard():
         ]
     )
 
+@lru_cache(maxsize=None)
 def get_position_keyboard(): # Функция остается
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -46,6 +61,7 @@ def get_position_keyboard(): # Функция остается
     )
     return keyboard
 
+@lru_cache(maxsize=None)
 def get_rank_keyboard(): # Функция остается
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -66,6 +82,7 @@ def get_rank_keyboard(): # Функция остается
     )
     return keyboard
 
+@lru_cache(maxsize=None)
 def get_equipment_log_main_keyboard():
     """Кнопки основного меню журнала снаряжения."""
     keyboard = InlineKeyboardMarkup(
@@ -77,6 +94,7 @@ def get_equipment_log_main_keyboard():
     )
     return keyboard
 
+@lru_cache(maxsize=None)
 def get_equipment_log_action_keyboard():
     """Кнопки для выбора действия в новой записи лога."""
     keyboard = InlineKeyboardMarkup(
@@ -112,6 +130,7 @@ def get_equipment_selection_keyboard(equipment_list: list[Equipment], action: st
     builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="log_cancel")) # Добавляем кнопку отмены всегда
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_readiness_toggle_keyboard(is_currently_ready: bool):
     """Создает клавиатуру для смены статуса готовности."""
     builder = InlineKeyboardBuilder()
@@ -127,17 +146,20 @@ def get_readiness_toggle_keyboard(is_currently_ready: bool):
     return builder.as_markup()
 
 # Новое меню для Диспетчера
+@lru_cache(maxsize=None)
 def get_dispatcher_menu():
     return ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text="Заступить на караул")], # <--- НОВАЯ КНОПКА
             [KeyboardButton(text="🔥 Создать новый выезд")],
             [KeyboardButton(text="📊 Активные выезды"), KeyboardButton(text="📂 Архив выездов")],
+            [KeyboardButton(text="🔎 Поиск выездов")],
             [KeyboardButton(text="Отметить отсутствующих")], # <--- Добавим сразу кнопку для будущего функционала
         ],
         resize_keyboard=True
     )
     
+@lru_cache(maxsize=ID_KEYBOARD_CACHE_SIZE)
 def get_dispatch_approval_keyboard(dispatch_order_id: int):
     """Клавиатура для утверждения/отклонения выезда НК."""
     builder = InlineKeyboardBuilder()
@@ -153,6 +175,7 @@ def get_dispatch_approval_keyboard(dispatch_order_id: int):
     return builder.as_markup()
 
 # Добавим базовое меню для НК
+@lru_cache(maxsize=None)
 def get_commander_menu():
     return ReplyKeyboardMarkup(
         keyboard=[
@@ -160,21 +183,32 @@ def get_commander_menu():
             [KeyboardButton(text="⏳ Выезды на утверждение")],
             [KeyboardButton(text="🔥 Активные выезды (все)")],
             [KeyboardButton(text="📋 Статус техники/ЛС")],
-            [KeyboardButton(text="🔧 Обслуживание снаряжения")] # <--- Добавим сразу кнопку для будущего функционала (СИЗОД в строй)
+            [KeyboardButton(text="🔧 Обслуживание снаряжения")], # <--- Добавим сразу кнопку для будущего функционала (СИЗОД в строй)
+            [KeyboardButton(text="👥 Заступление караула")],
+            [KeyboardButton(text="🔚 Закрыть караул")]
         ],
         resize_keyboard=True
     )
     
-def get_personnel_select_keyboard(employees: list[Employee], selected_ids: set[int]):
-    """Клавиатура для множественного выбора сотрудников."""
+def get_personnel_select_keyboard(employees: list[Employee], selected_ids: set[int], crews: list = ()):
+    """Клавиатура для множественного выбора сотрудников.
+
+    crews - рекомендованные экипажи (app/crew_recommendations.py): кнопка назначает
+    машину с водителем и пожарными одним нажатием.
+    """
     builder = InlineKeyboardBuilder()
+    for crew in crews:
+        priority = f"{crew.operational_priority}-й ход" if crew.operational_priority else "резерв"
+        builder.row(InlineKeyboardButton(
+            text=f"🚒 {priority}: {crew.vehicle_label}, экипаж {len(crew.employee_ids)} чел.",
+            callback_data=f"dispatch_crew_{crew.vehicle_id}"
+        ))
     for emp in employees:
         is_selected = emp.id in selected_ids
         # Отмечаем выбранных галочкой
         text = f"{'✅' if is_selected else '⬜️'} {emp.full_name} ({emp.rank})"
         # callback_data содержит ID для добавления/удаления
-        builder.button(text=text, callback_data=f"dispatch_toggle_personnel_{emp.id}")
-    builder.adjust(1) # По одному сотруднику в строке
+        builder.row(InlineKeyboardButton(text=text, callback_data=f"dispatch_toggle_personnel_{emp.id}")) # По одному сотруднику в строке
     # Добавляем кнопку "Готово" (переход к выбору техники)
     builder.row(InlineKeyboardButton(text="➡️ К выбору техники", callback_data="dispatch_personnel_done"))
     # Добавляем кнопку отмены всего процесса
@@ -194,12 +228,14 @@ def get_vehicle_select_keyboard(vehicles: list[Vehicle], selected_ids: set[int])
     builder.row(InlineKeyboardButton(text="❌ Отменить создание выезда", callback_data="dispatch_create_cancel"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_cancel_keyboard(callback_data: str = "universal_cancel"): # <-- Стандартный callback_data
     """Универсальная клавиатура с кнопкой Отмена."""
     builder = InlineKeyboardBuilder()
     builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data=callback_data))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def get_sizod_status_keyboard(callback_prefix: str = "sizod_status_start_"):
     """Клавиатура для выбора состояния СИЗОД (Исправен/Неисправен)."""
     builder = InlineKeyboardBuilder()
@@ -228,6 +264,7 @@ def get_vehicle_selection_for_shift_keyboard(vehicles: list[Vehicle]):
     builder.row(InlineKeyboardButton(text="❌ Отменить заступление", callback_data="universal_cancel"))
     return builder.as_markup()
 
+@lru_cache(maxsize=None)
 def confirm_cancel_absence_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -239,6 +276,7 @@ def confirm_cancel_absence_keyboard():
         ]
     )
     
+@lru_cache(maxsize=ID_KEYBOARD_CACHE_SIZE)
 def get_dispatch_edit_field_keyboard(dispatch_id: int):
     builder = InlineKeyboardBuilder()
     # Кнопки для каждого поля, которое можно редактировать
@@ -250,6 +288,7 @@ def get_dispatch_edit_field_keyboard(dispatch_id: int):
     builder.row(InlineKeyboardButton(text="❌ Отменить редактирование", callback_data=f"edit_dispatch_cancel_{dispatch_id}"))
     return builder.as_markup()
 
+@lru_cache(maxsize=ID_KEYBOARD_CACHE_SIZE)
 def get_confirm_cancel_edit_keyboard(dispatch_id: int): # Для подтверждения конкретного изменения
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Сохранить изменение", callback_data=f"edit_dispatch_save_change_{dispatch_id}")
@@ -257,6 +296,7 @@ def get_confirm_cancel_edit_keyboard(dispatch_id: int): # Для подтвер
     builder.adjust(2)
     return builder.as_markup()
 
+@lru_cache(maxsize=ID_KEYBOARD_CACHE_SIZE)
 def get_equipment_maintenance_action_keyboard(equipment_id: int):
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Поставить в строй (исправен)", callback_data=f"maint_action_available_{equipment_id}")
@@ -267,9 +307,23 @@ def get_equipment_maintenance_action_keyboard(equipment_id: int):
     builder.row(InlineKeyboardButton(text="❌ Отменить всё", callback_data="maint_cancel_fsm")) # Полная отмена
     return builder.as_markup()
 
+@lru_cache(maxsize=ID_KEYBOARD_CACHE_SIZE)
 def get_maintenance_confirmation_keyboard(equipment_id: int, action_to_confirm: str):
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Подтвердить действие", callback_data=f"maint_confirm_{action_to_confirm}_{equipment_id}")
     builder.button(text="❌ Отмена", callback_data=f"maint_cancel_action_{equipment_id}") # Вернуться к выбору действия для этого снаряжения
     builder.adjust(1)
-    return builder.as_markup()
\ No newline at end of file
+    return builder.as_markup()
+
+def get_equipment_for_service_keyboard(equipment_list):
+    """Список снаряжения, требующего обслуживания (для НК)."""
+    builder = InlineKeyboardBuilder()
+    for item in equipment_list:
+        status_emoji = EQUIPMENT_STATUS_EMOJI.get(item.status, '❓')
+        builder.button(
+            text=f"{status_emoji} {item.name} ({item.inventory_number or 'б/н'}) - {item.status}",
+            callback_data=f"maint_select_equip_{item.id}"
+        )
+    builder.adjust(1)
+    builder.row(InlineKeyboardButton(text="❌ Отмена", callback_data="maint_cancel_fsm"))
+    return builder.as_markup()
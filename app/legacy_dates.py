@@ -0,0 +1,179 @@
+import calendar
+import logging
+import re
+from datetime import date, datetime, time
+
+from sqlalchemy import bindparam, event, func, inspect, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from models import Equipment, Report, Trip
+from app.archive import equipment_logs_all
+
+# --- Типизированные даты вместо строк ---
+# Equipment.service_life ("2028-01-01", "01.01.2028", "5 лет"), Trip.date/time и
+# Report.created_at хранятся строками, по ним нельзя построить индекс для запросов по диапазону.
+# Рядом добавлены колонки Date/DateTime (исходный текст сохраняется):
+#   Equipment.service_life_until - срок службы до (с индексом, см. fetch_expiring_equipment),
+#   Trip.event_time, Report.creation_time.
+# migrate_legacy_dates() при старте разбирает строки, у которых типизированная колонка пуста.
+# Срок вида "5 лет" считается от первой записи журнала снаряжения (ввод в эксплуатацию);
+# если записей нет, срок остается неразобранным. Новые и измененные строки заполняются
+# событиями маппера при сохранении через ORM.
+
+_DATE_FORMATS = ("%Y-%m-%d", "%d.%m.%Y", "%d.%m.%y", "%d/%m/%Y", "%Y.%m.%d")
+_TIME_FORMATS = ("%H:%M", "%H:%M:%S", "%H.%M")
+_PERIOD_RE = re.compile(r"(\d+)\s*(лет|год|г\b|мес|дн|ден|сут)")
+_PERIOD_MONTHS = {'лет': 12, 'год': 12, 'г': 12, 'мес': 1}
+
+
+def parse_date(text: str | None) -> date | None:
+    if not text:
+        return None
+    text = text.strip()
+    for date_format in _DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    try:
+        return datetime.fromisoformat(text).date()
+    except ValueError:
+        return None
+
+
+def parse_time(text: str | None) -> time | None:
+    if not text:
+        return None
+    for time_format in _TIME_FORMATS:
+        try:
+            return datetime.strptime(text.strip(), time_format).time()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_datetime(text: str | None) -> datetime | None:
+    if not text:
+        return None
+    try:
+        return datetime.fromisoformat(text.strip())
+    except ValueError:
+        parsed_date = parse_date(text)
+        return datetime.combine(parsed_date, time()) if parsed_date else None
+
+
+def _add_months(start: date, months: int) -> date:
+    month_index = start.month - 1 + months
+    year, month = start.year + month_index // 12, month_index % 12 + 1
+    return date(year, month, min(start.day, calendar.monthrange(year, month)[1]))
+
+
+def parse_service_life(text: str | None, in_service_since: date | None) -> date | None:
+    """Дата окончания срока службы: явная дата или период ("5 лет", "6 месяцев") от in_service_since."""
+    parsed = parse_date(text)
+    if parsed or not text or in_service_since is None:
+        return parsed
+    match = _PERIOD_RE.search(text.lower())
+    if not match:
+        return None
+    amount, unit = int(match.group(1)), match.group(2)
+    if unit in _PERIOD_MONTHS:
+        return _add_months(in_service_since, amount * _PERIOD_MONTHS[unit])
+    return date.fromordinal(in_service_since.toordinal() + amount) # Дни/сутки
+
+
+async def migrate_legacy_dates(session_factory: async_sessionmaker):
+    """Заполняет типизированные колонки дат из строковых (только еще не заполненные строки)."""
+    async with session_factory() as session:
+        async with session.begin():
+            first_log_time = (
+                select(func.min(equipment_logs_all.c.timestamp))
+                .where(equipment_logs_all.c.equipment_id == Equipment.id)
+                .scalar_subquery()
+            )
+            equipment_rows = (await session.execute(
+                select(Equipment.id, Equipment.service_life, first_log_time)
+                .where(Equipment.service_life.is_not(None), Equipment.service_life_until.is_(None))
+            )).all()
+            equipment_values = [
+                {'row_id': equipment_id, 'value': until}
+                for equipment_id, service_life, first_log in equipment_rows
+                if (until := parse_service_life(service_life, first_log.date() if first_log else None))
+            ]
+
+            trip_rows = (await session.execute(
+                select(Trip.id, Trip.date, Trip.time).where(Trip.event_time.is_(None))
+            )).all()
+            trip_values = []
+            for trip_id, trip_date, trip_time in trip_rows:
+                parsed_date = parse_date(trip_date)
+                if parsed_date:
+                    trip_values.append({'row_id': trip_id, 'value': datetime.combine(parsed_date, parse_time(trip_time) or time())})
+
+            report_rows = (await session.execute(
+                select(Report.id, Report.created_at).where(Report.creation_time.is_(None))
+            )).all()
+            report_values = [
+                {'row_id': report_id, 'value': created}
+                for report_id, created_at in report_rows
+                if (created := parse_datetime(created_at))
+            ]
+
+            # Массовое обновление по первичному ключу (executemany). UPDATE на уровне таблицы:
+            # версия Equipment (version_id_col) не меняется - колонка не участвует в выдаче снаряжения
+            for column, values in (
+                (Equipment.__table__.c.service_life_until, equipment_values),
+                (Trip.__table__.c.event_time, trip_values),
+                (Report.__table__.c.creation_time, report_values),
+            ):
+                if values:
+                    await session.execute(
+                        update(column.table)
+                        .where(column.table.c.id == bindparam('row_id'))
+                        .values({column.name: bindparam('value')}),
+                        values
+                    )
+
+    unparsed = {
+        'equipment': len(equipment_rows) - len(equipment_values),
+        'trips': len(trip_rows) - len(trip_values),
+        'reports': len(report_rows) - len(report_values),
+    }
+    if equipment_values or trip_values or report_values:
+        logging.info(
+            f"Миграция дат: снаряжение {len(equipment_values)}, выезды (trips) {len(trip_values)}, "
+            f"отчеты {len(report_values)}; не разобрано {unparsed}."
+        )
+
+
+def _changed(target, attribute: str) -> bool:
+    return inspect(target).attrs[attribute].history.has_changes()
+
+
+def _on_equipment_insert(mapper, connection, target: Equipment):
+    if target.service_life_until is None:
+        # Период ("5 лет") для нового снаряжения отсчитывается от даты добавления
+        target.service_life_until = parse_service_life(target.service_life, date.today())
+
+
+def _on_equipment_update(mapper, connection, target: Equipment):
+    if _changed(target, 'service_life') and not _changed(target, 'service_life_until'):
+        target.service_life_until = parse_service_life(target.service_life, date.today())
+
+
+def _on_trip_save(mapper, connection, target: Trip):
+    if target.event_time is None or _changed(target, 'date') or _changed(target, 'time'):
+        parsed_date = parse_date(target.date)
+        target.event_time = datetime.combine(parsed_date, parse_time(target.time) or time()) if parsed_date else None
+
+
+def _on_report_save(mapper, connection, target: Report):
+    if target.creation_time is None:
+        target.creation_time = parse_datetime(target.created_at)
+
+
+event.listen(Equipment, 'before_insert', _on_equipment_insert)
+event.listen(Equipment, 'before_update', _on_equipment_update)
+for _event_name in ('before_insert', 'before_update'):
+    event.listen(Trip, _event_name, _on_trip_save)
+    event.listen(Report, _event_name, _on_report_save)
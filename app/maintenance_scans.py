@@ -0,0 +1,186 @@
+import logging
+from datetime import date, datetime, timedelta
+from functools import partial
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from models import DispatchOrder, Employee, Equipment, ShiftLog, Vehicle
+from app.outbox import enqueue_message as enqueue_outbox_message, wake_outbox_sender
+from app.scheduler import JobScheduler, get_high_water_mark, set_high_water_mark
+
+# --- Плановые проверки с дайджестом начальникам караула ---
+# Вместо ручных запросов НК получает сводку о новых проблемах:
+# - просроченный осмотр техники (Vehicle.last_check старше VEHICLE_CHECK_INTERVAL);
+# - истекающий срок службы снаряжения (Equipment.service_life_until, см. app/legacy_dates.py);
+# - смены, не закрытые через STALE_SHIFT_AFTER после начала;
+# - выезды, которые дольше PENDING_APPROVAL_ALERT_AFTER ждут утверждения.
+# Каждая проверка - диапазонный запрос по индексу: (отметка прошлого запуска, порог сейчас].
+# Порог сдвигается вместе со временем, поэтому каждая строка попадает в сводку один раз -
+# в тот запуск, когда она впервые стала просроченной. Отметка сохраняется в той же
+# транзакции, что и строки outbox со сводкой: после сбоя проверка повторится целиком.
+# Исключения, где значение может появиться уже "позади" отметки:
+# - техника без единого осмотра (last_check пуст) попадает в каждую сводку, пока ее не осмотрят;
+# - срок службы вводится и исправляется вручную, поэтому снаряжение отбирается не по отметке,
+#   а по Equipment.expiry_notified_until: сводка приходит по каждому новому значению срока.
+
+VEHICLE_CHECK_INTERVAL = timedelta(days=30)
+EQUIPMENT_EXPIRY_WARNING_DAYS = 30 # За сколько дней предупреждать об окончании срока службы
+STALE_SHIFT_AFTER = timedelta(hours=24)
+PENDING_APPROVAL_ALERT_AFTER = timedelta(minutes=15)
+DIGEST_MAX_LINES = 20
+
+COMMANDER_POSITION = "Начальник караула"
+
+# Имя задания, расписание cron, разброс запуска (секунды)
+MAINTENANCE_JOBS = (
+    ('vehicle_checks', "0 8 * * *", 300),
+    ('equipment_expiry', "5 8 * * *", 300),
+    ('stale_shifts', "*/30 * * * *", 60),
+    ('pending_approvals', "*/5 * * * *", 20),
+)
+
+
+async def _commander_chat_ids(session: AsyncSession) -> list[int]:
+    result = await session.scalars(
+        select(Employee.telegram_id).where(
+            Employee.position.ilike(COMMANDER_POSITION),
+            Employee.telegram_id.is_not(None)
+        )
+    )
+    return list(result.all())
+
+
+def _digest_text(title: str, lines: list[str]) -> str:
+    shown = lines[:DIGEST_MAX_LINES]
+    if len(lines) > len(shown):
+        shown.append(f"... и еще {len(lines) - len(shown)}")
+    return "\n".join([title, *shown])
+
+
+async def _send_digest(session: AsyncSession, title: str, lines: list[str]) -> int:
+    if not lines:
+        return 0
+    chat_ids = await _commander_chat_ids(session)
+    text = _digest_text(title, lines)
+    for chat_id in chat_ids:
+        enqueue_outbox_message(session, chat_id, text)
+    return len(chat_ids)
+
+
+async def _vehicle_check_lines(session: AsyncSession, since: str | None, until: datetime) -> list[str]:
+    query = select(Vehicle.number_plate, Vehicle.model, Vehicle.last_check).order_by(Vehicle.last_check)
+    if since is None:
+        overdue = Vehicle.last_check <= until
+    else:
+        overdue = (Vehicle.last_check > datetime.fromisoformat(since)) & (Vehicle.last_check <= until)
+    # Техника без единого осмотра - в каждой сводке (в том числе добавленная после прошлого запуска)
+    query = query.where(overdue | Vehicle.last_check.is_(None))
+    rows = (await session.execute(query)).all()
+    return [
+        f"- {number_plate} ({model or 'модель не указана'}): "
+        f"{'осмотр ' + last_check.strftime('%d.%m.%Y') if last_check else 'осмотров не было'}"
+        for number_plate, model, last_check in rows
+    ]
+
+
+async def _equipment_expiry_lines(session: AsyncSession, since: str | None, until: date) -> list[str]:
+    # Отметка since не используется: срок, введенный задним числом (уже <= отметки), тоже должен попасть в сводку
+    rows = (await session.execute(
+        select(Equipment.id, Equipment.name, Equipment.inventory_number, Equipment.service_life_until)
+        .where(
+            Equipment.service_life_until <= until,
+            Equipment.status != 'decommissioned',
+            (Equipment.expiry_notified_until.is_(None)) | (Equipment.expiry_notified_until != Equipment.service_life_until)
+        )
+        .order_by(Equipment.service_life_until)
+    )).all()
+    if rows:
+        # Отмечаем в той же транзакции, что и сводку (без изменения version: поле служебное)
+        await session.execute(
+            update(Equipment)
+            .where(Equipment.id.in_([row.id for row in rows]))
+            .values(expiry_notified_until=Equipment.service_life_until)
+            .execution_options(synchronize_session=False)
+        )
+    return [
+        f"- {name}{f' ({number})' if number else ''}: до {until_date.strftime('%d.%m.%Y')}"
+        for _equipment_id, name, number, until_date in rows
+    ]
+
+
+async def _stale_shift_lines(session: AsyncSession, since: str | None, until: datetime) -> list[str]:
+    query = (
+        select(ShiftLog.karakul_number, ShiftLog.start_time, Employee.full_name)
+        .join(Employee, Employee.id == ShiftLog.employee_id)
+        .where(ShiftLog.status == 'active', ShiftLog.start_time <= until)
+        .order_by(ShiftLog.start_time)
+    )
+    if since is not None:
+        query = query.where(ShiftLog.start_time > datetime.fromisoformat(since))
+    rows = (await session.execute(query)).all()
+    return [
+        f"- {full_name}, караул {karakul_number}: с {start_time.strftime('%d.%m.%Y %H:%M')}"
+        for karakul_number, start_time, full_name in rows
+    ]
+
+
+async def _pending_approval_lines(session: AsyncSession, since: str | None, until: datetime) -> list[str]:
+    query = (
+        select(DispatchOrder.id, DispatchOrder.address, DispatchOrder.creation_time)
+        .where(DispatchOrder.status == 'pending_approval', DispatchOrder.creation_time <= until)
+        .order_by(DispatchOrder.creation_time)
+    )
+    if since is not None:
+        query = query.where(DispatchOrder.creation_time > datetime.fromisoformat(since))
+    rows = (await session.execute(query)).all()
+    return [
+        f"- №{dispatch_id}, {address}: создан {creation_time.strftime('%d.%m %H:%M')}"
+        for dispatch_id, address, creation_time in rows
+    ]
+
+
+# Имя задания -> заголовок сводки, текущий порог, запрос строк
+_SCANS = {
+    'vehicle_checks': (
+        f"🚒 Просрочен осмотр техники (более {VEHICLE_CHECK_INTERVAL.days} дн.):",
+        lambda: datetime.now() - VEHICLE_CHECK_INTERVAL,
+        _vehicle_check_lines,
+    ),
+    'equipment_expiry': (
+        f"⏳ Срок службы снаряжения истекает (≤ {EQUIPMENT_EXPIRY_WARNING_DAYS} дн.):",
+        lambda: date.today() + timedelta(days=EQUIPMENT_EXPIRY_WARNING_DAYS),
+        _equipment_expiry_lines,
+    ),
+    'stale_shifts': (
+        f"🕒 Смены не закрыты более {int(STALE_SHIFT_AFTER.total_seconds() // 3600)} ч.:",
+        lambda: datetime.now() - STALE_SHIFT_AFTER,
+        _stale_shift_lines,
+    ),
+    'pending_approvals': (
+        f"⚠️ Выезды ждут утверждения более {int(PENDING_APPROVAL_ALERT_AFTER.total_seconds() // 60)} мин.:",
+        lambda: datetime.now() - PENDING_APPROVAL_ALERT_AFTER,
+        _pending_approval_lines,
+    ),
+}
+
+
+async def run_maintenance_scan(job_name: str, session_factory: async_sessionmaker) -> int:
+    """Одна проверка: новые строки с прошлого запуска -> сводка в outbox. Возвращает число строк."""
+    title, threshold, fetch_lines = _SCANS[job_name]
+    until = threshold()
+    async with session_factory() as session:
+        async with session.begin():
+            since = await get_high_water_mark(session, job_name)
+            lines = await fetch_lines(session, since, until)
+            recipients = await _send_digest(session, title, lines)
+            await set_high_water_mark(session, job_name, until.isoformat())
+    if lines:
+        wake_outbox_sender()
+        logging.info(f"Проверка {job_name}: найдено {len(lines)}, сводка для {recipients} НК.")
+    return len(lines)
+
+
+def register_maintenance_jobs(scheduler: JobScheduler, session_factory: async_sessionmaker):
+    for job_name, schedule, jitter_seconds in MAINTENANCE_JOBS:
+        scheduler.add_job(job_name, schedule, partial(run_maintenance_scan, job_name, session_factory), jitter_seconds)
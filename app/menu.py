@@ -7,59 +7,68 @@ from app.keyboards import (
     get_commander_menu
 )
 import logging
-async def get_driver_menu_dynamic(employee_id: int):
-    is_on_shift = await get_active_shift_for_menu(employee_id) is not None
-    shift_button_text = "Закончить караул" if is_on_shift else "Заступить на караул"
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=shift_button_text)], # <--- ДИНАМИЧЕСКАЯ КНОПКА
-            [KeyboardButton(text="Новый путевой лист")],
-            [KeyboardButton(text="📊 История поездок"), KeyboardButton(text="⛽ Учет ГСМ")],
-            [KeyboardButton(text="🛠 Тех. состояние")]
-        ],
-        resize_keyboard=True
-    )
+from app.duty_registry import is_on_duty
 
-async def get_firefighter_menu_dynamic(employee_id: int): # Уже принимает employee_id
-    # Проверка get_active_shift_for_menu уже есть и работает для кнопки "Заступить/Закончить караул"
-    is_on_shift = await get_active_shift_for_menu(employee_id) is not None 
-    shift_button_text = "Закончить караул" if is_on_shift else "Заступить на караул"
-    
-    keyboard_buttons = [
-        [KeyboardButton(text=shift_button_text)],
+# --- Меню ролей ---
+# Меню статичны, кроме первой кнопки "Заступить/Закончить караул",
+# поэтому для каждой роли заранее строятся оба варианта и отдаются готовыми.
+SHIFT_START_BUTTON_TEXT = "Заступить на караул"
+SHIFT_END_BUTTON_TEXT = "Закончить караул"
+
+_ROLE_MENU_ROWS = {
+    'driver': [
+        [KeyboardButton(text="Новый путевой лист")],
+        [KeyboardButton(text="📊 История поездок"), KeyboardButton(text="⛽ Учет ГСМ")],
+        [KeyboardButton(text="🛠 Тех. состояние")]
+    ],
+    'firefighter': [
         [KeyboardButton(text="🔥 Мои активные выезда")],
         [KeyboardButton(text="🧯 Журнал снаряжения")],
         [KeyboardButton(text="🚨 Готовность к выезду")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=keyboard_buttons, resize_keyboard=True)
+    ],
+    'dispatcher': [
+        [KeyboardButton(text="🔥 Создать новый выезд")],
+        [KeyboardButton(text="📊 Активные выезды"), KeyboardButton(text="📂 Архив выездов")],
+        [KeyboardButton(text="🔎 Поиск выездов")],
+        [KeyboardButton(text="Отметить отсутствующих")],
+        [KeyboardButton(text="📊 Отчет по выездам")],
+    ],
+    'commander': [
+        [KeyboardButton(text="⏳ Выезды на утверждение")],
+        [KeyboardButton(text="🔥 Активные выезды (все)")],
+        [KeyboardButton(text="📋 Статус техники/ЛС")],
+        [KeyboardButton(text="🔧 Обслуживание снаряжения")],
+        [KeyboardButton(text="👥 Заступление караула")],
+        [KeyboardButton(text="🔚 Закрыть караул")]
+    ],
+}
 
-async def get_dispatcher_menu_dynamic(employee_id: int): # Если эта функция у тебя в keyboards.py, модифицируй там
-    is_on_shift = await get_active_shift_for_menu(employee_id) is not None
-    shift_button_text = "Закончить караул" if is_on_shift else "Заступить на караул"
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=shift_button_text)],
-            [KeyboardButton(text="🔥 Создать новый выезд")],
-            [KeyboardButton(text="📊 Активные выезды"), KeyboardButton(text="📂 Архив выездов")],
-            [KeyboardButton(text="Отметить отсутствующих")],
-            [KeyboardButton(text="📊 Отчет по выездам")],
-        ],
-        resize_keyboard=True
-    )
-    
-async def get_commander_menu_dynamic(employee_id: int): # Если эта функция у тебя в keyboards.py, модифицируй там
-    is_on_shift = await get_active_shift_for_menu(employee_id) is not None
-    shift_button_text = "Закончить караул" if is_on_shift else "Заступить на караул"
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=shift_button_text)],
-            [KeyboardButton(text="⏳ Выезды на утверждение")],
-            [KeyboardButton(text="🔥 Активные выезды (все)")],
-            [KeyboardButton(text="📋 Статус техники/ЛС")],
-            [KeyboardButton(text="🔧 Обслуживание снаряжения")]
-        ],
+_ROLE_MENUS = {
+    (role, on_shift): ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text=SHIFT_END_BUTTON_TEXT if on_shift else SHIFT_START_BUTTON_TEXT)], *rows],
         resize_keyboard=True
     )
+    for role, rows in _ROLE_MENU_ROWS.items()
+    for on_shift in (False, True)
+}
+
+async def _is_on_shift(employee_id: int) -> bool:
+    on_duty = is_on_duty(employee_id)
+    if on_duty is None: # Реестр не загружен (например, вне run.py) - спрашиваем БД
+        on_duty = await get_active_shift_for_menu(employee_id) is not None
+    return on_duty
+
+async def get_driver_menu_dynamic(employee_id: int):
+    return _ROLE_MENUS['driver', await _is_on_shift(employee_id)]
+
+async def get_firefighter_menu_dynamic(employee_id: int):
+    return _ROLE_MENUS['firefighter', await _is_on_shift(employee_id)]
+
+async def get_dispatcher_menu_dynamic(employee_id: int):
+    return _ROLE_MENUS['dispatcher', await _is_on_shift(employee_id)]
+
+async def get_commander_menu_dynamic(employee_id: int):
+    return _ROLE_MENUS['commander', await _is_on_shift(employee_id)]
 
 async def show_role_specific_menu(message: types.Message, employee_id: int, position: str): # Принимаем employee_id
     """Показывает меню в зависимости от должности с учетом статуса караула."""
@@ -88,6 +97,6 @@ async def get_active_shift_for_menu(employee_id: int) -> ShiftLog | None:
             ShiftLog.status == 'active'
         )
         active_shift = await session.scalar(stmt)
-        logging.info(f"get_active_shift_for_menu (menu.py) for employee {employee_id}: Found active shift: {bool(active_shift)}, Shift ID: {active_shift.id if active_shift else None}")
+        logging.debug(f"get_active_shift_for_menu (menu.py) for employee {employee_id}: Found active shift: {bool(active_shift)}, Shift ID: {active_shift.id if active_shift else None}")
         return active_shift
     
@@ -0,0 +1,204 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import object_session
+
+from models import Employee, Vehicle
+from app.commit_hooks import on_commit, register_commit_applier
+
+# --- Пакетная загрузка имен сотрудников и техники (паттерн DataLoader) ---
+# Обработчик сначала собирает все ID, которые нужны для отрисовки сообщения
+# (по всем показываемым выездам), а затем загружает их одним запросом на тип сущности.
+# Изменение или удаление сотрудника/техники через ORM сбрасывает его имя в кэше после коммита;
+# правки в обход ORM (массовый UPDATE, ручное редактирование БД) видны не позже чем через NAME_CACHE_TTL_SECONDS.
+
+NAME_CACHE_MAX_SIZE = 1024 # Размер общего LRU-кэша имен (между апдейтами)
+NAME_CACHE_TTL_SECONDS = 300 # Сколько имя живет в кэше
+
+
+@dataclass(frozen=True, slots=True)
+class EmployeeName:
+    id: int
+    full_name: str
+    position: str
+    rank: str | None
+
+    def display(self) -> str:
+        return f"{self.full_name} ({self.position}, {self.rank or 'б/з'})"
+
+
+@dataclass(frozen=True, slots=True)
+class VehicleName:
+    id: int
+    model: str | None
+    number_plate: str | None
+
+    def display(self) -> str:
+        return f"{self.model} ({self.number_plate})"
+
+
+class _LRUCache:
+    """Простой LRU-кэш на OrderedDict со сроком жизни записей. Имена меняются редко, поэтому их можно держать между апдейтами."""
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict() # key -> (value, expires_at по time.monotonic)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl_seconds)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+_name_cache = _LRUCache(NAME_CACHE_MAX_SIZE, NAME_CACHE_TTL_SECONDS)
+
+
+def invalidate_name_cache(employee_id: int | None = None, vehicle_id: int | None = None):
+    """Сбрасывает кэш имен (целиком или для конкретного сотрудника/автомобиля)."""
+    if employee_id is None and vehicle_id is None:
+        _name_cache.clear()
+        return
+    if employee_id is not None:
+        _name_cache.discard(('employee', employee_id))
+    if vehicle_id is not None:
+        _name_cache.discard(('vehicle', vehicle_id))
+
+
+# События маппера срабатывают при flush: имена сбрасываются из кэша только после коммита (app/commit_hooks.py)
+_COMMIT_KEY = 'name_cache_invalidations'
+
+
+def _on_employee_changed(mapper, connection, target: Employee):
+    session = object_session(target)
+    if session is not None:
+        on_commit(session, _COMMIT_KEY, ('employee', target.id))
+
+
+def _on_vehicle_changed(mapper, connection, target: Vehicle):
+    session = object_session(target)
+    if session is not None:
+        on_commit(session, _COMMIT_KEY, ('vehicle', target.id))
+
+
+def _discard_cached_names(keys: list):
+    for key in keys:
+        _name_cache.discard(key)
+
+
+register_commit_applier(_COMMIT_KEY, _discard_cached_names)
+event.listen(Employee, 'after_update', _on_employee_changed)
+event.listen(Employee, 'after_delete', _on_employee_changed)
+event.listen(Vehicle, 'after_update', _on_vehicle_changed)
+event.listen(Vehicle, 'after_delete', _on_vehicle_changed)
+
+
+def parse_id_list(value) -> list[int]:
+    """Разбирает поле assigned_*_ids (JSON-строка или список) в список ID."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = json.loads(value) # json.JSONDecodeError пробрасывается вызывающему
+    if isinstance(value, list):
+        return value
+    logging.warning(f"Неожиданный тип для списка ID: {type(value)}")
+    return []
+
+
+class NameLoader:
+    """Загрузчик имен в пределах одного апдейта."""
+
+    def __init__(self, use_cache: bool = True):
+        self.use_cache = use_cache
+        self._wanted_employee_ids = set()
+        self._wanted_vehicle_ids = set()
+        self.employees: dict[int, EmployeeName] = {}
+        self.vehicles: dict[int, VehicleName] = {}
+
+    def want_employees(self, ids):
+        self._wanted_employee_ids.update(i for i in ids if i is not None)
+
+    def want_vehicles(self, ids):
+        self._wanted_vehicle_ids.update(i for i in ids if i is not None)
+
+    async def load(self, session: AsyncSession):
+        """Загружает все запрошенные ID: не больше одного запроса на тип сущности."""
+        missing_employee_ids = self._take_from_cache('employee', self._wanted_employee_ids, self.employees)
+        missing_vehicle_ids = self._take_from_cache('vehicle', self._wanted_vehicle_ids, self.vehicles)
+
+        if missing_employee_ids:
+            result = await session.execute(
+                select(Employee.id, Employee.full_name, Employee.position, Employee.rank)
+                .where(Employee.id.in_(missing_employee_ids))
+            )
+            for row in result.all():
+                item = EmployeeName(*row)
+                self.employees[item.id] = item
+                if self.use_cache:
+                    _name_cache.put(('employee', item.id), item)
+
+        if missing_vehicle_ids:
+            result = await session.execute(
+                select(Vehicle.id, Vehicle.model, Vehicle.number_plate)
+                .where(Vehicle.id.in_(missing_vehicle_ids))
+            )
+            for row in result.all():
+                item = VehicleName(*row)
+                self.vehicles[item.id] = item
+                if self.use_cache:
+                    _name_cache.put(('vehicle', item.id), item)
+
+        self._wanted_employee_ids.clear()
+        self._wanted_vehicle_ids.clear()
+        return self
+
+    def _take_from_cache(self, kind: str, wanted_ids: set, target: dict) -> list[int]:
+        missing = []
+        for item_id in wanted_ids:
+            if item_id in target:
+                continue
+            cached = _name_cache.get((kind, item_id)) if self.use_cache else None
+            if cached is not None:
+                target[item_id] = cached
+            else:
+                missing.append(item_id)
+        return missing
+
+    def employee(self, employee_id: int | None) -> EmployeeName | None:
+        return self.employees.get(employee_id)
+
+    def vehicle(self, vehicle_id: int | None) -> VehicleName | None:
+        return self.vehicles.get(vehicle_id)
+
+    def employees_by_name(self, ids) -> list[EmployeeName]:
+        """Найденные сотрудники из списка ID, отсортированные по ФИО."""
+        found = [self.employees[i] for i in set(ids) if i in self.employees]
+        return sorted(found, key=lambda e: e.full_name)
+
+    def vehicles_by_model(self, ids) -> list[VehicleName]:
+        """Найденная техника из списка ID, отсортированная по модели."""
+        found = [self.vehicles[i] for i in set(ids) if i in self.vehicles]
+        return sorted(found, key=lambda v: v.model or "")
@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select, update, delete, exists, func, or_, and_
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from models import OutboxMessage
+from app.circuit_breaker import CircuitOpenError, telegram_breaker
+
+# --- Исходящие уведомления через outbox ---
+# Обработчик не шлет уведомления сам: он добавляет строку outbox_messages в той же
+# транзакции, что и изменение статуса выезда. После коммита уведомление уже не потеряется
+# (даже если бот упадет), а время ответа обработчика не зависит от Telegram.
+# Фоновый отправитель забирает пачку строк одним UPDATE ... RETURNING, отправляет их
+# с ограничением параллельности и частоты, отмечает результат и повторяет неудачные
+# с экспоненциальной задержкой. Доставка "хотя бы один раз": при падении посреди пачки
+# часть сообщений может уйти повторно.
+# Outbox же служит локальной очередью на время недоступности Telegram: пока предохранитель
+# Bot API разомкнут, строки не забираются, а после замыкания отправляются по порядку.
+# Отправленные и окончательно неудачные строки старше OUTBOX_RETENTION_DAYS удаляются
+# ночным заданием purge_outbox (app/scheduler.py), чтобы таблица не росла бесконечно.
+
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_SEND_CONCURRENCY = 8          # Сколько чатов обслуживается одновременно
+OUTBOX_MESSAGES_PER_SECOND = 25      # Общий лимит Telegram - около 30 сообщений в секунду
+OUTBOX_POLL_INTERVAL_SECONDS = 2     # Проверка без сигнала wake_outbox_sender()
+OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=2) # Строки 'sending' старше этого снова берутся в работу
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE_SECONDS = 2
+OUTBOX_BACKOFF_MAX_SECONDS = 300
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "14"))
+OUTBOX_PURGE_BATCH_SIZE = 1000        # Строк за одну транзакцию (короткие блокировки записи)
+OUTBOX_PURGE_SCHEDULE = "45 3 * * *"  # Каждую ночь в 03:45, после архивации
+
+_wakeup = asyncio.Event()
+
+
+def enqueue_message(
+    session: AsyncSession,
+    chat_id: int,
+    text: str,
+    *,
+    parse_mode: str | None = None,
+    reply_markup: InlineKeyboardMarkup | None = None
+) -> OutboxMessage:
+    """Добавляет уведомление в outbox в текущей транзакции вызывающего кода."""
+    message = OutboxMessage(
+        chat_id=chat_id,
+        text=text,
+        parse_mode=parse_mode,
+        reply_markup=reply_markup.model_dump_json(exclude_none=True) if reply_markup is not None else None,
+        status='pending',
+        attempts=0,
+        next_attempt_at=datetime.now()
+    )
+    session.add(message)
+    return message
+
+
+def wake_outbox_sender():
+    """Будит отправителя сразу после коммита, не дожидаясь интервала опроса."""
+    _wakeup.set()
+
+
+telegram_breaker.add_close_listener(wake_outbox_sender) # Telegram снова доступен - отправляем накопившееся
+
+
+async def outbox_depth(session_factory: async_sessionmaker) -> int:
+    """Сколько уведомлений ждут отправки (глубина очереди)."""
+    async with session_factory() as session:
+        return await session.scalar(
+            select(func.count(OutboxMessage.id)).where(OutboxMessage.status.in_(['pending', 'sending']))
+        )
+
+
+async def purge_outbox(session_factory: async_sessionmaker, retention_days: int = OUTBOX_RETENTION_DAYS) -> int:
+    """Удаляет отправленные и окончательно неудачные уведомления старше retention_days. Возвращает число строк."""
+    horizon = datetime.now() - timedelta(days=retention_days)
+    total = 0
+    while True:
+        async with session_factory() as session:
+            async with session.begin():
+                ids = (await session.scalars(
+                    select(OutboxMessage.id)
+                    .where(OutboxMessage.status.in_(['sent', 'failed']), OutboxMessage.created_at < horizon)
+                    .limit(OUTBOX_PURGE_BATCH_SIZE)
+                )).all()
+                if ids:
+                    await session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids)))
+        total += len(ids)
+        if len(ids) < OUTBOX_PURGE_BATCH_SIZE:
+            break
+        await asyncio.sleep(0) # Даем обработчикам апдейтов выполниться между пачками
+    logging.info(f"Outbox: удалено старых уведомлений {total}.")
+    return total
+
+
+def _backoff(attempts: int) -> timedelta:
+    return timedelta(seconds=min(OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX_SECONDS))
+
+
+class _RateLimiter:
+    """Равномерно распределяет отправки: не чаще rate сообщений в секунду."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_slot = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class OutboxSender:
+    """Фоновая задача отправки уведомлений из outbox_messages."""
+
+    def __init__(self, bot: Bot, session_factory: async_sessionmaker, batch_size: int = OUTBOX_BATCH_SIZE):
+        self.bot = bot
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self._concurrency = asyncio.Semaphore(OUTBOX_SEND_CONCURRENCY)
+        self._rate_limiter = _RateLimiter(OUTBOX_MESSAGES_PER_SECOND)
+        self._task: asyncio.Task | None = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.deferred = 0 # Отложено из-за разомкнутого предохранителя
+        self._paused = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logging.info("Отправитель outbox запущен.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            if not telegram_breaker.accepting:
+                await self._pause()
+                continue
+            self._paused = False
+            try:
+                processed = await self.run_once()
+            except Exception as e:
+                logging.exception(f"Ошибка отправителя outbox: {e}")
+                processed = 0
+            if processed >= self.batch_size:
+                continue # Очередь не пуста - сразу следующая пачка
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+
+    async def _pause(self):
+        if not self._paused:
+            self._paused = True
+            try:
+                depth = await outbox_depth(self.session_factory)
+            except Exception as e:
+                depth = f"? ({e})"
+            logging.warning(f"Outbox: Bot API недоступен, отправка приостановлена; в очереди {depth}.")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+
+    async def metrics(self) -> dict:
+        """Состояние предохранителя, глубина очереди и счетчики отправки."""
+        return {
+            'breaker': telegram_breaker.metrics(),
+            'queue_depth': await outbox_depth(self.session_factory),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'deferred': self.deferred,
+        }
+
+    async def _claim_batch(self) -> list:
+        now = datetime.now()
+        claim_expired = now - OUTBOX_CLAIM_TIMEOUT
+        # Более раннее сообщение того же чата, которое ждет повтора или еще отправляется:
+        # пока оно не ушло, следующие сообщения чата не забираются (порядок внутри чата
+        # сохраняется и между пачками). Раньше срока ставшие "готовыми" попадают в ту же пачку.
+        earlier = aliased(OutboxMessage)
+        earlier_blocked = exists().where(
+            earlier.chat_id == OutboxMessage.chat_id,
+            earlier.id < OutboxMessage.id,
+            or_(
+                and_(earlier.status == 'pending', earlier.next_attempt_at > now),
+                and_(earlier.status == 'sending', earlier.claimed_at > claim_expired)
+            )
+        )
+        due_ids = (
+            select(OutboxMessage.id)
+            .where(
+                or_(
+                    and_(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= now),
+                    and_(OutboxMessage.status == 'sending', OutboxMessage.claimed_at <= claim_expired)
+                ),
+                ~earlier_blocked
+            )
+            .order_by(OutboxMessage.id)
+            .limit(self.batch_size)
+            .scalar_subquery()
+        )
+        async with self.session_factory() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(OutboxMessage)
+                    .where(OutboxMessage.id.in_(due_ids))
+                    .values(status='sending', claimed_at=now)
+                    .returning(
+                        OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.text,
+                        OutboxMessage.parse_mode, OutboxMessage.reply_markup, OutboxMessage.attempts
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                return sorted(result.all(), key=lambda row: row.id)
+
+    async def run_once(self) -> int:
+        """Одна пачка: забрать, отправить, отметить. Возвращает количество забранных строк."""
+        rows = await self._claim_batch()
+        if not rows:
+            return 0
+        # Внутри чата - по порядку создания, разные чаты - параллельно
+        by_chat: dict[int, list] = {}
+        for row in rows:
+            by_chat.setdefault(row.chat_id, []).append(row)
+        outcomes: dict[int, dict] = {}
+        await asyncio.gather(*(self._send_chat(chat_rows, outcomes) for chat_rows in by_chat.values()))
+        await self._store_outcomes(outcomes)
+        return len(rows)
+
+    async def _send_chat(self, chat_rows: list, outcomes: dict[int, dict]):
+        async with self._concurrency:
+            for index, row in enumerate(chat_rows):
+                outcome = await self._send_one(row)
+                outcomes[row.id] = outcome
+                if outcome['status'] == 'pending':
+                    # Остальные сообщения чата ждут вместе с этим, чтобы не нарушить порядок
+                    for later_row in chat_rows[index + 1:]:
+                        outcomes[later_row.id] = {'status': 'pending', 'next_attempt_at': outcome['next_attempt_at']}
+                    return
+
+    async def _send_one(self, row) -> dict:
+        await self._rate_limiter.wait()
+        attempts = row.attempts + 1
+        try:
+            await self.bot.send_message(
+                chat_id=row.chat_id,
+                text=row.text,
+                parse_mode=row.parse_mode,
+                reply_markup=InlineKeyboardMarkup.model_validate_json(row.reply_markup) if row.reply_markup else None
+            )
+        except CircuitOpenError:
+            # Telegram недоступен - сообщение остается в очереди без траты попытки
+            self.deferred += 1
+            return {'status': 'pending', 'next_attempt_at': datetime.now()}
+        except TelegramRetryAfter as e:
+            self.retried += 1
+            logging.warning(f"Outbox {row.id}: Telegram просит подождать {e.retry_after} с.")
+            return {'status': 'pending', 'next_attempt_at': datetime.now() + timedelta(seconds=e.retry_after), 'last_error': str(e)}
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Бот заблокирован/чат не найден/некорректный текст - повтор не поможет
+            self.failed += 1
+            logging.error(f"Outbox {row.id}: уведомление в чат {row.chat_id} не может быть доставлено: {e}")
+            return {'status': 'failed', 'attempts': attempts, 'last_error': str(e)}
+        except Exception as e:
+            if attempts >= OUTBOX_MAX_ATTEMPTS:
+                self.failed += 1
+                logging.error(f"Outbox {row.id}: попытки исчерпаны ({attempts}): {e}")
+                return {'status': 'failed', 'attempts': attempts, 'last_error': str(e)}
+            self.retried += 1
+            logging.warning(f"Outbox {row.id}: ошибка отправки (попытка {attempts}), повтор позже: {e}")
+            return {'status': 'pending', 'attempts': attempts, 'next_attempt_at': datetime.now() + _backoff(attempts), 'last_error': str(e)}
+        self.sent += 1
+        return {'status': 'sent'}
+
+    async def _store_outcomes(self, outcomes: dict[int, dict]):
+        sent_ids = [message_id for message_id, values in outcomes.items() if values['status'] == 'sent']
+        async with self.session_factory() as session:
+            async with session.begin():
+                if sent_ids:
+                    await session.execute(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id.in_(sent_ids))
+                        .values(status='sent', sent_at=datetime.now(), attempts=OutboxMessage.attempts + 1, claimed_at=None)
+                        .execution_options(synchronize_session=False)
+                    )
+                for message_id, values in outcomes.items():
+                    if values['status'] == 'sent':
+                        continue
+                    await session.execute(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id == message_id)
+                        .values(**values, claimed_at=None)
+                        .execution_options(synchronize_session=False)
+                    )
+        logging.info(
+            f"Outbox: пачка {len(outcomes)}; всего отправлено {self.sent}, повторов {self.retried}, ошибок {self.failed}."
+        )
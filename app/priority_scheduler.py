@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+
+# --- Приоритетное планирование апдейтов ---
+# Отчеты, история поездок и сводка статуса ЛС/техники не должны отнимать цикл событий
+# и соединение с БД у создания и утверждения выездов. Каждый апдейт относится к классу
+# приоритета; у класса есть свой предел параллельных обработчиков, плюс общий предел.
+# Освободившееся место отдается ожидающим в порядке приоритета классов.
+# При перегрузке апдейты низшего класса не ставятся в очередь, а сразу отклоняются.
+
+PRIORITY_CRITICAL = 'critical'     # Выезды: создание, утверждение/отклонение, свои активные выезды
+PRIORITY_SHIFT = 'shift'           # Смены, снаряжение, путевые листы и все остальное
+PRIORITY_BACKGROUND = 'background' # История, архив, отчеты, сводки
+
+PRIORITY_ORDER = (PRIORITY_CRITICAL, PRIORITY_SHIFT, PRIORITY_BACKGROUND)
+
+CLASS_CONCURRENCY_LIMITS = {
+    PRIORITY_CRITICAL: 8,
+    PRIORITY_SHIFT: 6,
+    PRIORITY_BACKGROUND: 2,
+}
+MAX_CONCURRENT_UPDATES = 10  # Общий предел одновременно выполняемых обработчиков
+BACKGROUND_MAX_WAITING = 8   # Больше ожидающих фоновых апдейтов - новые отклоняются
+METRICS_LOG_INTERVAL_SECONDS = 300
+QUEUE_DELAY_SAMPLES = 500    # Сколько последних задержек хранить для перцентилей
+
+SHED_TEXT = "⏳ Сервер сейчас занят оперативными задачами. Повторите запрос через минуту."
+
+CRITICAL_CALLBACK_PREFIXES = (
+    'dispatch_approve_', 'dispatch_reject_', 'dispatch_confirm', 'dispatch_create_cancel',
+    'dispatch_toggle_', 'dispatch_crew_', 'dispatch_personnel_done', 'dispatch_vehicles_done',
+    'dispatch_view_details_', 'dispatch_full_details_', 'dispatch_complete_',
+)
+CRITICAL_TEXTS = ("🔥 Создать новый выезд", "⏳ Выезды на утверждение", "🔥 Мои активные выезда", "🔥 Активные выезды (все)")
+CRITICAL_STATE_GROUPS = ('DispatchCreationStates',)
+
+BACKGROUND_CALLBACK_PREFIXES = ('trip_page_', 'dispatch_list_', 'dispatch_search_page_', 'cancel_report_generation')
+BACKGROUND_TEXTS = ("📊 История поездок", "📂 Архив выездов", "🔎 Поиск выездов", "📊 Отчет по выездам", "📋 Статус техники/ЛС", "⛽ Учет ГСМ")
+BACKGROUND_STATE_GROUPS = ('DispatchReportStates', 'DispatchSearchStates')
+
+
+def classify_update(event, raw_state: str | None = None) -> str:
+    """Класс приоритета апдейта по callback_data, тексту кнопки меню или состоянию FSM."""
+    if isinstance(event, CallbackQuery) and event.data:
+        if event.data.startswith(CRITICAL_CALLBACK_PREFIXES):
+            return PRIORITY_CRITICAL
+        if event.data.startswith(BACKGROUND_CALLBACK_PREFIXES):
+            return PRIORITY_BACKGROUND
+    elif isinstance(event, Message) and event.text:
+        if event.text in CRITICAL_TEXTS:
+            return PRIORITY_CRITICAL
+        if event.text in BACKGROUND_TEXTS:
+            return PRIORITY_BACKGROUND
+    if raw_state:
+        group = raw_state.split(':', 1)[0]
+        if group in CRITICAL_STATE_GROUPS:
+            return PRIORITY_CRITICAL
+        if group in BACKGROUND_STATE_GROUPS:
+            return PRIORITY_BACKGROUND
+    return PRIORITY_SHIFT
+
+
+class ClassStats:
+    """Метрики класса: пропущено/отклонено апдейтов и задержка в очереди."""
+
+    def __init__(self):
+        self.admitted = 0
+        self.shed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits = deque(maxlen=QUEUE_DELAY_SAMPLES)
+
+    def add_wait(self, wait: float):
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_waits.append(wait)
+
+    def snapshot(self) -> dict:
+        waits = sorted(self.recent_waits)
+        p95 = waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0
+        return {
+            'admitted': self.admitted,
+            'shed': self.shed,
+            'avg_wait_ms': round(self.total_wait / self.admitted * 1000, 1) if self.admitted else 0.0,
+            'p95_wait_ms': round(p95 * 1000, 1),
+            'max_wait_ms': round(self.max_wait * 1000, 1),
+        }
+
+
+class UpdateShed(Exception):
+    """Апдейт низшего класса отклонен из-за перегрузки."""
+
+
+class PriorityScheduler:
+    """Выдает места на выполнение обработчиков с учетом класса приоритета."""
+
+    def __init__(
+        self,
+        class_limits: dict[str, int] = CLASS_CONCURRENCY_LIMITS,
+        total_limit: int = MAX_CONCURRENT_UPDATES,
+        background_max_waiting: int = BACKGROUND_MAX_WAITING
+    ):
+        self.class_limits = dict(class_limits)
+        self.total_limit = total_limit
+        self.background_max_waiting = background_max_waiting
+        self._running = {name: 0 for name in PRIORITY_ORDER}
+        self._waiters: dict[str, deque] = {name: deque() for name in PRIORITY_ORDER}
+        self.stats = {name: ClassStats() for name in PRIORITY_ORDER}
+        self._last_metrics_log = time.monotonic()
+
+    def _can_start(self, priority: str) -> bool:
+        return (
+            self._running[priority] < self.class_limits[priority]
+            and sum(self._running.values()) < self.total_limit
+        )
+
+    def _has_waiters_ahead(self, priority: str) -> bool:
+        """Есть ли ожидающие того же или более высокого класса, которым не хватает общего предела.
+
+        Ожидающие, которые уперлись в предел своего класса, другие классы не задерживают:
+        свободное место в общем пределе им все равно не достанется.
+        """
+        for name in PRIORITY_ORDER:
+            if self._waiters[name] and self._running[name] < self.class_limits[name]:
+                return True
+            if name == priority:
+                return False
+        return False
+
+    async def acquire(self, priority: str):
+        started = time.monotonic()
+        if self._can_start(priority) and not self._has_waiters_ahead(priority):
+            self._running[priority] += 1
+            self.stats[priority].add_wait(0.0)
+            return
+
+        if priority == PRIORITY_BACKGROUND and len(self._waiters[priority]) >= self.background_max_waiting:
+            self.stats[priority].shed += 1
+            raise UpdateShed()
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(priority) # Место уже выдано, но задача отменена до начала работы
+            else:
+                self._waiters[priority].remove(waiter)
+            raise
+        self.stats[priority].add_wait(time.monotonic() - started)
+
+    def release(self, priority: str):
+        self._running[priority] -= 1
+        self._wake_waiters()
+        self._maybe_log_metrics()
+
+    def _wake_waiters(self):
+        # Проходим классы по убыванию приоритета: фоновые получают место, только если
+        # более важных ожидающих нет или их собственный предел исчерпан
+        for name in PRIORITY_ORDER:
+            waiters = self._waiters[name]
+            while waiters and self._can_start(name):
+                waiter = waiters.popleft()
+                if waiter.done():
+                    continue
+                self._running[name] += 1
+                waiter.set_result(None)
+
+    def metrics(self) -> dict:
+        """Снимок метрик по классам (в т.ч. задержка в очереди) и текущая загрузка."""
+        return {
+            name: {
+                **self.stats[name].snapshot(),
+                'running': self._running[name],
+                'waiting': len(self._waiters[name]),
+            }
+            for name in PRIORITY_ORDER
+        }
+
+    def _maybe_log_metrics(self):
+        now = time.monotonic()
+        if now - self._last_metrics_log < METRICS_LOG_INTERVAL_SECONDS:
+            return
+        self._last_metrics_log = now
+        logging.info(f"Планировщик апдейтов: {self.metrics()}")
+
+
+class PriorityMiddleware(BaseMiddleware):
+    """Inner-middleware для router.message/router.callback_query: ждет место в планировщике.
+
+    Inner, а не outer: место занимают только апдейты, для которых нашелся обработчик,
+    и только после своей очереди в чате (app/chat_ordering.py).
+    """
+
+    def __init__(self, scheduler: PriorityScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, dict[str, Any]], Awaitable[Any]],
+        event: Message | CallbackQuery,
+        data: dict[str, Any]
+    ) -> Any:
+        priority = classify_update(event, data.get('raw_state'))
+        try:
+            await self.scheduler.acquire(priority)
+        except UpdateShed:
+            logging.warning(f"Апдейт класса {priority} от {event.from_user.id} отклонен из-за перегрузки.")
+            try:
+                if isinstance(event, CallbackQuery):
+                    await event.answer(SHED_TEXT, show_alert=True)
+                else:
+                    await event.answer(SHED_TEXT)
+            except Exception as e:
+                logging.warning(f"Не удалось сообщить об отклонении апдейта: {e}")
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            self.scheduler.release(priority)
+
+
+# Общий планировщик бота (метрики: update_scheduler.metrics())
+update_scheduler = PriorityScheduler()
@@ -0,0 +1,102 @@
+import functools
+import logging
+import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# --- Бюджеты SQL-запросов для обработчиков ---
+# Максимальное количество SQL-запросов, которое обработчик может выполнить за один вызов.
+# Бюджет не должен зависеть от количества строк на странице: если обработчик начинает
+# делать запрос "на каждую строку" (N+1), счетчик выйдет за бюджет.
+HANDLER_QUERY_BUDGETS = {
+    '_generate_trip_history_page': 3,  # count + поездки + selectin автомобилей
+    '_generate_dispatch_list_page': 2, # count + выезды страницы
+    '_generate_dispatch_search_page': 2, # count + найденные выезды страницы
+    'show_confirmation_summary': 3,    # имена ЛС + номера техники + проверка повторного вызова
+    'show_full_dispatch_details': 5,   # выезд (+ поиск в архиве) + имена сотрудников + техника + текущий пользователь
+    'show_my_active_dispatches': 4,    # пользователь + выезды + имена сотрудников + техника
+}
+
+# Строгий режим (QUERY_BUDGET_STRICT=1): превышение бюджета вызывает исключение.
+# Включается при отладке и прогоне сценариев, в обычной работе только пишется предупреждение.
+STRICT_MODE = os.getenv("QUERY_BUDGET_STRICT", "0") == "1"
+
+# Стек активных счетчиков текущей задачи (вложенные обработчики считаются каждый в своем)
+_active_counters: ContextVar[tuple] = ContextVar("query_budget_counters", default=())
+_installed_engines = set()
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Обработчик выполнил больше SQL-запросов, чем объявлено в HANDLER_QUERY_BUDGETS."""
+
+
+class QueryCounter:
+    """Счетчик SQL-запросов в пределах одного вызова (одного апдейта)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.statements = []
+
+    def add(self, statement: str):
+        self.count += 1
+        self.statements.append(statement)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    for counter in _active_counters.get():
+        counter.add(statement)
+
+
+def install_query_counter(engine: AsyncEngine):
+    """Подключает подсчет запросов к движку через событие before_cursor_execute."""
+    sync_engine = engine.sync_engine
+    if id(sync_engine) in _installed_engines:
+        return
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    _installed_engines.add(id(sync_engine))
+    logging.info("Счетчик SQL-запросов подключен к движку БД.")
+
+
+@asynccontextmanager
+async def count_queries(name: str = "block"):
+    """Считает SQL-запросы внутри блока: async with count_queries() as counter: ..."""
+    counter = QueryCounter(name)
+    token = _active_counters.set(_active_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _active_counters.reset(token)
+
+
+def check_budget(counter: QueryCounter, budget: int | None = None):
+    """Сравнивает результат счетчика с бюджетом обработчика."""
+    if budget is None:
+        budget = HANDLER_QUERY_BUDGETS.get(counter.name)
+    if budget is None or counter.count <= budget:
+        return
+    message = (
+        f"Обработчик {counter.name} выполнил {counter.count} SQL-запросов при бюджете {budget}. "
+        f"Последние запросы: {counter.statements[-3:]}"
+    )
+    if STRICT_MODE:
+        raise QueryBudgetExceeded(message)
+    logging.warning(message)
+
+
+def query_budget(name: str | None = None):
+    """Декоратор для async-обработчика: считает его запросы и проверяет бюджет."""
+    def decorator(func):
+        budget_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            async with count_queries(budget_name) as counter:
+                result = await func(*args, **kwargs)
+            check_budget(counter)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,204 @@
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import DispatchOrder, Employee, Equipment, Vehicle, ShiftLog
+from app.name_loader import EmployeeName, VehicleName
+from app.archive import DispatchOrderAll
+
+# --- Read-модели для списков (только чтение) ---
+# Списки и сводки читают лишь несколько полей, поэтому вместо полных ORM-объектов
+# (с identity map и отслеживанием изменений) выбираем только нужные колонки
+# и складываем строки в легкие неизменяемые dataclass со __slots__.
+# Для изменения данных по-прежнему используются ORM-модели из models.py.
+
+
+@dataclass(frozen=True, slots=True)
+class DispatchListRow:
+    id: int
+    status: str
+    address: str
+    reason: str
+    creation_time: datetime
+    victims_count: int | None
+    fatalities_count: int | None
+
+
+@dataclass(frozen=True, slots=True)
+class EquipmentRow:
+    id: int
+    name: str
+    inventory_number: str | None
+    status: str
+
+
+@dataclass(frozen=True, slots=True)
+class ExpiringEquipmentRow:
+    id: int
+    name: str
+    inventory_number: str | None
+    status: str
+    service_life_until: date
+
+
+@dataclass(frozen=True, slots=True)
+class VehicleRow:
+    id: int
+    model: str | None
+    number_plate: str | None
+    status: str | None
+
+
+@dataclass(frozen=True, slots=True)
+class ActiveShiftRow:
+    employee_id: int
+    karakul_number: str
+    operational_priority: int | None
+    sizod_number: str | None
+    sizod_status_start: str | None
+    sizod_notes_start: str | None
+    full_name: str
+    position: str
+    rank: str | None
+    vehicle_model: str | None
+    vehicle_number_plate: str | None
+
+
+@dataclass(frozen=True, slots=True)
+class PersonnelReadinessRow:
+    id: int
+    full_name: str
+    position: str
+    rank: str | None
+    is_ready: bool
+    held_items_count: int
+
+
+async def fetch_dispatch_list_rows(
+    session: AsyncSession, statuses, limit: int, offset: int, include_archive: bool = False
+) -> list[DispatchListRow]:
+    """Страница списка выездов (по убыванию времени создания); include_archive - вместе с archive.db."""
+    source = DispatchOrderAll if include_archive else DispatchOrder
+    result = await session.execute(
+        select(
+            source.id, source.status, source.address, source.reason,
+            source.creation_time, source.victims_count, source.fatalities_count
+        )
+        .where(source.status.in_(statuses))
+        .order_by(source.creation_time.desc())
+        .limit(limit)
+        .offset(offset)
+    )
+    return [DispatchListRow(*row) for row in result.all()]
+
+
+async def fetch_equipment_for_service(session: AsyncSession) -> list[EquipmentRow]:
+    """Снаряжение, которое не доступно и не списано (т.е. требует внимания)."""
+    result = await session.execute(
+        select(Equipment.id, Equipment.name, Equipment.inventory_number, Equipment.status)
+        .where(Equipment.status.notin_(['available', 'decommissioned'])) # type: ignore
+        .order_by(Equipment.name)
+    )
+    return [EquipmentRow(*row) for row in result.all()]
+
+
+def _expiring_equipment_conditions(within_days: int, today: date | None) -> tuple:
+    due_date = (today or date.today()) + timedelta(days=within_days)
+    return Equipment.service_life_until <= due_date, Equipment.status != 'decommissioned'
+
+
+async def fetch_expiring_equipment(
+    session: AsyncSession,
+    within_days: int,
+    today: date | None = None,
+    limit: int | None = None
+) -> list[ExpiringEquipmentRow]:
+    """Снаряжение (не списанное), у которого срок службы истекает в ближайшие within_days дней или уже истек.
+
+    Диапазон service_life_until <= сегодня + within_days читается по индексу ix_equipment_service_life_until.
+    limit - только первые строки (самые ранние сроки); общее число - count_expiring_equipment.
+    """
+    result = await session.execute(
+        select(Equipment.id, Equipment.name, Equipment.inventory_number, Equipment.status, Equipment.service_life_until)
+        .where(*_expiring_equipment_conditions(within_days, today))
+        .order_by(Equipment.service_life_until)
+        .limit(limit)
+    )
+    return [ExpiringEquipmentRow(*row) for row in result.all()]
+
+
+async def count_expiring_equipment(session: AsyncSession, within_days: int, today: date | None = None) -> int:
+    """Сколько всего снаряжения попадает в fetch_expiring_equipment (без limit)."""
+    return await session.scalar(
+        select(func.count(Equipment.id)).where(*_expiring_equipment_conditions(within_days, today))
+    )
+
+
+async def fetch_vehicle_rows(session: AsyncSession, order_by_model: bool = False) -> list[VehicleRow]:
+    """Вся техника (id, модель, номер, статус)."""
+    query = select(Vehicle.id, Vehicle.model, Vehicle.number_plate, Vehicle.status)
+    if order_by_model:
+        query = query.order_by(Vehicle.model)
+    result = await session.execute(query)
+    return [VehicleRow(*row) for row in result.all()]
+
+
+async def fetch_active_shift_rows(session: AsyncSession, karakul_number: str | None = None) -> list[ActiveShiftRow]:
+    """Активные смены с данными сотрудника и автомобиля одним запросом (JOIN вместо selectinload)."""
+    query = (
+        select(
+            ShiftLog.employee_id, ShiftLog.karakul_number, ShiftLog.operational_priority,
+            ShiftLog.sizod_number, ShiftLog.sizod_status_start, ShiftLog.sizod_notes_start,
+            Employee.full_name, Employee.position, Employee.rank,
+            Vehicle.model, Vehicle.number_plate
+        )
+        .join(Employee, Employee.id == ShiftLog.employee_id)
+        .outerjoin(Vehicle, Vehicle.id == ShiftLog.vehicle_id)
+        .where(ShiftLog.status == 'active')
+        .order_by(ShiftLog.karakul_number, Employee.full_name)
+    )
+    if karakul_number:
+        query = query.where(ShiftLog.karakul_number == karakul_number)
+    result = await session.execute(query)
+    return [ActiveShiftRow(*row) for row in result.all()]
+
+
+async def fetch_personnel_readiness_rows(session: AsyncSession) -> list[PersonnelReadinessRow]:
+    """Все сотрудники с количеством числящегося за ними снаряжения (COUNT вместо загрузки списков)."""
+    held_count = (
+        select(Equipment.current_holder_id, func.count(Equipment.id).label('held_count'))
+        .where(Equipment.current_holder_id.is_not(None))
+        .group_by(Equipment.current_holder_id)
+        .subquery()
+    )
+    result = await session.execute(
+        select(
+            Employee.id, Employee.full_name, Employee.position, Employee.rank, Employee.is_ready,
+            func.coalesce(held_count.c.held_count, 0)
+        )
+        .outerjoin(held_count, held_count.c.current_holder_id == Employee.id)
+        .order_by(Employee.position, Employee.full_name)
+    )
+    return [PersonnelReadinessRow(*row) for row in result.all()]
+
+
+async def fetch_dispatch_personnel_candidates(session: AsyncSession) -> list[EmployeeName]:
+    """Готовые пожарные и водители, которых можно назначить на выезд."""
+    result = await session.execute(
+        select(Employee.id, Employee.full_name, Employee.position, Employee.rank)
+        .where(Employee.position.in_(['Пожарный', 'Водитель']), Employee.is_ready == True)
+        .order_by(Employee.full_name)
+    )
+    return [EmployeeName(*row) for row in result.all()]
+
+
+async def fetch_dispatch_vehicle_candidates(session: AsyncSession) -> list[VehicleName]:
+    """Доступная техника для назначения на выезд."""
+    result = await session.execute(
+        select(Vehicle.id, Vehicle.model, Vehicle.number_plate)
+        .where(Vehicle.status == 'available')
+        .order_by(Vehicle.model)
+    )
+    return [VehicleName(*row) for row in result.all()]
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import logging
+from datetime import datetime
+from typing import Callable
+
+from aiogram import types
+from aiogram.exceptions import TelegramBadRequest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from models import Report
+
+# --- Повторная отправка отчетов по file_id ---
+# Файл, загруженный в Telegram, можно отправлять снова по его file_id без передачи байтов.
+# Ключ реестра - хэш содержимого отчета (тип, имя файла и строки данных), а не байтов XLSX:
+# openpyxl записывает в файл время создания, поэтому байты одинаковых отчетов различаются.
+# Реестр хранится в таблице reports (модель Report) и переживает перезапуск бота.
+
+
+def report_content_hash(report_type: str, filename: str, rows: list) -> str:
+    """Хэш содержимого отчета: одинаковые данные за тот же период дают тот же хэш."""
+    payload = json.dumps([report_type, filename, rows], ensure_ascii=False, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+async def get_report_file_id(session_factory: async_sessionmaker, content_hash: str) -> str | None:
+    async with session_factory() as session:
+        return await session.scalar(
+            select(Report.telegram_file_id)
+            .where(Report.content_hash == content_hash, Report.telegram_file_id.is_not(None))
+            .order_by(Report.id.desc())
+            .limit(1)
+        )
+
+
+async def save_report_file_id(
+    session_factory: async_sessionmaker,
+    report_type: str,
+    content_hash: str,
+    file_id: str,
+    data: dict
+):
+    created = datetime.now().replace(microsecond=0)
+    async with session_factory() as session:
+        async with session.begin():
+            session.add(Report(
+                report_type=report_type,
+                data=data,
+                created_at=created.isoformat(),
+                creation_time=created,
+                content_hash=content_hash,
+                telegram_file_id=file_id
+            ))
+
+
+async def send_report_document(
+    message: types.Message,
+    session_factory: async_sessionmaker,
+    report_type: str,
+    filename: str,
+    rows: list,
+    build_file: Callable[[list], bytes],
+    caption: str,
+    data: dict | None = None
+):
+    """Отправляет отчет: по сохраненному file_id, если такой отчет уже загружался, иначе загружает файл."""
+    content_hash = report_content_hash(report_type, filename, rows)
+    file_id = await get_report_file_id(session_factory, content_hash)
+    if file_id:
+        try:
+            await message.answer_document(file_id, caption=caption)
+            logging.info(f"Отчет {report_type} ({filename}) отправлен по file_id, без повторной загрузки.")
+            return
+        except TelegramBadRequest as e:
+            logging.warning(f"Сохраненный file_id отчета {filename} не принят Telegram, загружаем заново: {e}")
+
+    file_bytes = build_file(rows)
+    sent = await message.answer_document(types.BufferedInputFile(file_bytes, filename=filename), caption=caption)
+    if sent.document is None:
+        return
+    await save_report_file_id(
+        session_factory, report_type, content_hash, sent.document.file_id,
+        {**(data or {}), 'filename': filename, 'rows': len(rows), 'size_bytes': len(file_bytes)}
+    )
+    logging.info(f"Отчет {report_type} ({filename}, {len(file_bytes)} байт) загружен, file_id сохранен.")
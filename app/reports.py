@@ -6,14 +6,18 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import StateFilter
 from sqlalchemy import select, and_
 from sqlalchemy.ext.asyncio import async_sessionmaker
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment
 
-from models import DispatchOrder, Employee, Vehicle # и другие нужные модели
+from models import Employee # и другие нужные модели
+from app.archive import DispatchOrderAll
 from app.keyboards import get_cancel_keyboard # или своя клавиатура отмены
 from app.dispatcher import STATUS_TRANSLATIONS
+from app.report_files import send_report_document
 import logging
+DISPATCH_REPORT_TYPE = 'dispatches_xlsx'
+
 # Состояния FSM для генерации отчета по выездам
 class DispatchReportStates(StatesGroup):
     CHOOSING_PERIOD = State()
@@ -75,93 +79,109 @@ async def process_dispatch_report_period(message: types.Message, state: FSMConte
 
     await message.answer("⏳ Генерирую отчет по выездам, пожалуйста, подождите...")
     
-    excel_file_bytes = await generate_dispatches_excel_report(session_factory, date_from, date_to)
+    report_rows = await fetch_dispatch_report_rows(session_factory, date_from, date_to)
 
-    if excel_file_bytes:
+    if report_rows:
         report_filename = f"Отчет_по_выездам_{date_from.strftime('%Y%m%d')}-{date_to.strftime('%Y%m%d')}.xlsx"
-        input_file = types.BufferedInputFile(excel_file_bytes, filename=report_filename)
-        await message.answer_document(input_file, caption=f"✅ Ваш отчет по выездам за период готов.")
+        # Тот же отчет (например, закрытый период, запрошенный другим НК) уходит по file_id без загрузки
+        await send_report_document(
+            message, session_factory, DISPATCH_REPORT_TYPE, report_filename, report_rows,
+            build_dispatches_excel, caption=f"✅ Ваш отчет по выездам за период готов.",
+            data={'date_from': date_from.isoformat(), 'date_to': date_to.isoformat()}
+        )
     else:
         await message.answer("Не удалось сформировать отчет или за указанный период нет данных.")
     
     await state.clear()
     
-async def generate_dispatches_excel_report(session_factory: async_sessionmaker, date_from: datetime, date_to: datetime) -> bytes | None:
+async def fetch_dispatch_report_rows(session_factory: async_sessionmaker, date_from: datetime, date_to: datetime) -> list[list]:
+    """Строки отчета по выездам за период (уже в том виде, в котором они попадут в Excel)."""
+    creator = aliased(Employee)
+    approver = aliased(Employee)
     async with session_factory() as session:
-        dispatches = await session.scalars(
-            select(DispatchOrder)
-            .options( # Жадная загрузка для уменьшения кол-ва запросов
-                selectinload(DispatchOrder.creator),
-                selectinload(DispatchOrder.approver)
+        # Выезды из основной базы и из archive.db (представление dispatch_orders_all), ФИО - JOIN
+        result = await session.execute(
+            select(
+                DispatchOrderAll.id, DispatchOrderAll.creation_time, DispatchOrderAll.address, DispatchOrderAll.reason,
+                DispatchOrderAll.status, DispatchOrderAll.approval_time, approver.full_name, DispatchOrderAll.completion_time,
+                DispatchOrderAll.victims_count, DispatchOrderAll.fatalities_count, DispatchOrderAll.details_on_casualties,
+                DispatchOrderAll.notes, creator.full_name
             )
+            .outerjoin(creator, creator.id == DispatchOrderAll.dispatcher_id)
+            .outerjoin(approver, approver.id == DispatchOrderAll.commander_id)
             .where(
                 and_( # type: ignore
-                    DispatchOrder.creation_time >= date_from,
-                    DispatchOrder.creation_time <= date_to
+                    DispatchOrderAll.creation_time >= date_from,
+                    DispatchOrderAll.creation_time <= date_to
                 )
             )
-            .order_by(DispatchOrder.creation_time.asc())
+            .order_by(DispatchOrderAll.creation_time.asc())
         )
-        dispatches_list = dispatches.all()
-
-        if not dispatches_list:
-            return None
-
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Список выездов"
-
-        # Заголовки
-        headers = [
-            "ID выезда", "Дата создания", "Время создания", "Адрес", "Причина", 
-            "Статус", "Дата утверждения НК", "ФИО НК", "Дата завершения", 
-            "Кол-во пострадавших", "Кол-во погибших", 
-            "Детали по пострадавшим/погибшим", "Общие примечания", "Диспетчер (создал)"
-        ]
-        ws.append(headers)
-        for col_num, header_title in enumerate(headers, 1): # Стилизация заголовков
-            cell = ws.cell(row=1, column=col_num)
-            cell.font = Font(bold=True)
-            cell.alignment = Alignment(horizontal="center", vertical="center")
-
-        # Данные
-        for order in dispatches_list:
-            row_data = [
-                order.id,
-                order.creation_time.strftime("%d.%m.%Y") if order.creation_time else "",
-                order.creation_time.strftime("%H:%M:%S") if order.creation_time else "",
-                order.address,
-                order.reason,
-                STATUS_TRANSLATIONS.get(order.status, order.status),
-                order.approval_time.strftime("%d.%m.%Y %H:%M") if order.approval_time else "",
-                order.approver.full_name if order.approver else "",
-                order.completion_time.strftime("%d.%m.%Y %H:%M") if order.completion_time else "",
-                order.victims_count if order.victims_count is not None else 0,
-                order.fatalities_count if order.fatalities_count is not None else 0,
-                order.details_on_casualties,
-                order.notes,
-                order.creator.full_name if order.creator else ""
-            ]
-            ws.append(row_data)
-        
-        # Автоподбор ширины колонок (примерный)
-        for col in ws.columns:
-            max_length = 0
-            column = col[0].column_letter # Получаем букву колонки
-            for cell in col:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column].width = adjusted_width
-
-        # Сохраняем в байтовый поток
-        file_stream = io.BytesIO()
-        wb.save(file_stream)
-        file_stream.seek(0) # Перемещаем указатель в начало потока
-        return file_stream.getvalue()
+        dispatches_list = result.all()
+
+    # Данные
+    report_rows = []
+    for (order_id, creation_time, address, reason, status, approval_time, approver_name, completion_time,
+         victims_count, fatalities_count, details_on_casualties, notes, creator_name) in dispatches_list:
+        report_rows.append([
+            order_id,
+            creation_time.strftime("%d.%m.%Y") if creation_time else "",
+            creation_time.strftime("%H:%M:%S") if creation_time else "",
+            address,
+            reason,
+            STATUS_TRANSLATIONS.get(status, status),
+            approval_time.strftime("%d.%m.%Y %H:%M") if approval_time else "",
+            approver_name or "",
+            completion_time.strftime("%d.%m.%Y %H:%M") if completion_time else "",
+            victims_count if victims_count is not None else 0,
+            fatalities_count if fatalities_count is not None else 0,
+            details_on_casualties,
+            notes,
+            creator_name or ""
+        ])
+    return report_rows
+
+def build_dispatches_excel(report_rows: list[list]) -> bytes:
+    """Собирает XLSX отчета по выездам из готовых строк."""
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Список выездов"
+
+    # Заголовки
+    headers = [
+        "ID выезда", "Дата создания", "Время создания", "Адрес", "Причина", 
+        "Статус", "Дата утверждения НК", "ФИО НК", "Дата завершения", 
+        "Кол-во пострадавших", "Кол-во погибших", 
+        "Детали по пострадавшим/погибшим", "Общие примечания", "Диспетчер (создал)"
+    ]
+    ws.append(headers)
+    for col_num, header_title in enumerate(headers, 1): # Стилизация заголовков
+        cell = ws.cell(row=1, column=col_num)
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal="center", vertical="center")
+
+    # Данные
+    for row_data in report_rows:
+        ws.append(row_data)
+    
+    # Автоподбор ширины колонок (примерный)
+    for col in ws.columns:
+        max_length = 0
+        column = col[0].column_letter # Получаем букву колонки
+        for cell in col:
+            try:
+                if len(str(cell.value)) > max_length:
+                    max_length = len(str(cell.value))
+            except:
+                pass
+        adjusted_width = (max_length + 2)
+        ws.column_dimensions[column].width = adjusted_width
+
+    # Сохраняем в байтовый поток
+    file_stream = io.BytesIO()
+    wb.save(file_stream)
+    file_stream.seek(0) # Перемещаем указатель в начало потока
+    return file_stream.getvalue()
 
 # Функция для регистрации хэндлеров этого модуля
 def register_reports_handlers(router: Router):
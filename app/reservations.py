@@ -0,0 +1,269 @@
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, or_, and_, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from models import ResourceReservation
+from app.commit_hooks import on_commit, register_commit_applier
+
+# --- Бронирование ЛС и техники при создании выезда ---
+# Пока диспетчер выбирает состав, выбранные сотрудники и техника получают мягкую бронь
+# с ограниченным сроком: другие диспетчеры их не видят и не могут выбрать.
+# При подтверждении выезда бронь атомарно (в одной транзакции с созданием DispatchOrder)
+# становится жесткой и привязывается к выезду; при отмене, отклонении НК, завершении
+# выезда или истечении срока - снимается. Рабочая таблица держится в памяти (проверки O(1) без запросов),
+# таблица resource_reservations в БД нужна для восстановления после перезапуска.
+# Рассчитано на один процесс бота.
+
+RESOURCE_EMPLOYEE = 'employee'
+RESOURCE_VEHICLE = 'vehicle'
+
+SOFT_CLAIM_TTL = timedelta(minutes=10) # Сколько держится выбор, пока диспетчер заполняет выезд
+# Жесткая бронь снимается при отклонении или завершении выезда. Срок - страховка для выездов,
+# которые забыли завершить, чтобы ЛС и техника не блокировались навсегда.
+HARD_ASSIGNMENT_TTL = timedelta(hours=12)
+
+
+@dataclass(slots=True)
+class Reservation:
+    owner_telegram_id: int
+    dispatch_id: int | None
+    expires_at: datetime
+
+
+_reservations: dict[tuple[str, int], Reservation] = {}
+_COMMIT_KEY = 'dispatch_reservations' # Брони выезда в еще не зафиксированной транзакции (app/commit_hooks.py)
+
+
+def _get_active(key: tuple[str, int], now: datetime) -> Reservation | None:
+    reservation = _reservations.get(key)
+    if reservation is not None and reservation.expires_at <= now:
+        del _reservations[key] # Истекшая бронь - ресурс снова свободен
+        return None
+    return reservation
+
+
+async def warm_reservations(session_factory: async_sessionmaker):
+    """Загружает действующие брони из БД, истекшие удаляет (вызывается при старте бота)."""
+    now = datetime.now()
+    async with session_factory() as session:
+        async with session.begin():
+            await session.execute(delete(ResourceReservation).where(ResourceReservation.expires_at <= now))
+            result = await session.execute(
+                select(
+                    ResourceReservation.resource_type, ResourceReservation.resource_id,
+                    ResourceReservation.owner_telegram_id, ResourceReservation.dispatch_id,
+                    ResourceReservation.expires_at
+                )
+            )
+            rows = result.all()
+    _reservations.clear()
+    for resource_type, resource_id, owner_telegram_id, dispatch_id, expires_at in rows:
+        _reservations[(resource_type, resource_id)] = Reservation(owner_telegram_id, dispatch_id, expires_at)
+    logging.info(f"Брони ЛС/техники загружены: {len(_reservations)}.")
+
+
+def is_available(resource_type: str, resource_id: int, owner_telegram_id: int) -> bool:
+    """Свободен ли ресурс для этого диспетчера (не забронирован другим и не назначен на выезд)."""
+    reservation = _get_active((resource_type, resource_id), datetime.now())
+    return reservation is None or (reservation.dispatch_id is None and reservation.owner_telegram_id == owner_telegram_id)
+
+
+async def claim(session_factory: async_sessionmaker, resource_type: str, resource_id: int, owner_telegram_id: int) -> bool:
+    """Мягкая бронь ресурса за диспетчером. False - ресурс уже занят."""
+    key = (resource_type, resource_id)
+    now = datetime.now()
+    current = _get_active(key, now)
+    if current is not None and (current.dispatch_id is not None or current.owner_telegram_id != owner_telegram_id):
+        return False
+
+    # Занимаем в памяти до первого await, чтобы параллельный апдейт увидел бронь
+    reservation = Reservation(owner_telegram_id, None, now + SOFT_CLAIM_TTL)
+    _reservations[key] = reservation
+    try:
+        async with session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(ResourceReservation).where(
+                        ResourceReservation.resource_type == resource_type,
+                        ResourceReservation.resource_id == resource_id,
+                        or_(
+                            ResourceReservation.expires_at <= now,
+                            and_(
+                                ResourceReservation.owner_telegram_id == owner_telegram_id,
+                                ResourceReservation.dispatch_id.is_(None)
+                            )
+                        )
+                    )
+                )
+                await session.execute(
+                    insert(ResourceReservation).values(
+                        resource_type=resource_type, resource_id=resource_id,
+                        owner_telegram_id=owner_telegram_id, expires_at=reservation.expires_at
+                    )
+                )
+    except IntegrityError:
+        logging.warning(f"Бронь {key} уже есть в БД у другого владельца.")
+        if _reservations.get(key) is reservation:
+            del _reservations[key]
+        return False
+    except Exception as e:
+        logging.exception(f"Ошибка сохранения брони {key}: {e}")
+        if _reservations.get(key) is reservation:
+            del _reservations[key]
+        return False
+    return True
+
+
+async def claim_many(
+    session_factory: async_sessionmaker,
+    keys: list[tuple[str, int]],
+    owner_telegram_id: int
+) -> set[tuple[str, int]]:
+    """Мягкая бронь нескольких ресурсов одной транзакцией (экипаж целиком).
+
+    Занятые другими ресурсы пропускаются. Возвращает ресурсы, которые теперь за диспетчером
+    (включая выбранные им раньше).
+    """
+    now = datetime.now()
+    held, new_keys = set(), []
+    for key in dict.fromkeys(keys):
+        current = _get_active(key, now)
+        if current is None:
+            new_keys.append(key)
+        elif current.dispatch_id is None and current.owner_telegram_id == owner_telegram_id:
+            held.add(key)
+    if not new_keys:
+        return held
+
+    # Как в claim: сначала в памяти, до первого await
+    reservation = Reservation(owner_telegram_id, None, now + SOFT_CLAIM_TTL)
+    for key in new_keys:
+        _reservations[key] = reservation
+    try:
+        async with session_factory() as session:
+            async with session.begin():
+                await session.execute(
+                    delete(ResourceReservation).where(
+                        tuple_(ResourceReservation.resource_type, ResourceReservation.resource_id).in_(new_keys),
+                        ResourceReservation.expires_at <= now
+                    )
+                )
+                await session.execute(insert(ResourceReservation), [
+                    dict(
+                        resource_type=resource_type, resource_id=resource_id,
+                        owner_telegram_id=owner_telegram_id, expires_at=reservation.expires_at
+                    )
+                    for resource_type, resource_id in new_keys
+                ])
+    except Exception as e:
+        if isinstance(e, IntegrityError):
+            logging.warning(f"Часть броней {new_keys} уже есть в БД у другого владельца.")
+        else:
+            logging.exception(f"Ошибка сохранения броней {new_keys}: {e}")
+        for key in new_keys:
+            if _reservations.get(key) is reservation:
+                del _reservations[key]
+        return held # Транзакция откатилась целиком - новых броней нет
+    return held | set(new_keys)
+
+
+async def release(session_factory: async_sessionmaker, resource_type: str, resource_id: int, owner_telegram_id: int):
+    """Снимает мягкую бронь диспетчера с одного ресурса."""
+    key = (resource_type, resource_id)
+    reservation = _reservations.get(key)
+    if reservation is not None and reservation.dispatch_id is None and reservation.owner_telegram_id == owner_telegram_id:
+        del _reservations[key]
+    async with session_factory() as session:
+        async with session.begin():
+            await session.execute(
+                delete(ResourceReservation).where(
+                    ResourceReservation.resource_type == resource_type,
+                    ResourceReservation.resource_id == resource_id,
+                    ResourceReservation.owner_telegram_id == owner_telegram_id,
+                    ResourceReservation.dispatch_id.is_(None)
+                )
+            )
+
+
+async def release_owner(session_factory: async_sessionmaker, owner_telegram_id: int):
+    """Снимает все мягкие брони диспетчера (отмена создания выезда)."""
+    for key in [k for k, r in _reservations.items() if r.dispatch_id is None and r.owner_telegram_id == owner_telegram_id]:
+        del _reservations[key]
+    async with session_factory() as session:
+        async with session.begin():
+            await session.execute(
+                delete(ResourceReservation).where(
+                    ResourceReservation.owner_telegram_id == owner_telegram_id,
+                    ResourceReservation.dispatch_id.is_(None)
+                )
+            )
+
+
+async def assign_to_dispatch(
+    session: AsyncSession,
+    owner_telegram_id: int,
+    dispatch_id: int,
+    resources: dict[str, list[int]]
+) -> list[tuple[str, int]]:
+    """Превращает брони диспетчера в жесткие брони выезда в транзакции вызывающего кода.
+
+    Возвращает список ресурсов, которые уже заняты другими (тогда ничего не меняется
+    и вызывающий код должен откатить транзакцию). Таблица в памяти меняется только после
+    коммита этой транзакции; до коммита ресурсы остаются мягкой бронью диспетчера, и
+    другие диспетчеры их по-прежнему не видят. При откате память не меняется.
+    """
+    now = datetime.now()
+    keys = [(resource_type, resource_id) for resource_type, ids in resources.items() for resource_id in ids]
+    lost = [key for key in keys if not is_available(key[0], key[1], owner_telegram_id)]
+    if lost:
+        return lost
+
+    expires_at = now + HARD_ASSIGNMENT_TTL
+    await session.execute(
+        delete(ResourceReservation).where(
+            or_(
+                and_(ResourceReservation.owner_telegram_id == owner_telegram_id, ResourceReservation.dispatch_id.is_(None)),
+                ResourceReservation.expires_at <= now
+            )
+        )
+    )
+    if keys:
+        await session.execute(insert(ResourceReservation), [
+            dict(
+                resource_type=resource_type, resource_id=resource_id,
+                owner_telegram_id=owner_telegram_id, dispatch_id=dispatch_id, expires_at=expires_at
+            )
+            for resource_type, resource_id in keys
+        ])
+    on_commit(session, _COMMIT_KEY, (owner_telegram_id, dispatch_id, keys, expires_at))
+    return []
+
+
+def _apply_committed_assignments(assignments: list):
+    for owner_telegram_id, dispatch_id, keys, expires_at in assignments:
+        for key in [k for k, r in _reservations.items() if r.dispatch_id is None and r.owner_telegram_id == owner_telegram_id]:
+            del _reservations[key] # Невыбранные в итоге ресурсы освобождаются
+        for key in keys:
+            _reservations[key] = Reservation(owner_telegram_id, dispatch_id, expires_at)
+
+
+register_commit_applier(_COMMIT_KEY, _apply_committed_assignments)
+
+
+def forget_dispatch(dispatch_id: int):
+    """Убирает из памяти жесткие брони выезда (без изменения БД)."""
+    for key in [k for k, r in _reservations.items() if r.dispatch_id == dispatch_id]:
+        del _reservations[key]
+
+
+async def release_dispatch(session_factory: async_sessionmaker, dispatch_id: int):
+    """Освобождает ЛС и технику выезда (выезд отклонен, отменен или завершен)."""
+    forget_dispatch(dispatch_id)
+    async with session_factory() as session:
+        async with session.begin():
+            await session.execute(delete(ResourceReservation).where(ResourceReservation.dispatch_id == dispatch_id))
+    logging.info(f"Брони ЛС/техники выезда {dispatch_id} сняты.")
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import JobHighWaterMark
+
+# --- Фоновые задания по расписанию ---
+# Расписание задается в формате cron из пяти полей: "минута час день месяц день_недели"
+# (поддерживаются *, списки "1,15", диапазоны "1-5" и шаг "*/10", "8-18/2";
+# день недели 0-7, 0 и 7 - воскресенье). Каждое задание крутится в своей задаче asyncio:
+# - к времени запуска добавляется случайная задержка до jitter секунд, чтобы задания
+#   с одинаковым расписанием не били в базу одновременно;
+# - выполнение однопоточное (single-flight): следующий запуск считается от момента
+#   окончания предыдущего, пропущенные за время долгого выполнения запуски не копятся,
+#   а run_now() не запускает задание, которое уже выполняется.
+# Отметка "обработано до" (high-water mark) инкрементальных заданий хранится в таблице
+# job_high_water_marks и меняется в той же транзакции, что и результат задания.
+
+_CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 7))
+_CRON_SEARCH_LIMIT = timedelta(days=366 * 5) # Защита от расписаний без совпадений ("0 0 31 2 *")
+_CRON_RETRY_DELAY = 3600 # Секунд до повторного расчета, если время запуска не найдено
+
+
+def _parse_cron_field(text: str, low: int, high: int) -> frozenset[int]:
+    values = set()
+    for part in text.split(','):
+        values_range, _, step_text = part.partition('/')
+        step = int(step_text) if step_text else 1
+        if values_range == '*':
+            start, end = low, high
+        elif '-' in values_range:
+            start, end = (int(value) for value in values_range.split('-', 1))
+        else:
+            start = int(values_range)
+            end = high if step_text else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"Значение '{part}' вне диапазона {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+@dataclass(frozen=True)
+class CronSpec:
+    """Разобранное расписание cron."""
+    text: str
+    minute: frozenset[int]
+    hour: frozenset[int]
+    day: frozenset[int]
+    month: frozenset[int]
+    weekday: frozenset[int]
+    any_day: bool
+    any_weekday: bool
+
+    @classmethod
+    def parse(cls, text: str) -> 'CronSpec':
+        parts = text.split()
+        if len(parts) != len(_CRON_FIELDS):
+            raise ValueError(f"Расписание '{text}': нужно {len(_CRON_FIELDS)} полей")
+        values = {name: _parse_cron_field(part, low, high) for part, (name, low, high) in zip(parts, _CRON_FIELDS)}
+        values['weekday'] = frozenset(weekday % 7 for weekday in values['weekday'])
+        # Как в cron: поле, начинающееся с '*' ("*", "*/2"), не ограничивает день
+        return cls(text=text, any_day=parts[2].startswith('*'), any_weekday=parts[4].startswith('*'), **values)
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.day
+        weekday_ok = (moment.isoweekday() % 7) in self.weekday
+        # Как в cron: если ограничены и число, и день недели - достаточно одного из них
+        if not self.any_day and not self.any_weekday:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, moment: datetime) -> datetime:
+        """Ближайшее время запуска строго позже moment (с точностью до минуты)."""
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        deadline = candidate + _CRON_SEARCH_LIMIT
+        # Проматываем целыми месяцами/днями/часами, пока поле не совпадет
+        while candidate < deadline:
+            if candidate.month not in self.month:
+                year, month = (candidate.year + 1, 1) if candidate.month == 12 else (candidate.year, candidate.month + 1)
+                candidate = candidate.replace(year=year, month=month, day=1, hour=0, minute=0)
+                continue
+            if not self._day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if candidate.hour not in self.hour:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+                continue
+            if candidate.minute not in self.minute:
+                candidate += timedelta(minutes=1)
+                continue
+            return candidate
+        raise ValueError(f"Расписание '{self.text}' не срабатывает никогда")
+
+
+@dataclass
+class ScheduledJob:
+    name: str
+    spec: CronSpec
+    run: Callable[[], Awaitable[object]]
+    jitter_seconds: float = 0
+    running: bool = False
+    next_run_at: datetime | None = None
+    last_started_at: datetime | None = None
+    last_duration_seconds: float | None = None
+    last_error: str | None = None
+    runs: int = 0
+    failures: int = 0
+    skipped: int = 0 # Запуски, пропущенные из-за еще идущего выполнения
+    _lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False)
+
+
+class JobScheduler:
+    """Запускает зарегистрированные задания по расписанию cron."""
+
+    def __init__(self):
+        self._jobs: dict[str, ScheduledJob] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def add_job(self, name: str, schedule: str, run: Callable[[], Awaitable[object]], jitter_seconds: float = 0):
+        if name in self._jobs:
+            raise ValueError(f"Задание '{name}' уже зарегистрировано")
+        self._jobs[name] = ScheduledJob(name, CronSpec.parse(schedule), run, jitter_seconds)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._job_loop(job)) for job in self._jobs.values()]
+        logging.info(f"Планировщик заданий запущен: {', '.join(f'{job.name} ({job.spec.text})' for job in self._jobs.values())}.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run_now(self, name: str) -> bool:
+        """Выполняет задание вне расписания. False - задание уже выполняется."""
+        return await self._execute(self._jobs[name])
+
+    async def _job_loop(self, job: ScheduledJob):
+        while True:
+            now = datetime.now()
+            try:
+                job.next_run_at = job.spec.next_after(now)
+            except ValueError as e:
+                # Задача не должна завершаться молча: пишем ошибку и пробуем позже
+                job.next_run_at = None
+                job.last_error = str(e)
+                logging.error(f"Задание {job.name}: не удалось рассчитать время запуска: {e}")
+                await asyncio.sleep(_CRON_RETRY_DELAY)
+                continue
+            delay = (job.next_run_at - now).total_seconds() + random.uniform(0, job.jitter_seconds)
+            await asyncio.sleep(delay)
+            await self._execute(job)
+
+    async def _execute(self, job: ScheduledJob) -> bool:
+        if job._lock.locked():
+            job.skipped += 1
+            logging.warning(f"Задание {job.name}: предыдущий запуск еще выполняется, запуск пропущен.")
+            return False
+        async with job._lock:
+            job.running = True
+            job.last_started_at = datetime.now()
+            started = asyncio.get_running_loop().time()
+            try:
+                await job.run()
+                job.last_error = None
+            except Exception as e:
+                job.failures += 1
+                job.last_error = str(e)
+                logging.exception(f"Ошибка задания {job.name}: {e}")
+            finally:
+                job.runs += 1
+                job.running = False
+                job.last_duration_seconds = asyncio.get_running_loop().time() - started
+        return True
+
+    def metrics(self) -> dict:
+        return {
+            job.name: {
+                'schedule': job.spec.text,
+                'running': job.running,
+                'next_run_at': job.next_run_at,
+                'last_started_at': job.last_started_at,
+                'last_duration_seconds': job.last_duration_seconds,
+                'last_error': job.last_error,
+                'runs': job.runs,
+                'failures': job.failures,
+                'skipped': job.skipped,
+            }
+            for job in self._jobs.values()
+        }
+
+
+# Общий планировщик (задания регистрируются в run.py)
+job_scheduler = JobScheduler()
+
+
+async def get_high_water_mark(session: AsyncSession, job_name: str) -> str | None:
+    mark = await session.get(JobHighWaterMark, job_name)
+    return mark.value if mark else None
+
+
+async def set_high_water_mark(session: AsyncSession, job_name: str, value: str):
+    """Сохраняет отметку в транзакции вызывающего кода (вместе с результатом задания)."""
+    mark = await session.get(JobHighWaterMark, job_name)
+    if mark is None:
+        session.add(JobHighWaterMark(job_name=job_name, value=value, updated_at=datetime.now()))
+    else:
+        mark.value = value
+        mark.updated_at = datetime.now()
@@ -0,0 +1,177 @@
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from sqlalchemy import exists, func, select, tuple_, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import aliased
+
+from models import Employee, Equipment, ShiftLog, Vehicle
+from app.duty_registry import mark_off_duty
+from app.equipment_checkout import add_equipment_logs
+from app.outbox import enqueue_message as enqueue_outbox_message, wake_outbox_sender
+
+# --- Массовое закрытие смен ---
+# Смены, которые не закрыли кнопкой "Закончить караул", остаются 'active' навсегда: держат
+# технику и СИЗОД занятыми и попадают во все выборки заступивших. Здесь все смены караула
+# (по команде НК) или все смены старше SHIFT_MAX_DURATION (фоновое задание) закрываются
+# одной транзакцией из нескольких операторов над множествами, а не по одной смене:
+# 1. UPDATE shift_logs ... RETURNING - закрытие смен с причиной в end_reason;
+# 2. UPDATE equipment - сдача СИЗОД, которые все еще числятся за этими сотрудниками
+#    (как finalize_firefighter_shift_end, но состояние при сдаче не проверено - в обслуживание);
+# 3. UPDATE vehicles - машины снова 'available', если на них нет другой активной смены;
+# 4. INSERT equipment_logs (executemany) - запись о сдаче СИЗОД для журнала снаряжения;
+# 5. уведомления сотрудникам через outbox.
+# После коммита сотрудники убираются из реестра заступивших.
+
+SHIFT_MAX_DURATION = timedelta(hours=36) # Караул - сутки, плюс запас на пересменку
+SHIFT_CLOSURE_SCHEDULE = "15 * * * *"     # Проверка раз в час (app/scheduler.py)
+AUTO_RETURNED_SIZOD_STATUS = 'maintenance' # Состояние СИЗОД при сдаче никто не проверил
+
+END_REASON_KARAKUL_CLOSED = 'karakul_closed'   # Закрыты НК вместе со всем караулом
+END_REASON_MAX_DURATION = 'max_duration'       # Закрыты автоматически по длительности
+
+_END_REASON_TEXT = {
+    END_REASON_KARAKUL_CLOSED: "караул закрыт начальником караула",
+    END_REASON_MAX_DURATION: f"смена длилась более {int(SHIFT_MAX_DURATION.total_seconds() // 3600)} часов",
+}
+
+
+@dataclass
+class ShiftClosureResult:
+    shift_ids: list[int] = field(default_factory=list)
+    employee_ids: list[int] = field(default_factory=list)
+    released_vehicle_ids: list[int] = field(default_factory=list)
+    returned_equipment_ids: list[int] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.shift_ids)
+
+
+async def close_shifts(
+    session_factory: async_sessionmaker,
+    *,
+    karakul_number: str | None = None,
+    started_before: datetime | None = None,
+    end_reason: str,
+    closed_by_employee_id: int | None = None
+) -> ShiftClosureResult:
+    """Закрывает активные смены караула karakul_number и/или начатые раньше started_before."""
+    if karakul_number is None and started_before is None:
+        raise ValueError("Нужно указать karakul_number или started_before.")
+    conditions = [ShiftLog.status == 'active']
+    if karakul_number is not None:
+        conditions.append(ShiftLog.karakul_number == karakul_number)
+    if started_before is not None:
+        conditions.append(ShiftLog.start_time < started_before)
+
+    now = datetime.now()
+    result = ShiftClosureResult()
+    returned_holders: set[tuple[str, int]] = set()
+    async with session_factory() as session:
+        async with session.begin():
+            closed = (await session.execute(
+                update(ShiftLog)
+                .where(*conditions)
+                .values(status='completed', end_time=now, end_reason=end_reason)
+                .returning(ShiftLog.id, ShiftLog.employee_id, ShiftLog.karakul_number, ShiftLog.vehicle_id, ShiftLog.sizod_number)
+                .execution_options(synchronize_session=False)
+            )).all()
+            if not closed:
+                return result
+            result.shift_ids = [row.id for row in closed]
+            result.employee_ids = sorted({row.employee_id for row in closed})
+
+            # СИЗОД: снимаются только те, что все еще числятся за сотрудником закрытой смены.
+            # Первый UPDATE уже взял блокировку записи SQLite, так что между SELECT и UPDATE никто не вмешается
+            shift_by_holder = {(row.sizod_number, row.employee_id): row for row in closed if row.sizod_number}
+            if shift_by_holder:
+                held = (await session.execute(
+                    select(Equipment.id, Equipment.inventory_number, Equipment.current_holder_id)
+                    .where(
+                        Equipment.type == 'СИЗОД',
+                        tuple_(Equipment.inventory_number, Equipment.current_holder_id).in_(list(shift_by_holder))
+                    )
+                )).all()
+                if held:
+                    await session.execute(
+                        update(Equipment)
+                        .where(Equipment.id.in_([equipment_id for equipment_id, _number, _holder in held]))
+                        .values(status=AUTO_RETURNED_SIZOD_STATUS, current_holder_id=None, version=Equipment.version + 1)
+                        .execution_options(synchronize_session=False)
+                    )
+                result.returned_equipment_ids = [equipment_id for equipment_id, _number, _holder in held]
+                returned_holders = {(number, holder_id) for _equipment_id, number, holder_id in held}
+                await add_equipment_logs(session, [
+                    {
+                        'employee_id': holder_id,
+                        'equipment_id': equipment_id,
+                        'action': 'returned',
+                        'timestamp': now,
+                        'notes': (
+                            f"Сдан при закрытии караула №{shift_by_holder[(number, holder_id)].karakul_number} "
+                            f"({_END_REASON_TEXT.get(end_reason, end_reason)}). Состояние не проверено."
+                        ),
+                        'shift_log_id': shift_by_holder[(number, holder_id)].id,
+                    }
+                    for equipment_id, number, holder_id in held
+                ])
+
+            # Техника: свободна, если ее не держит другая (еще активная) смена
+            vehicle_ids = {row.vehicle_id for row in closed if row.vehicle_id is not None}
+            if vehicle_ids:
+                other_shift = aliased(ShiftLog)
+                released = await session.scalars(
+                    update(Vehicle)
+                    .where(
+                        Vehicle.id.in_(vehicle_ids),
+                        ~exists().where(other_shift.vehicle_id == Vehicle.id, other_shift.status == 'active')
+                    )
+                    .values(status='available')
+                    .returning(Vehicle.id)
+                    .execution_options(synchronize_session=False)
+                )
+                result.released_vehicle_ids = list(released.all())
+
+            # Уведомления сотрудникам - в той же транзакции
+            chat_ids = dict((await session.execute(
+                select(Employee.id, Employee.telegram_id)
+                .where(Employee.id.in_(result.employee_ids), Employee.telegram_id.is_not(None))
+            )).all())
+            for row in closed:
+                if row.employee_id in chat_ids:
+                    enqueue_outbox_message(
+                        session, chat_ids[row.employee_id],
+                        f"ℹ️ Ваш караул №{row.karakul_number} завершен: "
+                        f"{_END_REASON_TEXT.get(end_reason, end_reason)}."
+                        + (f"\nСИЗОД №{row.sizod_number} отмечен сданным и направлен на проверку." if (row.sizod_number, row.employee_id) in returned_holders else "")
+                    )
+
+    for employee_id in result.employee_ids:
+        mark_off_duty(employee_id)
+    wake_outbox_sender()
+    logging.info(
+        f"Массовое закрытие смен ({end_reason}, караул {karakul_number}, начаты до {started_before}, "
+        f"инициатор {closed_by_employee_id}): смен {len(result.shift_ids)}, "
+        f"СИЗОД сдано {len(result.returned_equipment_ids)}, техники освобождено {len(result.released_vehicle_ids)}."
+    )
+    return result
+
+
+async def close_stale_shifts(session_factory: async_sessionmaker) -> ShiftClosureResult:
+    """Фоновое задание: закрывает смены длиннее SHIFT_MAX_DURATION."""
+    return await close_shifts(
+        session_factory, started_before=datetime.now() - SHIFT_MAX_DURATION, end_reason=END_REASON_MAX_DURATION
+    )
+
+
+async def fetch_active_karakul_counts(session_factory: async_sessionmaker) -> list[tuple[str, int]]:
+    """Караулы с активными сменами и число заступивших (для выбора караула к закрытию)."""
+    async with session_factory() as session:
+        result = await session.execute(
+            select(ShiftLog.karakul_number, func.count())
+            .where(ShiftLog.status == 'active')
+            .group_by(ShiftLog.karakul_number)
+            .order_by(ShiftLog.karakul_number)
+        )
+        return [tuple(row) for row in result.all()]
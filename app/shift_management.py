@@ -8,6 +8,9 @@ import logging
 import asyncio
 from models import async_session, Employee, ShiftLog, Vehicle, Equipment, EquipmentLog
 from app.keyboards import get_cancel_keyboard, get_sizod_status_keyboard, get_vehicle_selection_for_shift_keyboard
+from app.duty_registry import mark_on_duty, mark_off_duty
+from app.equipment_checkout import claim_equipment, release_equipment, get_equipment_state
+from app.inventory_index import inventory_index
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove  # Для клавиатуры "Пропустить"
 from sqlalchemy.ext.asyncio import async_sessionmaker
 # --- Состояния FSM для Заступления на Караул ---
@@ -216,6 +219,7 @@ async def process_karakul_number(message: types.Message, state: FSMContext, sess
                     session.add(new_shift)
                     logging.info(f"SRV_DEBUG: process_karakul_number (OTHER): ShiftLog ADDED to session. Pending commit.")
                 logging.info(f"SRV_DEBUG: process_karakul_number (OTHER): Transaction block COMMITTED/ROLLBACKED.")
+                mark_on_duty(employee_id_for_menu, karakul_number, start_time=_start_time)
 
                 await message.answer(
                     f"✅ Вы успешно заступили на караул №{karakul_number} ({_start_time.strftime('%d.%m.%Y %H:%M')}).",
@@ -245,8 +249,52 @@ async def process_sizod_number_input(message: types.Message, state: FSMContext):
     if not sizod_number:
         await message.answer("Номер СИЗОД не может быть пустым...", reply_markup=get_cancel_keyboard())
         return
+    # Проверяем номер по индексу в памяти сразу, а не в конце заступления
+    if inventory_index.loaded:
+        item = inventory_index.find_exact(sizod_number, equipment_type='СИЗОД')
+        if item is None:
+            suggestions = [found.inventory_number for found in inventory_index.suggest(sizod_number, equipment_type='СИЗОД')]
+            await state.update_data(sizod_typed=sizod_number, sizod_suggestions=suggestions)
+            logging.info(f"Пожарный {message.from_user.id}: СИЗОД '{sizod_number}' не найден, предложено {suggestions}")
+            prompt = "Возможно, вы имели в виду:" if suggestions else "Проверьте номер и введите его снова."
+            await message.answer(
+                f"СИЗОД с номером «{sizod_number}» не найден. {prompt}",
+                reply_markup=_sizod_suggestions_keyboard(suggestions)
+            )
+            return
+        sizod_number = item.inventory_number # Номер в том виде, как он записан в БД ("с-12" -> "S-0012")
+    await _accept_sizod_number(message, state, sizod_number, message.from_user.id)
+
+async def handle_sizod_suggestion(callback: types.CallbackQuery, state: FSMContext):
+    """Выбор номера СИЗОД из подсказок (sizod_pick_{номер подсказки} или sizod_pick_typed)."""
+    data = await state.get_data()
+    choice = callback.data.removeprefix("sizod_pick_")
+    if choice == "typed":
+        sizod_number = data.get('sizod_typed')
+    else:
+        suggestions = data.get('sizod_suggestions') or []
+        sizod_number = suggestions[int(choice)] if choice.isdigit() and int(choice) < len(suggestions) else None
+    if not sizod_number:
+        await callback.answer("Подсказка устарела. Введите номер СИЗОД.", show_alert=True)
+        return
+    await callback.answer()
+    await state.update_data(sizod_typed=None, sizod_suggestions=None)
+    await callback.message.edit_text(f"СИЗОД №{sizod_number}", reply_markup=None)
+    await _accept_sizod_number(callback.message, state, sizod_number, callback.from_user.id)
+
+def _sizod_suggestions_keyboard(suggestions: list[str]) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text=f"🧯 {number}", callback_data=f"sizod_pick_{index}")]
+        for index, number in enumerate(suggestions)
+    ]
+    # Индекс мог не узнать о новом СИЗОД, добавленном в БД в обход бота - окончательно проверит заступление
+    rows.append([InlineKeyboardButton(text="Оставить как ввели", callback_data="sizod_pick_typed")])
+    rows.append([InlineKeyboardButton(text="❌ Отменить заступление", callback_data="universal_cancel")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def _accept_sizod_number(message: types.Message, state: FSMContext, sizod_number: str, user_id: int):
     await state.update_data(sizod_number=sizod_number)
-    logging.info(f"Пожарный {message.from_user.id} ввел номер СИЗОД: {sizod_number}")
+    logging.info(f"Пожарный {user_id} ввел номер СИЗОД: {sizod_number}")
     await message.answer("Укажите состояние полученного СИЗОД:", reply_markup=get_sizod_status_keyboard())
     await state.set_state(StartShiftStates.CHOOSING_SIZOD_STATUS_START)
 
@@ -324,33 +372,29 @@ async def finalize_firefighter_shift_start(
             async with session.begin():
                 logging.info(f"SRV_DEBUG: finalize_firefighter_shift_start: Transaction block STARTED.")
                 
-                equipment = await session.scalar(
-                    select(Equipment).where(Equipment.inventory_number == data['sizod_number'], Equipment.type == 'СИЗОД')
+                # Закрепляем СИЗОД одним условным UPDATE: если его успел взять другой, строка не обновится
+                equipment = await claim_equipment(
+                    session, employee_db_id,
+                    inventory_number=data['sizod_number'], equipment_type='СИЗОД', allow_reclaim=True
                 )
                 equipment_id_for_log = None
                 error_message_for_user = None
 
                 if equipment:
                     equipment_id_for_log = equipment.id
-                    if equipment.status != 'available' and equipment.current_holder_id != employee_db_id and equipment.current_holder_id is not None:
-                        holder = await session.get(Employee, equipment.current_holder_id)
-                        holder_name = holder.full_name if holder else "неизвестным сотрудником"
-                        error_message_for_user = f"❌ Ошибка: СИЗОД №{data['sizod_number']} уже используется {holder_name} (статус: {equipment.status}). Заступление отменено."
-                    elif equipment.status not in ['available', 'in_use'] and equipment.current_holder_id is None: # СИЗОД свободен, но не 'available' (например, 'maintenance')
-                        error_message_for_user = f"❌ Ошибка: СИЗОД №{data['sizod_number']} сейчас недоступен (статус: {equipment.status}). Заступление отменено."
-                    
-                    if error_message_for_user:
-                        logging.error(f"SRV_DEBUG: finalize_firefighter_shift_start: {error_message_for_user}")
-                        raise ValueError(error_message_for_user) # Вызовет откат транзакции
-
-                    equipment.current_holder_id = employee_db_id
-                    equipment.status = 'in_use' # СИЗОД взят
-                    session.add(equipment)
                     logging.info(f"SRV_DEBUG: finalize_firefighter_shift_start: Equipment {equipment.id} status updated to 'in_use', holder set to {employee_db_id}.")
                 else:
-                    error_message_for_user = f"❌ Ошибка: СИЗОД с инвентарным номером '{data['sizod_number']}' не найден в базе. Обратитесь к администратору. Заступление отменено."
+                    current_state = await get_equipment_state(session, inventory_number=data['sizod_number'], equipment_type='СИЗОД')
+                    if not current_state:
+                        error_message_for_user = f"❌ Ошибка: СИЗОД с инвентарным номером '{data['sizod_number']}' не найден в базе. Обратитесь к администратору. Заступление отменено."
+                    elif current_state.current_holder_id is not None:
+                        holder = await session.get(Employee, current_state.current_holder_id)
+                        holder_name = holder.full_name if holder else "неизвестным сотрудником"
+                        error_message_for_user = f"❌ Ошибка: СИЗОД №{data['sizod_number']} уже используется {holder_name} (статус: {current_state.status}). Заступление отменено."
+                    else: # СИЗОД свободен, но не 'available' (например, 'maintenance')
+                        error_message_for_user = f"❌ Ошибка: СИЗОД №{data['sizod_number']} сейчас недоступен (статус: {current_state.status}). Заступление отменено."
                     logging.error(f"SRV_DEBUG: finalize_firefighter_shift_start: {error_message_for_user}")
-                    raise ValueError(error_message_for_user)
+                    raise ValueError(error_message_for_user) # Вызовет откат транзакции
 
                 new_shift_db_entry = ShiftLog(
                     employee_id=employee_db_id,
@@ -383,6 +427,7 @@ async def finalize_firefighter_shift_start(
                     logging.info(f"SRV_DEBUG: finalize_firefighter_shift_start: EquipmentLog CREATED for shift {new_shift_db_entry.id}.")
             # --- КОММИТ/ОТКАТ ПРОИЗОШЕЛ ---
             logging.info(f"SRV_DEBUG: finalize_firefighter_shift_start: Transaction block COMMITTED (or rollbacked).")
+            mark_on_duty(employee_db_id, data['karakul_number'], start_time=_start_time, sizod_number=data['sizod_number'])
 
             # Если мы здесь, транзакция успешна
             success_text = final_message_text_success_template.format(
@@ -596,6 +641,12 @@ async def finalize_driver_shift_start(message: types.Message, state: FSMContext,
                 logging.info(f"SRV_DEBUG: finalize_driver_shift_start: Vehicle {vehicle_in_transaction.id} status updated to 'in_use'.")
             # --- КОММИТ/ОТКАТ ПРОИЗОШЕЛ ---
             logging.info(f"SRV_DEBUG: finalize_driver_shift_start: Transaction block COMMITTED (or rollbacked).")
+            mark_on_duty(
+                employee_db_id, data['karakul_number'], start_time=_start_time,
+                vehicle_id=vehicle_obj_for_message.id,
+                vehicle_label=f"{vehicle_obj_for_message.model} ({vehicle_obj_for_message.number_plate})",
+                operational_priority=data['operational_priority']
+            )
 
             # Если мы здесь, транзакция успешна
             vehicle_info_str = f"{vehicle_obj_for_message.model} ({vehicle_obj_for_message.number_plate})"
@@ -662,6 +713,7 @@ async def finalize_generic_shift_end(message: types.Message, state: FSMContext,
                     await state.clear() # Очищаем состояние, так как операция не удалась
                     return
             # Коммит произошел
+            mark_off_duty(employee_db_id)
 
             await message.answer(
                 f"✅ Караул №{_karakul_number} успешно завершен ({_end_time_str}).",
@@ -819,6 +871,7 @@ async def finalize_driver_shift_end(message: types.Message, state: FSMContext, s
 
             # --- КОММИТ ПРОИЗОШЕЛ (или rollback при ошибке внутри блока session.begin()) ---
             logging.info(f"SRV_DEBUG: finalize_driver_shift_end: Transaction block COMMITTED (or rollbacked).")
+            mark_off_duty(employee_db_id)
 
             # Сообщение пользователю (если транзакция прошла успешно)
             await message.answer(
@@ -1058,34 +1111,32 @@ async def finalize_firefighter_shift_end(
 
                 # Обновляем Equipment и создаем EquipmentLog
                 if shift_to_end.sizod_number:
-                    equipment = await session.scalar(
-                        select(Equipment).where(Equipment.inventory_number == shift_to_end.sizod_number, Equipment.type == 'СИЗОД')
+                    # Снимаем СИЗОД условным UPDATE: только если он все еще числится за этим сотрудником
+                    equipment = await release_equipment(
+                        session, employee_db_id,
+                        inventory_number=shift_to_end.sizod_number, equipment_type='СИЗОД',
+                        new_status='available' if data.get('sizod_status_end') == 'Исправен' else 'maintenance'
                     )
                     if equipment:
-                        if equipment.current_holder_id == employee_db_id:
-                            equipment.current_holder_id = None
-                            equipment.status = 'available' if data.get('sizod_status_end') == 'Исправен' else 'maintenance'
-                            session.add(equipment)
-                            logging.info(f"SRV_DEBUG: finalize_firefighter_shift_end: Equipment {equipment.id} status set to {equipment.status}, holder removed.")
-
-                            equip_log_notes = f"Сдан с караула №{shift_to_end.karakul_number}. Конечное состояние: {data.get('sizod_status_end', 'N/A')}. "
-                            if data.get('sizod_notes_end') and data.get('sizod_notes_end') != "Описание пропущено при сдаче":
-                                equip_log_notes += f"Примечание: {data['sizod_notes_end']}"
-                            else:
-                                equip_log_notes += "Примечание: нет"
-                            
-                            equip_log = EquipmentLog(
-                                employee_id=employee_db_id, equipment_id=equipment.id, action='returned',
-                                notes=equip_log_notes, shift_log_id=active_shift_id
-                            )
-                            session.add(equip_log)
-                            logging.info(f"SRV_DEBUG: finalize_firefighter_shift_end: EquipmentLog created for SIZOD return.")
+                        logging.info(f"SRV_DEBUG: finalize_firefighter_shift_end: Equipment {equipment.id} status set to {equipment.status}, holder removed.")
+
+                        equip_log_notes = f"Сдан с караула №{shift_to_end.karakul_number}. Конечное состояние: {data.get('sizod_status_end', 'N/A')}. "
+                        if data.get('sizod_notes_end') and data.get('sizod_notes_end') != "Описание пропущено при сдаче":
+                            equip_log_notes += f"Примечание: {data['sizod_notes_end']}"
                         else:
-                            logging.warning(f"SRV_DEBUG: finalize_firefighter_shift_end: SIZOD {shift_to_end.sizod_number} was not held by employee {employee_db_id}...")
+                            equip_log_notes += "Примечание: нет"
+                        
+                        equip_log = EquipmentLog(
+                            employee_id=employee_db_id, equipment_id=equipment.id, action='returned',
+                            notes=equip_log_notes, shift_log_id=active_shift_id
+                        )
+                        session.add(equip_log)
+                        logging.info(f"SRV_DEBUG: finalize_firefighter_shift_end: EquipmentLog created for SIZOD return.")
                     else:
-                        logging.warning(f"SRV_DEBUG: finalize_firefighter_shift_end: SIZOD {shift_to_end.sizod_number} not found in Equipment table...")
+                        logging.warning(f"SRV_DEBUG: finalize_firefighter_shift_end: SIZOD {shift_to_end.sizod_number} not found or not held by employee {employee_db_id}...")
             # --- Транзакция завершена (commit или rollback) ---
             logging.info(f"SRV_DEBUG: finalize_firefighter_shift_end: Transaction block COMMITTED (or rollbacked).")
+            mark_off_duty(employee_db_id)
 
             # Если мы здесь, значит транзакция (вероятно) прошла успешно
             success_text = final_message_text_success_template.format(
@@ -0,0 +1,155 @@
+import bisect
+import logging
+import os
+import time
+from typing import Any
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramAPIError
+from aiogram.methods import (
+    AnswerCallbackQuery, GetUpdates, SendAudio, SendDocument, SendMediaGroup,
+    SendPhoto, SendVideo, SendVoice, TelegramMethod
+)
+
+from app.circuit_breaker import CircuitBreaker, CircuitOpenError, OUTAGE_ERRORS, telegram_breaker
+
+try:
+    import orjson
+except ImportError: # orjson не обязателен - без него используется стандартный json
+    orjson = None
+
+# --- Общая настроенная HTTP-сессия для Bot ---
+# Один пул keep-alive соединений к api.telegram.org на весь бот, кэш DNS, таймауты по
+# типу метода (загрузка файлов долгая, ответ на callback должен быть быстрым) и быстрый
+# JSON. Время каждого запроса к Bot API пишется в гистограмму по методу, чтобы отделять
+# сетевые задержки Telegram от времени работы обработчиков. Запросы идут через
+# предохранитель: при недоступности Telegram они сразу завершаются CircuitOpenError.
+
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "50"))          # Всего соединений
+TELEGRAM_KEEPALIVE_SECONDS = float(os.getenv("TELEGRAM_KEEPALIVE_SECONDS", "60"))
+TELEGRAM_DNS_CACHE_SECONDS = int(os.getenv("TELEGRAM_DNS_CACHE_SECONDS", "600"))
+
+DEFAULT_REQUEST_TIMEOUT = float(os.getenv("TELEGRAM_REQUEST_TIMEOUT", "15"))
+CALLBACK_ANSWER_TIMEOUT = 5    # Telegram все равно перестает ждать ответ на callback через ~10 с
+FILE_UPLOAD_TIMEOUT = 120      # Отчеты и документы
+FILE_UPLOAD_METHODS = (SendDocument, SendPhoto, SendVideo, SendAudio, SendVoice, SendMediaGroup)
+
+# Границы корзин гистограммы задержек, мс (последняя корзина - все, что больше)
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LATENCY_LOG_INTERVAL_SECONDS = 300
+
+
+def _orjson_dumps(value: Any) -> str:
+    return orjson.dumps(value).decode()
+
+
+class LatencyHistogram:
+    """Гистограмма задержек одного метода Bot API."""
+
+    __slots__ = ('counts', 'total_ms', 'errors')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.errors = 0
+
+    def observe(self, elapsed_ms: float, failed: bool):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.total_ms += elapsed_ms
+        if failed:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Верхняя граница корзины, в которую попадает квантиль q (None - за последней границей)."""
+        total = sum(self.counts)
+        if not total:
+            return 0.0
+        threshold = q * total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else None
+        return None
+
+    def snapshot(self) -> dict:
+        total = sum(self.counts)
+        return {
+            'count': total,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / total, 1) if total else 0.0,
+            'p50_le_ms': self.quantile(0.5),
+            'p95_le_ms': self.quantile(0.95),
+            'buckets': dict(zip([*map(str, LATENCY_BUCKETS_MS), 'inf'], self.counts)),
+        }
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """AiohttpSession с пулом соединений, кэшем DNS, таймаутами по методу, гистограммами задержек и предохранителем."""
+
+    def __init__(self, pool_size: int = TELEGRAM_POOL_SIZE, breaker: CircuitBreaker = telegram_breaker, **kwargs: Any):
+        if orjson is not None:
+            kwargs.setdefault('json_loads', orjson.loads)
+            kwargs.setdefault('json_dumps', _orjson_dumps)
+        kwargs.setdefault('timeout', DEFAULT_REQUEST_TIMEOUT)
+        super().__init__(limit=pool_size, **kwargs)
+        self._connector_init.update(
+            ttl_dns_cache=TELEGRAM_DNS_CACHE_SECONDS,
+            use_dns_cache=True,
+            keepalive_timeout=TELEGRAM_KEEPALIVE_SECONDS,
+        )
+        self.breaker = breaker
+        self.latency: dict[str, LatencyHistogram] = {}
+        self._last_latency_log = time.monotonic()
+        logging.info(f"HTTP-сессия Bot API: пул {pool_size} соединений, JSON: {'orjson' if orjson is not None else 'json'}.")
+
+    @staticmethod
+    def timeout_for(method: TelegramMethod) -> float | None:
+        """Таймаут по типу метода (None - общий таймаут сессии)."""
+        if isinstance(method, AnswerCallbackQuery):
+            return CALLBACK_ANSWER_TIMEOUT
+        if isinstance(method, FILE_UPLOAD_METHODS):
+            return FILE_UPLOAD_TIMEOUT
+        return None
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        if timeout is None:
+            timeout = self.timeout_for(method) # getUpdates передает свой таймаут явно
+        # getUpdates не блокируется предохранителем: опрос сам служит пробным запросом
+        # (у aiogram для него есть свой backoff), его результат тоже учитывается
+        if not isinstance(method, GetUpdates) and not self.breaker.before_request():
+            raise CircuitOpenError(method=method, message="Bot API недоступен (предохранитель разомкнут)")
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super().make_request(bot, method, timeout)
+            failed = False
+        except OUTAGE_ERRORS:
+            self.breaker.record_failure()
+            raise
+        except TelegramAPIError:
+            self.breaker.record_success() # Telegram ответил (ошибка в самом запросе) - сервис доступен
+            raise
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+        finally:
+            self._observe(method, (time.perf_counter() - started) * 1000, failed)
+        self.breaker.record_success()
+        return result
+
+    def _observe(self, method: TelegramMethod, elapsed_ms: float, failed: bool):
+        name = method.__api_method__
+        histogram = self.latency.get(name)
+        if histogram is None:
+            histogram = self.latency[name] = LatencyHistogram()
+        histogram.observe(elapsed_ms, failed)
+        now = time.monotonic()
+        if now - self._last_latency_log >= LATENCY_LOG_INTERVAL_SECONDS:
+            self._last_latency_log = now
+            logging.info(f"Задержки Bot API: {self.latency_metrics(exclude=(GetUpdates.__api_method__,))}")
+
+    def latency_metrics(self, exclude: tuple[str, ...] = ()) -> dict:
+        """Снимок гистограмм задержек по методам Bot API."""
+        return {name: histogram.snapshot() for name, histogram in self.latency.items() if name not in exclude}
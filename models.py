@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, JSON, select, DateTime, Boolean, Text
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, JSON, select, Date, DateTime, Boolean, Text, inspect, UniqueConstraint, Index
 from sqlalchemy.orm import DeclarativeBase, relationship
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 import asyncio
+import logging
 from datetime import datetime
 
 engine = create_async_engine(url='sqlite+aiosqlite:///database.db')
@@ -45,13 +46,20 @@ class Equipment(Base):
     type = Column(String, nullable=False) # Тип (СИЗОД, каска, боевка и т.д.)
     inventory_number = Column(String, unique=True, nullable=True) # Инвентарный номер (может быть полезен)
     service_life = Column(String, nullable=True) # Срок службы (может быть дата или период)
+    service_life_until = Column(Date, nullable=True, index=True) # Срок службы до (разобран из service_life, app/legacy_dates.py)
+    expiry_notified_until = Column(Date, nullable=True) # Срок службы, о котором НК уже получили сводку (app/maintenance_scans.py)
     status = Column(String, nullable=False, default='available') # Статус самого снаряжения (available, in_use, maintenance, decommissioned)
     current_holder_id = Column(Integer, ForeignKey('employees.id'), nullable=True)
+    # Версия строки для оптимистичной блокировки: увеличивается при каждом изменении
+    # (ORM делает это сам через version_id_col, условные UPDATE в app/equipment_checkout.py - явно)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
     
     # Связь с логами (один ко многим)
     logs = relationship('EquipmentLog', back_populates='equipment')
     current_holder = relationship('Employee', back_populates='held_equipment')
 
+    __mapper_args__ = {"version_id_col": version}
+
 class EquipmentLog(Base):
     __tablename__ = 'equipment_logs'
 
@@ -75,6 +83,7 @@ class Trip(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     date = Column(String, nullable=False)
     time = Column(String, nullable=False)
+    event_time = Column(DateTime, nullable=True, index=True) # date + time одной колонкой (app/legacy_dates.py)
     address = Column(String, nullable=False)
     personnel = Column(JSON, nullable=False)
     result = Column(String, nullable=False)
@@ -110,6 +119,10 @@ class Report(Base):
     report_type = Column(String, nullable=False)
     data = Column(JSON, nullable=False)
     created_at = Column(String, nullable=False)
+    creation_time = Column(DateTime, nullable=True, index=True) # created_at в виде даты (app/legacy_dates.py)
+    # Реестр уже загруженных в Telegram файлов отчетов: хэш содержимого -> file_id
+    content_hash = Column(String, nullable=True, index=True)
+    telegram_file_id = Column(String, nullable=True)
 
 class Vehicle(Base):
     __tablename__ = "vehicles"
@@ -118,15 +131,21 @@ class Vehicle(Base):
     model = Column(String)
     fuel_rate = Column(Float)
     status = Column(String) # "available", "in_use"
-    last_check = Column(DateTime, nullable = True)
+    last_check = Column(DateTime, nullable = True, index=True) # Индекс - для поиска просроченных осмотров (app/maintenance_scans.py)
 
 # --- Новая модель для Задания/Выезда ---
 class DispatchOrder(Base):
     __tablename__ = 'dispatch_orders'
+    # Поиск повторных вызовов: точечный запрос по адресу в недавнем окне времени
+    __table_args__ = (
+        Index('ix_dispatch_orders_address_normalized_created', 'address_normalized', 'creation_time'),
+        Index('ix_dispatch_orders_status_created', 'status', 'creation_time'), # Зависшие на утверждении (app/maintenance_scans.py)
+    )
 
     id = Column(Integer, primary_key=True)
     dispatcher_id = Column(Integer, ForeignKey('employees.id'), nullable=False) # ID диспетчера, создавшего задание
     address = Column(String, nullable=False) # Адрес выезда
+    address_normalized = Column(String, nullable=True) # Ключ адреса для поиска повторных вызовов (app/duplicate_calls.py)
     reason = Column(String, nullable=False) # Причина вызова
     creation_time = Column(DateTime, default=datetime.now, nullable=False) # Время создания
 
@@ -159,6 +178,10 @@ class DispatchOrder(Base):
 # --- Новая модель для Журнала Караулов/Смен ---
 class ShiftLog(Base):
     __tablename__ = 'shift_logs'
+    __table_args__ = (
+        Index('ix_shift_logs_status_start_time', 'status', 'start_time'), # Незакрытые смены (app/maintenance_scans.py)
+        Index('ix_shift_logs_vehicle_end_time', 'vehicle_id', 'end_time'), # Последние показания машины (app/karakul_start.py)
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     employee_id = Column(Integer, ForeignKey('employees.id'), nullable=False)
@@ -166,6 +189,7 @@ class ShiftLog(Base):
     start_time = Column(DateTime, default=datetime.now, nullable=False)
     end_time = Column(DateTime, nullable=True)
     status = Column(String, default='active', nullable=False) # 'active', 'completed'
+    end_reason = Column(String, nullable=True) # Почему закрыта без сотрудника: 'karakul_closed', 'max_duration' (app/shift_closure.py)
 
     # --- Поля для Водителя ---
     vehicle_id = Column(Integer, ForeignKey('vehicles.id'), nullable=True)
@@ -201,13 +225,76 @@ class AbsenceLog(Base):
     reported_at = Column(DateTime, default=datetime.now, nullable=False)
     reporter = relationship('Employee', back_populates='reported_absences', foreign_keys=[reporter_employee_id])
 
+# --- Бронирование ЛС и техники при создании выезда ---
+# Одна строка на ресурс: мягкая бронь (dispatch_id IS NULL) держится, пока диспетчер выбирает состав,
+# жесткая (dispatch_id задан) - пока выезд не отклонен или не истек срок. Рабочая копия - в app/reservations.py.
+class ResourceReservation(Base):
+    __tablename__ = 'resource_reservations'
+    __table_args__ = (UniqueConstraint('resource_type', 'resource_id'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    resource_type = Column(String, nullable=False) # 'employee' или 'vehicle'
+    resource_id = Column(Integer, nullable=False)
+    owner_telegram_id = Column(Integer, nullable=False) # Диспетчер, который забронировал
+    dispatch_id = Column(Integer, ForeignKey('dispatch_orders.id'), nullable=True)
+    expires_at = Column(DateTime, nullable=False)
+
+# Исходящие уведомления Telegram (transactional outbox): строка пишется в той же транзакции,
+# что и изменение статуса, а отправляет ее фоновый отправитель (app/outbox.py)
+class OutboxMessage(Base):
+    __tablename__ = 'outbox_messages'
+    __table_args__ = (
+        Index('ix_outbox_messages_status_next_attempt', 'status', 'next_attempt_at'),
+        Index('ix_outbox_messages_chat_status', 'chat_id', 'status'), # Более ранние сообщения чата (app/outbox.py)
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String, nullable=True)
+    reply_markup = Column(Text, nullable=True) # JSON inline-клавиатуры
+    status = Column(String, nullable=False, default='pending') # 'pending', 'sending', 'sent', 'failed'
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.now)
+    claimed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    sent_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+
+# Отметки "обработано до" для инкрементальных фоновых заданий (app/scheduler.py)
+class JobHighWaterMark(Base):
+    __tablename__ = 'job_high_water_marks'
+
+    job_name = Column(String, primary_key=True)
+    value = Column(String, nullable=False) # Дата/время в ISO-формате
+    updated_at = Column(DateTime, nullable=False, default=datetime.now)
+
 async def get_db():
     async with async_session() as session:
         yield session
 
+def _add_missing_columns(sync_conn):
+    """Добавляет в уже существующие таблицы новые колонки и индексы моделей (create_all их не добавляет)."""
+    inspector = inspect(sync_conn)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=sync_conn.dialect)}"
+            if column.server_default is not None:
+                ddl += f" NOT NULL DEFAULT '{column.server_default.arg}'" if not column.nullable else f" DEFAULT '{column.server_default.arg}'"
+            sync_conn.exec_driver_sql(ddl)
+            logging.info(f"Миграция: в таблицу {table.name} добавлена колонка {column.name}.")
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
 async def create_tables():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
 
 if __name__ == "__main__":
     asyncio.run(create_tables())
@@ -1,24 +1,63 @@
 import asyncio
 import os
 import logging
+from functools import partial
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher,Router
 from aiogram.fsm.storage.memory import MemoryStorage
 from app import register_handlers
-from models import create_tables
+from models import create_tables, engine, async_session
+from app.query_budget import install_query_counter
+from app.duty_registry import warm_duty_registry
+from app.reservations import warm_reservations
+from app.chat_ordering import ChatTicketMiddleware, chat_order
+from app.outbox import OutboxSender, purge_outbox, OUTBOX_PURGE_SCHEDULE
+from app.telegram_session import TunedAiohttpSession
+from app.archive import install_archive, ensure_archive_schema, run_archival, ARCHIVAL_SCHEDULE
+from app.dispatch_search import ensure_search_index
+from app.duplicate_calls import backfill_normalized_addresses
+from app.address_autocomplete import warm_address_autocomplete
+from app.inventory_index import warm_inventory_index
+from app.legacy_dates import migrate_legacy_dates
+from app.scheduler import job_scheduler
+from app.maintenance_scans import register_maintenance_jobs
+from app.shift_closure import close_stale_shifts, SHIFT_CLOSURE_SCHEDULE
 load_dotenv()
 
 async def main():
     
+    install_archive(engine) # archive.db и представления *_all на каждом соединении
     await create_tables()
-    bot = Bot(token=os.getenv("BOT_TOKEN"))
+    await ensure_archive_schema(engine)
+    await migrate_legacy_dates(async_session) # Типизированные даты из строковых (срок службы снаряжения и др.)
+    await ensure_search_index(engine) # Полнотекстовый индекс выездов (FTS5) и триггеры
+    await backfill_normalized_addresses(async_session) # Ключи адресов активных выездов для поиска повторных вызовов
+    install_query_counter(engine) # Подсчет SQL-запросов для бюджетов обработчиков
+    await warm_duty_registry(async_session) # Реестр заступивших на караул для меню
+    await warm_reservations(async_session) # Брони ЛС/техники для создания выездов
+    await warm_address_autocomplete(async_session) # Подсказки адресов по истории выездов
+    await warm_inventory_index(async_session) # Инвентарные номера снаряжения для проверки номера СИЗОД
+    bot = Bot(token=os.getenv("BOT_TOKEN"), session=TunedAiohttpSession()) # Метрики задержек: bot.session.latency_metrics()
+    outbox_sender = OutboxSender(bot, async_session) # Фоновая отправка уведомлений из outbox
+    outbox_sender.start()
+    # Фоновые задания по расписанию
+    job_scheduler.add_job('archival', ARCHIVAL_SCHEDULE, partial(run_archival, async_session), jitter_seconds=600) # Перенос старых данных в archive.db
+    job_scheduler.add_job('outbox_purge', OUTBOX_PURGE_SCHEDULE, partial(purge_outbox, async_session), jitter_seconds=600) # Старые отправленные/неудачные уведомления
+    register_maintenance_jobs(job_scheduler, async_session) # Сводки НК: осмотры техники, сроки службы, незакрытые смены, неутвержденные выезды
+    job_scheduler.add_job('stale_shift_closure', SHIFT_CLOSURE_SCHEDULE, partial(close_stale_shifts, async_session), jitter_seconds=60) # Закрытие забытых смен
+    job_scheduler.start()
     dp = Dispatcher(storage=MemoryStorage())
     
     router = Router()
     register_handlers(router, bot)
     dp.include_router(router)
     
-    await dp.start_polling(bot)
+    dp.update.outer_middleware(ChatTicketMiddleware(chat_order)) # Порядок апдейтов чата для обработчиков с флагом CHAT_ORDERED
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await job_scheduler.stop()
+        await outbox_sender.stop()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,36 @@
+import pytest
+
+from app.duplicate_calls import address_prefix_key, normalize_address
+
+
+@pytest.mark.parametrize('address', [
+    "Ленина 5к2",
+    "Ленина 5 к 2",
+    "Ленина 5 к2",
+    "Ленина, д. 5, корп. 2",
+    "ул. Ленина, дом 5, корпус 2",
+    "Ленина д5к2",
+    "Ленина д.5 к.2, кв. 14",
+])
+def test_building_number_variants_share_key(address):
+    assert normalize_address(address) == "ленина 5 к2"
+
+
+@pytest.mark.parametrize('address', ["Ленина 5с1", "Ленина 5 с1", "Ленина, д. 5, стр. 1", "Ленина д5с1"])
+def test_structure_number_variants_share_key(address):
+    assert normalize_address(address) == "ленина 5 с1"
+
+
+@pytest.mark.parametrize('address, expected', [
+    ("ул. Ленина, д5", "ленина 5"),
+    ("Ленина 12ак3", "ленина 12а к3"),
+    ("Садовая 12 а", "садовая 12а"),
+    ("Проспект Мира, дом 7 А", "мира пр 7а"),
+    ("г. Москва, ул. Сезам 5, подъезд 2", "сезам 5"),
+])
+def test_normalize_address(address, expected):
+    assert normalize_address(address) == expected
+
+
+def test_prefix_key_splits_building_like_duplicate_key():
+    assert address_prefix_key("пр-т Мира, д7к1") == address_prefix_key("Мира 7 корп. 1") == "мира 7 к1"
@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+from app.idempotency import IdempotentCallbackMiddleware, allow_callback_retry
+
+
+def _callback(data: str):
+    return SimpleNamespace(
+        id='1', data=data, answer=AsyncMock(),
+        message=SimpleNamespace(chat=SimpleNamespace(id=10), message_id=20),
+        from_user=SimpleNamespace(id=30)
+    )
+
+
+def test_repeated_press_skipped_after_success():
+    async def run():
+        middleware = IdempotentCallbackMiddleware()
+        calls = []
+
+        async def handler(event, data):
+            calls.append(event.data)
+
+        await middleware(handler, _callback('dispatch_confirm'), {})
+        await middleware(handler, _callback('dispatch_confirm'), {})
+        assert calls == ['dispatch_confirm']
+
+    asyncio.run(run())
+
+
+def test_press_after_reported_error_reaches_handler():
+    async def run():
+        middleware = IdempotentCallbackMiddleware()
+        calls = []
+
+        async def handler(event, data):
+            calls.append(event.data)
+            if len(calls) == 1:
+                allow_callback_retry() # Ошибка сохранения, пользователю уже показано сообщение
+
+        await middleware(handler, _callback('dispatch_confirm'), {})
+        await middleware(handler, _callback('dispatch_confirm'), {})
+        await middleware(handler, _callback('dispatch_confirm'), {})
+        assert calls == ['dispatch_confirm', 'dispatch_confirm']
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+import asyncio
+
+from app.priority_scheduler import PRIORITY_CRITICAL, PRIORITY_SHIFT, PriorityScheduler
+
+
+def test_class_limit_waiters_do_not_hold_back_other_classes():
+    async def run():
+        scheduler = PriorityScheduler({PRIORITY_CRITICAL: 2, PRIORITY_SHIFT: 2, 'background': 1}, total_limit=4)
+        await scheduler.acquire(PRIORITY_CRITICAL)
+        await scheduler.acquire(PRIORITY_CRITICAL)
+        critical_waiter = asyncio.create_task(scheduler.acquire(PRIORITY_CRITICAL)) # Предел класса исчерпан
+        await asyncio.sleep(0)
+        # Общий предел не исчерпан: смена стартует, не дожидаясь выездов
+        await asyncio.wait_for(scheduler.acquire(PRIORITY_SHIFT), timeout=1)
+        assert not critical_waiter.done()
+        scheduler.release(PRIORITY_CRITICAL)
+        await asyncio.wait_for(critical_waiter, timeout=1)
+
+    asyncio.run(run())
+
+
+def test_lower_class_waits_behind_higher_when_total_limit_reached():
+    async def run():
+        scheduler = PriorityScheduler({PRIORITY_CRITICAL: 2, PRIORITY_SHIFT: 2, 'background': 1}, total_limit=2)
+        await scheduler.acquire(PRIORITY_SHIFT)
+        await scheduler.acquire(PRIORITY_SHIFT)
+        critical_waiter = asyncio.create_task(scheduler.acquire(PRIORITY_CRITICAL))
+        shift_waiter = asyncio.create_task(scheduler.acquire(PRIORITY_SHIFT))
+        await asyncio.sleep(0)
+        scheduler.release(PRIORITY_SHIFT)
+        await asyncio.sleep(0)
+        assert critical_waiter.done() and not shift_waiter.done()
+        shift_waiter.cancel()
+
+    asyncio.run(run())
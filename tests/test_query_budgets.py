@@ -0,0 +1,151 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from aiogram import types
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+import app.archive
+import app.dispatcher
+from app.archive import ensure_archive_schema, install_archive
+from app.dispatch_search import ensure_search_index
+from app.dispatcher import (
+    _generate_dispatch_list_page, _generate_dispatch_search_page,
+    show_confirmation_summary, show_full_dispatch_details
+)
+from app.drivers import _generate_trip_history_page
+from app.firefighter import show_my_active_dispatches
+from app.query_budget import HANDLER_QUERY_BUDGETS, count_queries, install_query_counter
+from models import Base, DispatchOrder, Employee, TripSheet, Vehicle
+
+# --- Бюджеты SQL-запросов обработчиков (app/query_budget.py) ---
+# Каждый обработчик из HANDLER_QUERY_BUDGETS вызывается на базе SQLite в памяти,
+# где строк больше, чем помещается на одну страницу: запрос "на каждую строку" (N+1)
+# выведет счетчик за бюджет.
+
+DRIVER_TELEGRAM_ID = 1002
+FIREFIGHTER_TELEGRAM_ID = 1001
+
+
+async def _seed(session_factory: async_sessionmaker):
+    async with session_factory() as session:
+        async with session.begin():
+            for i in range(1, 31):
+                session.add(Employee(
+                    id=i, telegram_id=1000 + i, full_name=f"Иванов {i} И",
+                    position=['Пожарный', 'Водитель', 'Диспетчер', 'Начальник караула'][i % 4],
+                    rank='Рядовой', contacts='+7999', is_ready=True
+                ))
+            for i in range(1, 11):
+                session.add(Vehicle(id=i, number_plate=f"А{i:03d}АА", model=f"АЦ-{i}", fuel_rate=30.0, status='available'))
+            for i in range(1, 21):
+                session.add(DispatchOrder(
+                    id=i, dispatcher_id=3, address=f"ул. Ленина, д. {i}", reason="Пожар",
+                    status='approved' if i % 2 else 'completed',
+                    assigned_personnel_ids=json.dumps([1, 2, 5, 6]), assigned_vehicle_ids=json.dumps([1, 2, 3])
+                ))
+            for i in range(12):
+                session.add(TripSheet(
+                    driver_id=DRIVER_TELEGRAM_ID, vehicle_id=1 + i % 10, destination='Депо',
+                    mileage=10, fuel_consumption=3, status='completed'
+                ))
+
+
+@pytest.fixture
+def session_factory(monkeypatch):
+    monkeypatch.setattr(app.archive, 'ARCHIVE_DB_PATH', ':memory:')
+    # Одно соединение на весь тест: база в памяти живет, пока оно открыто
+    engine = create_async_engine('sqlite+aiosqlite://', poolclass=StaticPool)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+    monkeypatch.setattr(app.dispatcher, 'async_session', factory)
+
+    async def prepare():
+        install_archive(engine)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        await ensure_archive_schema(engine)
+        await ensure_search_index(engine)
+        await _seed(factory)
+        install_query_counter(engine)
+
+    asyncio.run(prepare())
+    yield factory
+    asyncio.run(engine.dispose())
+
+
+def _callback(data: str, telegram_id: int = FIREFIGHTER_TELEGRAM_ID) -> MagicMock:
+    callback = MagicMock()
+    callback.__class__ = types.CallbackQuery # Для проверок isinstance в обработчиках
+    callback.data = data
+    callback.from_user.id = telegram_id
+    callback.answer = AsyncMock()
+    callback.message.answer = AsyncMock()
+    callback.message.edit_text = AsyncMock()
+    return callback
+
+
+def _message(telegram_id: int = FIREFIGHTER_TELEGRAM_ID) -> MagicMock:
+    message = MagicMock()
+    message.__class__ = types.Message
+    message.from_user.id = telegram_id
+    message.answer = AsyncMock()
+    return message
+
+
+async def _trip_history(session_factory):
+    async with session_factory() as session:
+        await _generate_trip_history_page(session, DRIVER_TELEGRAM_ID, 1)
+
+
+async def _dispatch_list(session_factory):
+    async with session_factory() as session:
+        await _generate_dispatch_list_page(session, 1, 'archived')
+
+
+async def _dispatch_search(session_factory):
+    async with session_factory() as session:
+        await _generate_dispatch_search_page(session, "Ленина", 1)
+
+
+async def _confirmation_summary(session_factory):
+    state = AsyncMock()
+    state.get_data.return_value = {
+        'address': "ул. Ленина, д. 100", 'reason': "Пожар",
+        'selected_personnel_ids': {1, 2, 5, 6}, 'selected_vehicle_ids': {1, 2, 3},
+    }
+    await show_confirmation_summary(_callback("dispatch_vehicles_done"), state)
+
+
+async def _dispatch_details(session_factory):
+    await show_full_dispatch_details(_callback("dispatch_details_1"), session_factory)
+
+
+async def _my_active_dispatches(session_factory):
+    await show_my_active_dispatches(_message(), session_factory)
+
+
+HANDLER_CALLS = {
+    '_generate_trip_history_page': _trip_history,
+    '_generate_dispatch_list_page': _dispatch_list,
+    '_generate_dispatch_search_page': _dispatch_search,
+    'show_confirmation_summary': _confirmation_summary,
+    'show_full_dispatch_details': _dispatch_details,
+    'show_my_active_dispatches': _my_active_dispatches,
+}
+
+
+def test_every_budget_is_exercised():
+    assert set(HANDLER_CALLS) == set(HANDLER_QUERY_BUDGETS)
+
+
+@pytest.mark.parametrize('name', sorted(HANDLER_QUERY_BUDGETS))
+def test_handler_within_query_budget(name, session_factory):
+    async def run():
+        async with count_queries(name) as counter:
+            await HANDLER_CALLS[name](session_factory)
+        return counter
+
+    counter = asyncio.run(run())
+    assert 0 < counter.count <= HANDLER_QUERY_BUDGETS[name], counter.statements
@@ -0,0 +1,23 @@
+from datetime import datetime
+
+import pytest
+
+from app.scheduler import CronSpec
+
+
+def test_day_and_weekday_both_restricted_match_either():
+    spec = CronSpec.parse("0 8 1 * 1")
+    # 19.10.2026 - понедельник: совпадает день недели, число - нет
+    assert spec.next_after(datetime(2026, 10, 18, 9, 0)) == datetime(2026, 10, 19, 8, 0)
+
+
+def test_stepped_day_field_counts_as_unrestricted():
+    spec = CronSpec.parse("0 8 */2 * 1")
+    assert spec.any_day
+    # Нужны оба условия: нечетное число и понедельник
+    assert spec.next_after(datetime(2026, 10, 19, 9, 0)) == datetime(2026, 11, 9, 8, 0)
+
+
+def test_schedule_without_matches_raises():
+    with pytest.raises(ValueError):
+        CronSpec.parse("0 0 31 2 *").next_after(datetime(2026, 1, 1))